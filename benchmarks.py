@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmarks.py
+
+Benchmarks of the framing, parsing and proxying hot paths.
+
+Every benchmark is a function returning a run() callable that does one
+round of work and returns (ops, bytes) for it. Rounds are repeated for
+at least min_time seconds, best of repeat tries, and reported as ops/s
+and MB/s along with two rough memory figures (Python 2 has no
+tracemalloc): the growth of the peak RSS and the number of gc tracked
+objects still alive after the benchmark. Everything runs offline on the
+bundled testpacks*.packs data and synthetic workloads.
+
+  python benchmarks.py --output results.json
+  python benchmarks.py --baseline results.json --fail
+"""
+
+import gc
+import json
+import platform
+import random
+import resource
+import socket
+import struct
+import sys
+import time
+import unittest
+
+BENCHMARKS = []
+
+def benchmark(name):
+  def register(function):
+    BENCHMARKS.append((name, function))
+    return function
+  return register
+
+def recvs(data, size):
+  return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+def packs_data(memo = []):
+  if not memo:
+    from packs import read_payload
+    memo.append(read_payload('testpacks.packs') + read_payload('testpacks2.packs'))
+  return memo[0]
+
+def char_list_packet(characters = 9):
+  """
+  A 0x006B character list, the largest packet the bot parses.
+  """
+  from parsers import char_response_parser
+  layout = char_response_parser.layout
+  body = ''.join(chr(random.randrange(256)) for _ in xrange(layout.repeat_size * characters))
+  prefix = '\x6b\x00' + struct.pack('<H', layout.start + layout.head_size + len(body))
+  return prefix + '\x00' * layout.head_size + body
+
+def make_stream_chunker(size):
+  def setup():
+    from stream_chunker import StreamChunker
+    data = packs_data()
+    chunks = recvs(data, size)
+
+    def run():
+      chunker = StreamChunker()
+      for _ in xrange(len(data) // 16):
+        chunker.chunk(16)
+      for chunk in chunks:
+        chunker.add_data(chunk)
+      return len(chunker.chunks), len(data)
+    return run
+  return setup
+
+def make_packet_chunker(size):
+  def setup():
+    from stream_chunker import PacketChunker
+    data = packs_data()
+    chunks = recvs(data, size)
+
+    def run():
+      chunker, count = PacketChunker(), 0
+      for chunk in chunks:
+        chunker.add_data(chunk)
+        while chunker.has_chunk():
+          chunker.pop()
+          count += 1
+      return count, len(data)
+    return run
+  return setup
+
+def make_packet_framer(size):
+  def setup():
+    from framer import PacketFramer
+    data = packs_data()
+    chunks = recvs(data, size)
+
+    def run():
+      framer, count = PacketFramer(), 0
+      for chunk in chunks:
+        count += len(framer.add_data(chunk))
+      return count, len(data)
+    return run
+  return setup
+
+def make_parser(format):
+  def setup():
+    from parsers import char_response_parser
+    packets = [char_list_packet() for _ in xrange(100)]
+
+    def run():
+      for packet in packets:
+        char_response_parser(packet, format)
+      return len(packets), sum(len(packet) for packet in packets)
+    return run
+  return setup
+
+for size in (1, 8192):
+  benchmark('stream_chunker.recv%d' % size)(make_stream_chunker(size))
+  benchmark('packet_chunker.recv%d' % size)(make_packet_chunker(size))
+  benchmark('packet_framer.recv%d' % size)(make_packet_framer(size))
+
+for format in ('dict', 'record', 'view'):
+  benchmark('parser.char_list.%s' % format)(make_parser(format))
+
+@benchmark('registry.parse.testpacks')
+def registry_parse():
+  from framer import PacketFramer
+  from packet import ParseError
+  from registry import default_registry
+  registry = default_registry()
+  frames = []
+  for opcode, frame in PacketFramer().add_data(packs_data()):
+    #only the packets our specs agree with
+    try:
+      if registry.parse(opcode, frame.tobytes(), 'record') is not None:
+        frames.append((opcode, frame.tobytes()))
+    except ParseError:
+      pass
+
+  def run():
+    for opcode, frame in frames:
+      registry.parse(opcode, frame, 'record')
+    return len(frames), sum(len(frame) for _, frame in frames)
+  return run
+
+def make_parse_stream(batched):
+  def setup():
+    from registry import default_registry
+    registry = default_registry()
+    move = '\x86\x00' + '\x00' * 10 + '\x88' + '\x00' * 3
+    data = (move * 50 + '\x7f\x00' + '\x00' * 4) * 100
+    chunks = recvs(data, 8192)
+
+    def run():
+      count = 0
+      if batched:
+        for batch in registry.parse_stream(chunks):
+          count += batch.count
+      else:
+        from framer import PacketFramer
+        framer = PacketFramer()
+        for chunk in chunks:
+          for opcode, frame in framer.add_data(chunk):
+            registry.parse(opcode, frame, 'record')
+            count += 1
+      return count, len(data)
+    return run
+  return setup
+
+benchmark('registry.parse_stream.moves')(make_parse_stream(True))
+benchmark('registry.parse.moves')(make_parse_stream(False))
+
+@benchmark('world.feed.moves')
+def world_feed():
+  from data import pack_bytes
+  from world import World, MOVE_BITS
+  moves = []
+  for _ in xrange(5000):
+    id = random.randrange(1, 500)
+    position = pack_bytes([random.randrange(400) for _ in xrange(4)], MOVE_BITS)
+    moves.append('\x86\x00' + struct.pack('<I', id) + position + '\x88' + '\x00' * 4)
+  chunks = recvs(''.join(moves), 8192)
+  world = World()
+
+  def run():
+    world.feed(chunks)
+    world.nearby(200, 200, 15)
+    return len(moves), sum(len(chunk) for chunk in chunks)
+  return run
+
+@benchmark('data.unpack_bytes.position')
+def data_unpack():
+  from data import unpack_bytes
+  positions = [''.join(chr(random.randrange(256)) for _ in xrange(5)) for _ in xrange(10000)]
+  lengths = (10, 10, 10, 10)
+
+  def run():
+    for position in positions:
+      unpack_bytes(position, lengths)
+    return len(positions), 5 * len(positions)
+  return run
+
+@benchmark('data.unpack.hex')
+def data_unpack_hex():
+  from data import unpack
+  positions = [''.join(random.choice('0123456789abcdef') for _ in xrange(10)) for _ in xrange(10000)]
+  lengths = (10, 10, 10, 10)
+
+  def run():
+    for position in positions:
+      unpack(position, lengths)
+    return len(positions), 5 * len(positions)
+  return run
+
+def make_forwarding(size, processor_name, profiled = False):
+  def setup():
+    import asyncore
+    import processor
+    from swapper import SwapHandler
+    processor_class = getattr(processor, processor_name)
+    if profiled:
+      from profiler import OpcodeProfile, ProfilingProcessorFactory
+      processor_class = ProfilingProcessorFactory(OpcodeProfile(), processor_class)
+    data = packs_data()
+    chunks = recvs(data * 8, size)
+
+    def run():
+      client_app, client_proxy = socket.socketpair()
+      server_proxy, server_app = socket.socketpair()
+      client_app.setblocking(0)
+      server_app.setblocking(0)
+      map = {}
+      swapper = SwapHandler(client_proxy, '127.0.0.1', 1, processor_class, map, server_proxy)
+
+      received = 0
+      total = sum(len(chunk) for chunk in chunks)
+      pending = iter(chunks)
+      chunk = next(pending, None)
+      while received < total:
+        while chunk is not None:
+          try:
+            client_app.send(chunk)
+          except socket.error:
+            break
+          chunk = next(pending, None)
+        asyncore.loop(0, True, map, 1)
+        try:
+          while True:
+            received += len(server_app.recv(65536))
+        except socket.error:
+          pass
+
+      swapper.close()
+      client_app.close()
+      server_app.close()
+      return len(chunks), total
+    return run
+  return setup
+
+for size in (1024, 8192):
+  benchmark('swap_handler.data.recv%d' % size)(make_forwarding(size, 'DataProcessor'))
+  benchmark('swap_handler.packet.recv%d' % size)(make_forwarding(size, 'PacketProcessor'))
+  benchmark('swap_handler.profiled.recv%d' % size)(make_forwarding(size, 'PacketProcessor', True))
+  benchmark('swap_handler.profiled_data.recv%d' % size)(make_forwarding(size, 'DataProcessor', True))
+
+def measure(setup, min_time = 0.5, repeat = 3):
+  """
+  Returns the result dict of one benchmark.
+  """
+  run = setup()
+  run()
+
+  gc.collect()
+  objects = len(gc.get_objects())
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  best = None
+  for _ in xrange(repeat):
+    rounds, ops, bytes, start = 0, 0, 0, time.time()
+    while True:
+      round_ops, round_bytes = run()
+      rounds, ops, bytes = rounds + 1, ops + round_ops, bytes + round_bytes
+      elapsed = time.time() - start
+      if elapsed >= min_time:
+        break
+    if best is None or ops / elapsed > best[1] / best[0]:
+      best = (elapsed, ops, bytes, rounds)
+
+  elapsed, ops, bytes, rounds = best
+  del run
+  gc.collect()
+  return {
+    'ops_per_second': ops / elapsed,
+    'mb_per_second': bytes / elapsed / 1e6,
+    'seconds_per_round': elapsed / rounds,
+    'maxrss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    'objects_retained': len(gc.get_objects()) - objects,
+  }
+
+def run_benchmarks(names = None, min_time = 0.5, repeat = 3, out = sys.stderr):
+  results = {}
+  for name, setup in BENCHMARKS:
+    if names and not any(part in name for part in names):
+      continue
+    random.seed(0)
+    results[name] = measure(setup, min_time, repeat)
+    out.write('%-36s %14.0f ops/s %9.2f MB/s\n' % (name, results[name]['ops_per_second'], results[name]['mb_per_second']))
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'time': time.time(),
+    'results': results,
+  }
+
+def compare(current, baseline, threshold = 0.1, out = sys.stderr):
+  """
+  Prints the change in ops/s of every benchmark in both result sets and
+  returns the names of those slower than baseline by more than threshold.
+  """
+  regressions = []
+  for name in sorted(current['results']):
+    if name not in baseline['results']:
+      continue
+    now, before = current['results'][name]['ops_per_second'], baseline['results'][name]['ops_per_second']
+    change = now / before - 1 if before else 0.0
+    flag = ''
+    if change < -threshold:
+      regressions.append(name)
+      flag = ' REGRESSION'
+    out.write('%-36s %+7.1f%%%s\n' % (name, change * 100, flag))
+  return regressions
+
+class benchmark_harness(unittest.TestCase):
+  def test_every_benchmark_runs(self):
+    for name, setup in BENCHMARKS:
+      ops, bytes = setup()()
+      self.assertTrue(ops > 0 and bytes > 0, name)
+
+  def test_compare(self):
+    baseline = {'results': {'a': {'ops_per_second': 100.0}, 'b': {'ops_per_second': 100.0}}}
+    current = {'results': {'a': {'ops_per_second': 85.0}, 'b': {'ops_per_second': 95.0}, 'c': {'ops_per_second': 1.0}}}
+    class Null(object):
+      def write(self, data):
+        pass
+    self.assertEqual(compare(current, baseline, out = Null()), ['a'])
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description = 'Benchmark the framing, parsing and proxying hot paths.')
+  parser.add_argument('names', nargs = '*', help = 'only run benchmarks whose name contains one of these')
+  parser.add_argument('--output', help = 'write the JSON results here instead of stdout')
+  parser.add_argument('--baseline', help = 'JSON results to compare against')
+  parser.add_argument('--threshold', type = float, default = 0.1)
+  parser.add_argument('--fail', action = 'store_true', help = 'exit 1 on regressions')
+  parser.add_argument('--min-time', type = float, default = 0.5)
+  parser.add_argument('--repeat', type = int, default = 3)
+  parser.add_argument('--list', action = 'store_true')
+  options = parser.parse_args()
+
+  if options.list:
+    for name, _ in BENCHMARKS:
+      print name
+    sys.exit(0)
+
+  results = run_benchmarks(options.names, options.min_time, options.repeat)
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(results, f, indent = 2, sort_keys = True)
+  else:
+    print json.dumps(results, indent = 2, sort_keys = True)
+
+  if options.baseline:
+    with open(options.baseline) as f:
+      regressions = compare(results, json.load(f), options.threshold)
+    if regressions and options.fail:
+      sys.exit(1)
@@ -4,17 +4,47 @@
 bot_connector.py
 
 Created by zeebo on 2010-07-29.
+
+connect() logs a bot in with blocking sockets. AsyncLogin walks the same
+handshake on an asyncore map, so many logins can run at once:
+
+  login   sent 0x0064 to the login server, waiting for 0x0069
+  char    sent 0x0065 to the char server, waiting for 0x006B
+  select  sent 0x0066 for the character, waiting for 0x0071
+  ready   result holds the char id, map server and map name
+  failed  error says why
+
+Each stage has its own timeout and its latency is kept in latency. When
+the character's slot is known up front, the select is sent right behind
+the char server login instead of a round trip later.
 """
+import asyncore
+import json
+import os
 import socket
+import struct
+import sys
+import time
+import unittest
 from stream_chunker import PacketChunker
+from framer import PacketFramer
 from itertools import takewhile
 from parsers import *
 
+PORT = struct.Struct('<H')
+ACCOUNT_ID = struct.Struct('<I')
+
 def hex_repr(string):
   return ''.join('%.2X' % ord(c) for c in string)
 
 def fix_addr(ip, port):
   return '.'.join(`ord(x)` for x in ip), ord(port[0]) + 256*ord(port[1])
+
+def server_address(ip, port):
+  """
+  (host, port) of the raw 4 byte ip and 2 byte port of a parsed packet.
+  """
+  return socket.inet_ntoa(ip), PORT.unpack(port)[0]
   
 def grab_name(string):
   return ''.join(takewhile(lambda x: x != '\x00', string))
@@ -27,17 +57,23 @@ def read_to_chunk(socket, chunker, count=1024):
 def connect(server, auth, character_name, char_srv = 0):
   auth_sock = socket.create_connection(server)
   username, password = auth
-  auth_sock.send(
-    '\x64\x00\x18\x00\x00\x00%s%s\x12' % (username.ljust(24, '\x00'), password.ljust(24, '\x00'))
-  )
+  auth_sock.send(login_request_builder({
+    'version': 0x18,
+    'username': username,
+    'password': password,
+    'client_type': 0x12,
+  }))
   chunker = PacketChunker()  
   packet = read_to_chunk(auth_sock, chunker)  
   auth_sock.close()  
   auth_dict = login_response_parser(packet)    
   char_sock = socket.create_connection(fix_addr(auth_dict['servers'][char_srv]['ip'], auth_dict['servers'][char_srv]['port']))
-  char_sock.send(
-    '\x65\x00%s%s%s\x00\x00\x01' % (auth_dict['a_id'], auth_dict['l_id1'], auth_dict['l_id2'])
-  )  
+  char_sock.send(char_connect_builder({
+    'a_id': auth_dict['a_id'],
+    'l_id1': auth_dict['l_id1'],
+    'l_id2': auth_dict['l_id2'],
+    'sex': 1,
+  }))
   chunker.chunk(4)
   read_to_chunk(char_sock, chunker)
   
@@ -50,9 +86,9 @@ def connect(server, auth, character_name, char_srv = 0):
   
   the_char = parsed_dict['characters'][names[character_name]]
   
-  char_sock.send(
-    '\x66\x00%s' % the_char['slot'][0]
-  )
+  char_sock.send(char_select_builder({
+    'slot': the_char['slot'][0],
+  }))
   
   packet = read_to_chunk(char_sock, chunker)
   parsed_dict = map_login_parser(packet)
@@ -65,7 +101,477 @@ def connect(server, auth, character_name, char_srv = 0):
     'map_name': grab_name(parsed_dict['map_name']),
   }
   
+class LoginConnection(asyncore.dispatcher):
+  """
+  Non-blocking connection of an AsyncLogin to one server, with its own
+  framer. The first prefix bytes read are raw (the char server's account
+  id), everything after is framed and passed to login.handle_packet.
+  """
+  recv_size = 65536
+
+  def __init__(self, login, address, map, prefix = 0):
+    asyncore.dispatcher.__init__(self, map = map)
+    self.login = login
+    self.framer = PacketFramer()
+    self.prefix = prefix
+    self.raw = ''
+    self.out = []
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      #the handshake is all small request/response packets
+      self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.connect(address)
+    except socket.error:
+      self.close()
+      raise
+
+  def send_packet(self, packet):
+    self.out.append(str(packet))
+
+  def readable(self):
+    #asked on every pass of the loop, so the login's timeouts need no other driver
+    return not self.login.expired(self)
+
+  def writable(self):
+    return self.connecting or bool(self.out)
+
+  def handle_connect(self):
+    self.login.connected(self)
+
+  def handle_write(self):
+    data = ''.join(self.out)
+    sent = self.send(data)
+    self.out = [data[sent:]] if sent < len(data) else []
+
+  def handle_read(self):
+    data = self.recv(self.recv_size)
+    if len(self.raw) < self.prefix:
+      needed = self.prefix - len(self.raw)
+      self.raw, data = self.raw + data[:needed], data[needed:]
+
+    data, offsets = self.framer.split(data)
+    for opcode, start, end in offsets:
+      if not self.connected:
+        break
+      self.login.handle_packet(self, opcode, data[start:end])
+
+  def handle_close(self):
+    self.close()
+    self.login.connection_closed(self)
+
+  def handle_error(self):
+    self.close()
+    self.login.connection_error(self, 'Connection error: %s' % (asyncore.compact_traceback()[2],))
+
+class LoginCache(object):
+  """
+  What the last login of each account learnt, on disk as JSON: the char
+  servers of its 0x0069 and the slots of its characters. Entries older
+  than ttl seconds are ignored. Passwords and session ids are never
+  stored. Changes are written out by flush().
+
+  Only with trust_slots are cached slots selected before the character
+  list confirms them; a stale one then selects whatever character is in
+  that slot now, and the login fails once the list shows it.
+  """
+  def __init__(self, filename, ttl = 3600.0, trust_slots = False):
+    self.filename, self.ttl = filename, ttl
+    self.trust_slots = trust_slots
+    self.dirty = False
+    self.flushed = 0.0
+    try:
+      with open(filename) as f:
+        self.entries = self.decode(json.load(f))
+    except (IOError, ValueError, TypeError, KeyError, AttributeError):
+      self.entries = {}
+
+  #usernames and names are bytes in the server's own encoding, so they are hex encoded on disk
+  @staticmethod
+  def encode(entries):
+    return dict((key.encode('hex'), {
+      'time': entry['time'],
+      'servers': [[host, port, name.encode('hex')] for host, port, name in entry['servers']],
+      'characters': dict((name.encode('hex'), slot) for name, slot in entry['characters'].items()),
+    }) for key, entry in entries.items())
+
+  @staticmethod
+  def decode(entries):
+    return dict((str(key).decode('hex'), {
+      'time': entry['time'],
+      'servers': [[str(host), port, str(name).decode('hex')] for host, port, name in entry['servers']],
+      'characters': dict((str(name).decode('hex'), slot) for name, slot in entry['characters'].items()),
+    }) for key, entry in entries.items())
+
+  @staticmethod
+  def key(server, username):
+    return '%s:%d/%s' % (server[0], server[1], username)
+
+  def get(self, server, username, now = None):
+    entry = self.entries.get(self.key(server, username))
+    if entry is None or (now or time.time()) - entry['time'] > self.ttl:
+      return None
+    return entry
+
+  def update(self, server, username, servers, characters, now = None):
+    self.entries[self.key(server, username)] = {
+      'time': now or time.time(),
+      'servers': [list(address) for address in servers],
+      'characters': dict(characters),
+    }
+    self.dirty = True
+
+  def invalidate(self, server, username):
+    if self.entries.pop(self.key(server, username), None) is not None:
+      self.dirty = True
+
+  def flush(self, min_interval = 0.0):
+    now = time.time()
+    if not self.dirty or now - self.flushed < min_interval:
+      return
+    with open(self.filename + '.tmp', 'w') as f:
+      json.dump(self.encode(self.entries), f, sort_keys = True)
+    os.rename(self.filename + '.tmp', self.filename)
+    self.dirty, self.flushed = False, now
+
+class AsyncLogin(object):
+  """
+  One login handshake on map. done(login) is called once it is ready or
+  has failed. The stage timeouts are checked by its connections on every
+  pass of the loop running map, so they fire at most that loop's timeout
+  late; check_timeout(now) can be called to check in between.
+
+  A slot given up front is selected without waiting for the character
+  list; if it is wrong, the server selects whatever character is in it
+  and the login fails once the list arrives. With a LoginCache, the
+  cached char server is connected to while the login server is still
+  answering, and a cached slot is used like a given one if the cache
+  trusts its slots. If the server disagrees with the cache the entry is
+  dropped and the login fails with stale set, to be retried without it.
+  """
+  timeouts = {'login': 10.0, 'char': 10.0, 'select': 10.0}
+
+  def __init__(self, server, auth, character_name, map, done, char_srv = 0, slot = None, timeouts = None, cache = None):
+    self.server, self.auth = server, auth
+    self.character_name, self.char_srv = character_name, char_srv
+    self.map, self.done = map, done
+    self.slot = slot
+    self.cache = cache
+    if timeouts is not None:
+      self.timeouts = dict(self.timeouts, **timeouts)
+    self.state = 'new'
+    self.connection = None
+    self.preopened = None
+    self.cached_slot = self.stale = False
+    self.account_id = None
+    self.auth_dict = None
+    self.servers = None
+    self.characters = None
+    self.result = None
+    self.error = None
+    self.started = self.stage_started = None
+    self.latency = {}
+
+    self.expected = {
+      ('login', 0x0069): self.login_accepted,
+      ('login', 0x006A): self.login_refused,
+      ('char', 0x006B): self.char_list,
+      ('char', 0x006C): self.char_refused,
+      ('select', 0x0071): self.map_login,
+      ('select', 0x006C): self.char_refused,
+    }
+
+  def enter(self, state):
+    now = time.time()
+    if self.state in self.timeouts:
+      self.latency[self.state] = now - self.stage_started
+    self.state, self.stage_started = state, now
+
+  def open(self, address, state, packets, prefix = 0, connection = None):
+    self.close()
+    self.enter(state)
+    if connection is None:
+      try:
+        connection = LoginConnection(self, address, self.map, prefix)
+      except socket.error, e:
+        self.fail('Cannot connect to %s:%d: %s' % (address[0], address[1], e))
+        return
+    self.connection = connection
+    for packet in packets:
+      self.connection.send_packet(packet)
+
+  def start(self):
+    self.started = time.time()
+    username, password = self.auth
+    entry = self.cache.get(self.server, username) if self.cache is not None else None
+    if entry is not None:
+      if self.slot is None and self.cache.trust_slots and self.character_name in entry['characters']:
+        self.slot, self.cached_slot = entry['characters'][self.character_name], True
+      if len(entry['servers']) > self.char_srv:
+        host, port = entry['servers'][self.char_srv][:2]
+        try:
+          self.preopened = LoginConnection(self, (host, port), self.map, prefix = 4)
+        except socket.error:
+          self.cache.invalidate(self.server, username)
+
+    self.open(self.server, 'login', [login_request_builder({
+      'version': 0x18,
+      'username': username,
+      'password': password,
+      'client_type': 0x12,
+    })])
+
+  def connected(self, connection):
+    if connection is self.preopened:
+      self.latency['char_connect'] = time.time() - self.started
+    else:
+      self.latency[self.state + '_connect'] = time.time() - self.stage_started
+
+  def handle_packet(self, connection, opcode, packet):
+    handler = self.expected.get((self.state, opcode))
+    if handler is not None and connection is self.connection:
+      handler(packet)
+
+  def login_accepted(self, packet):
+    self.auth_dict = auth_dict = login_response_parser(packet)
+    self.servers = [server_address(server['ip'], server['port']) + (grab_name(server['name']),) for server in auth_dict['servers']]
+    if len(self.servers) <= self.char_srv:
+      return self.fail('No char server %d' % self.char_srv)
+    address = self.servers[self.char_srv][:2]
+
+    preopened, self.preopened = self.preopened, None
+    if preopened is not None and (preopened.addr != address or not (preopened.connected or preopened.connecting)):
+      #the cached char server was not the one the login server sent us to
+      preopened.close()
+      preopened = None
+      self.cache.invalidate(self.server, self.auth[0])
+
+    packets = [char_connect_builder({
+      'a_id': auth_dict['a_id'],
+      'l_id1': auth_dict['l_id1'],
+      'l_id2': auth_dict['l_id2'],
+      'sex': 1,
+    })]
+    if self.slot is not None:
+      packets.append(char_select_builder({'slot': self.slot}))
+    self.open(address, 'char', packets, 4, preopened)
+
+  def login_refused(self, packet):
+    self.fail('Login refused (%d)' % ord(packet[2]))
+
+  def char_refused(self, packet):
+    self.fail('Char server refused (%d)' % ord(packet[2]), self.cached_slot)
+
+  def char_list(self, packet):
+    raw = self.connection.raw
+    self.account_id = ACCOUNT_ID.unpack(raw)[0] if len(raw) == ACCOUNT_ID.size else None
+    parsed_dict = char_response_parser(packet)
+    self.characters = dict((grab_name(char['name']), ord(char['slot'][0])) for char in parsed_dict['characters'])
+    if self.character_name not in self.characters:
+      return self.fail('%s not in character list: %s' % (self.character_name, sorted(self.characters)), self.cached_slot)
+
+    slot = self.characters[self.character_name]
+    if self.slot is not None:
+      if slot != self.slot:
+        return self.fail('%s is in slot %d, not %d' % (self.character_name, slot, self.slot), self.cached_slot)
+      #the select went out with the char server login
+      self.enter('select')
+      return
+    self.enter('select')
+    self.connection.send_packet(char_select_builder({'slot': slot}))
+
+  def map_login(self, packet):
+    parsed_dict = map_login_parser(packet)
+    self.close()
+    self.result = {
+      'char_id': parsed_dict['char_id'],
+      'server': server_address(parsed_dict['ip'], parsed_dict['port']),
+      'map_name': grab_name(parsed_dict['map_name']),
+    }
+    self.enter('ready')
+    self.latency['total'] = self.stage_started - self.started
+    if self.cache is not None:
+      self.cache.update(self.server, self.auth[0], self.servers, self.characters)
+    self.done(self)
+
+  def connection_closed(self, connection):
+    if connection is self.preopened:
+      self.preopened = None
+    elif connection is self.connection and self.state not in ('ready', 'failed'):
+      self.fail('Connection closed while in %s' % self.state)
+
+  def connection_error(self, connection, error):
+    if connection is self.preopened:
+      self.preopened = None
+    elif connection is self.connection:
+      self.fail(error)
+
+  def timed_out(self, now = None):
+    """
+    Returns the timeout of the current stage if it has run out.
+    """
+    timeout = self.timeouts.get(self.state)
+    if timeout is not None and (now or time.time()) - self.stage_started > timeout:
+      return timeout
+    return None
+
+  def check_timeout(self, now = None):
+    timeout = self.timed_out(now)
+    if timeout is not None:
+      self.fail('Timed out in %s after %.1fs' % (self.state, timeout))
+
+  def expired(self, connection):
+    """
+    Called from connection.readable() while the loop lists the sockets to
+    wait on. Returns True, with connection closed, once the login no
+    longer uses it or its stage timed out, failing the login then. No
+    other connection is closed here, as the loop may have listed it
+    already; each one closes itself on its own turn.
+    """
+    if connection is self.preopened:
+      return False
+    if connection is self.connection:
+      if self.timed_out() is None:
+        return False
+      self.preopened = None
+      self.check_timeout()
+    connection.close()
+    return True
+
+  def fail(self, error, stale = False):
+    """
+    Gives up on the login. stale means a cached value was rejected.
+    """
+    if self.state in ('ready', 'failed'):
+      return
+    self.close()
+    if self.preopened is not None:
+      preopened, self.preopened = self.preopened, None
+      preopened.close()
+    self.error = error
+    if stale:
+      self.stale = True
+      self.cache.invalidate(self.server, self.auth[0])
+    self.enter('failed')
+    self.done(self)
+
+  def close(self):
+    if self.connection is not None:
+      connection, self.connection = self.connection, None
+      connection.close()
+
+class async_login(unittest.TestCase):
+  def setUp(self):
+    from fake_login_servers import FakeLoginServers
+    self.map = {}
+    self.servers = FakeLoginServers(self.map)
+    self.finished = []
+
+  def tearDown(self):
+    self.servers.close()
+
+  def login(self, auth = ('bot', 'pass'), name = 'Poopstick', **kwargs):
+    login = AsyncLogin(self.servers.login_server.address, auth, name, self.map, self.finished.append, **kwargs)
+    login.start()
+    end = time.time() + 5
+    while login not in self.finished and time.time() < end:
+      asyncore.loop(0.02, True, self.map, 1)
+    return login
+
+  def test_login(self):
+    login = self.login()
+    self.assertEqual(login.state, 'ready')
+    self.assertEqual(login.result, {'char_id': 'M\x00\x00\x00', 'server': ('127.0.0.1', 5121), 'map_name': 'prontera.gat'})
+    self.assertEqual((login.account_id, login.characters), (42, {'Poopstick': 2}))
+    self.assertEqual(sorted(login.latency), ['char', 'char_connect', 'login', 'login_connect', 'select', 'total'])
+    self.assertEqual(self.finished, [login])
+
+  def test_pipelined_select(self):
+    login = self.login(slot = 2)
+    self.assertEqual(login.state, 'ready')
+    self.assertEqual(self.servers.requests, [0x0064, 0x0065, 0x0066])
+    self.assertTrue(login.latency['select'] < login.latency['char'] + 0.05)
+
+    login = self.login(slot = 1)
+    self.assertEqual(login.error, 'Poopstick is in slot 2, not 1')
+
+  def test_failures(self):
+    self.assertEqual(self.login(('bot', 'bad')).error, 'Login refused (1)')
+    self.assertTrue(self.login(name = 'Nobody').error.startswith('Nobody not in character list'))
+
+  def test_cache(self):
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'logins.json')
+      cache = LoginCache(filename)
+      self.assertEqual(self.login(cache = cache).state, 'ready')
+      cache.flush()
+
+      cache = LoginCache(filename)
+      entry = cache.get(self.servers.login_server.address, 'bot')
+      self.assertEqual(entry['characters'], {'Poopstick': 2})
+      self.assertEqual(entry['servers'][0][:2], list(self.servers.char_server.address))
+      self.assertEqual(cache.get(self.servers.login_server.address, 'bot', time.time() + 7200), None)
+
+      login = self.login(cache = cache)
+      self.assertEqual((login.state, login.slot), ('ready', None))
+      self.assertTrue('char_connect' in login.latency)
+
+      cache.trust_slots = True
+      del self.servers.requests[:]
+      login = self.login(cache = cache)
+      self.assertEqual((login.state, login.slot), ('ready', 2))
+      self.assertEqual(self.servers.requests, [0x0064, 0x0065, 0x0066])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_cache_names(self):
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'logins.json')
+      cache = LoginCache(filename)
+      #latin-1 and EUC-KR names, neither valid UTF-8
+      cache.update(('127.0.0.1', 6900), 'b\xf6t', [('127.0.0.1', 6121, '\xc5\xd7\xbd\xba\xc6\xae')], {'Caf\xe9': 1})
+      cache.flush()
+      entry = LoginCache(filename).get(('127.0.0.1', 6900), 'b\xf6t')
+      self.assertEqual(entry['servers'], [['127.0.0.1', 6121, '\xc5\xd7\xbd\xba\xc6\xae']])
+      self.assertEqual(entry['characters'], {'Caf\xe9': 1})
+    finally:
+      shutil.rmtree(directory)
+
+  def test_stale_cache(self):
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    try:
+      address = self.servers.login_server.address
+      cache = LoginCache(os.path.join(directory, 'logins.json'), trust_slots = True)
+      cache.update(address, 'bot', [('127.0.0.1', 1, 'gone')], {'Poopstick': 1})
+      login = self.login(cache = cache)
+      self.assertEqual((login.state, login.stale), ('failed', True))
+      self.assertEqual(cache.get(address, 'bot'), None)
+      self.assertEqual(self.login(cache = cache).state, 'ready')
+
+      #an untrusted slot is never sent, so only the char server was stale
+      cache.trust_slots = False
+      cache.update(address, 'bot', [('127.0.0.1', 1, 'gone')], {'Poopstick': 1})
+      login = self.login(cache = cache)
+      self.assertEqual((login.state, login.stale), ('ready', False))
+      self.assertEqual(cache.get(address, 'bot')['characters'], {'Poopstick': 2})
+    finally:
+      shutil.rmtree(directory)
+
+  def test_stage_timeout(self):
+    #driven by asyncore.loop alone
+    self.servers.silent = ('char',)
+    login = self.login(timeouts = {'char': 0.1})
+    self.assertEqual(login.error, 'Timed out in char after 0.1s')
+    self.assertTrue('login' in login.latency)
+    self.assertFalse(any(isinstance(channel, LoginConnection) for channel in self.map.values()))
+
 if __name__ == '__main__':  
+  if sys.argv[1:] == ['test']:
+    unittest.main(argv = sys.argv[:1])
   data = connect(('192.168.1.5', 6900), ('Test', 'Test'), 'Poopstick')
   
   print data
\ No newline at end of file
@@ -1,25 +1,273 @@
-bytes = []
-with open('testpacks.packs') as f:
-  temp_datas = []
-  for line in f:
-    if line.strip() == '' and len(temp_datas):
-      bytes.extend(temp_datas[54:])
-      temp_datas = []
-    else:
-      temp_datas.extend(line.strip().split())
-
-#ok listen, accept, print data, close.
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bot_server_tester.py
 
+Replay server standing in for the game server in load tests.
+
+The server side of a capture (a .packs dump or a capture.py file) is
+decoded into one string once and served from memoryview slices to every
+client that connects, with a choice of pacing:
+
+  asap        as fast as the client reads
+  rate        a fixed number of bytes per second per client
+  timestamps  the capture's own timing, scaled by speed
+
+The drain command is the matching client: it opens many connections
+(e.g. through server.py) and reads everything sent. Both report the
+throughput they achieve every few seconds.
+
+  python bot_server_tester.py serve testpacks.packs --port 50001 --pacing rate --rate 100000
+  python bot_server_tester.py drain 127.0.0.1:50001 --clients 200
+"""
+
+import asyncore
 import socket
-import SocketServer
+import sys
+import time
+import unittest
+from bisect import bisect_right
+from server import ProxyLoop
+
+def load_replay(filename, direction = 'server'):
+  """
+  Returns (data, times, ends) for the packets sent by direction in a
+  capture: all the bytes joined, and for every packet its time relative
+  to the first one and the offset in data where it ends.
+  """
+  payloads, times = [], []
+  if filename.endswith('.packs'):
+    from packs import iter_segments
+    for segment in iter_segments(filename):
+      if (segment.sport < segment.dport) == (direction == 'server'):
+        payloads.append(segment.payload)
+        times.append(0.0)
+  else:
+    from capture import CaptureReader
+    reader = CaptureReader(filename)
+    for packet in reader:
+      if packet.direction == direction:
+        payloads.append(packet.payload)
+        times.append(packet.timestamp)
+    reader.close()
+
+  ends, end = [], 0
+  for payload in payloads:
+    end += len(payload)
+    ends.append(end)
+  start = times[0] if times else 0.0
+  return ''.join(payloads), [t - start for t in times], ends
+
+class Pacing(object):
+  """
+  How much of the replay a client may have been sent after elapsed
+  seconds.
+  """
+  def __init__(self, mode = 'asap', rate = None, speed = 1.0):
+    if mode not in ('asap', 'rate', 'timestamps'):
+      raise ValueError('Unknown pacing: %s' % mode)
+    if mode == 'rate' and not rate:
+      raise ValueError('Rate pacing needs a rate')
+    self.mode, self.rate, self.speed = mode, rate, speed
+
+  def allowed(self, elapsed, size, times, ends):
+    if self.mode == 'asap':
+      return size
+    if self.mode == 'rate':
+      return min(size, int(elapsed * self.rate))
+    sent = bisect_right(times, elapsed * self.speed)
+    return ends[sent-1] if sent else 0
+
+class Throughput(object):
+  def __init__(self, name):
+    self.name = name
+    self.started = self.last = time.time()
+    self.bytes = self.last_bytes = 0
+    self.clients = self.finished = 0
+
+  def report(self):
+    now = time.time()
+    print "%s: %d clients (%d finished), %.2f MB/s now, %.2f MB/s overall, %d bytes" % (
+      self.name, self.clients, self.finished,
+      (self.bytes - self.last_bytes) / max(now - self.last, 1e-6) / 1e6,
+      self.bytes / max(now - self.started, 1e-6) / 1e6, self.bytes,
+    )
+    self.last, self.last_bytes = now, self.bytes
+
+class ReplayHandler(asyncore.dispatcher):
+  """
+  Sends the replay to one client, repeats times over, then closes.
+  Anything the client sends is read and dropped.
+  """
+  send_size = 65536
+
+  def __init__(self, sock, server):
+    asyncore.dispatcher.__init__(self, sock, map = server.map)
+    self.server = server
+    self.view = memoryview(server.data)
+    self.started = time.time()
+    self.pos = 0
+    self.rounds = 0
+
+  def allowed(self):
+    server = self.server
+    return server.pacing.allowed(time.time() - self.started, len(server.data), server.times, server.ends)
+
+  def writable(self):
+    return self.pos < self.allowed()
+
+  def readable(self):
+    return True
+
+  def handle_read(self):
+    self.recv(65536)
+
+  def handle_write(self):
+    allowed = self.allowed()
+    sent = self.send(self.view[self.pos:min(allowed, self.pos + self.send_size)])
+    self.pos += sent
+    self.server.stats.bytes += sent
+
+    if self.pos >= len(self.view):
+      self.rounds += 1
+      if self.rounds < self.server.repeat:
+        self.pos, self.started = 0, time.time()
+      else:
+        self.server.stats.finished += 1
+        self.close()
+
+  def handle_close(self):
+    self.close()
+
+class ReplayServer(asyncore.dispatcher):
+  def __init__(self, data, times, ends, port, loop, pacing = None, repeat = 1, host = ''):
+    asyncore.dispatcher.__init__(self, map = loop.map)
+    self.data, self.times, self.ends = data, times, ends
+    self.map = loop.map
+    self.pacing = pacing or Pacing()
+    self.repeat = repeat
+    self.stats = Throughput('replay')
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(1024)
+    self.server_address = self.socket.getsockname()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+    self.stats.clients += 1
+    ReplayHandler(pair[0], self)
+
+  def shutdown(self):
+    self.close()
+
+class DrainClient(asyncore.dispatcher):
+  """
+  Connects to address and reads until the other end closes.
+  """
+  def __init__(self, address, loop, stats):
+    asyncore.dispatcher.__init__(self, map = loop.map)
+    self.stats = stats
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.connect(address)
+
+  def handle_connect(self):
+    self.stats.clients += 1
+
+  def writable(self):
+    return self.connecting
+
+  def handle_read(self):
+    self.stats.bytes += len(self.recv(65536))
+
+  def handle_close(self):
+    self.stats.finished += 1
+    self.close()
+
+def serve(options):
+  data, times, ends = load_replay(options.capture, options.direction)
+  print "Replaying %d bytes in %d packets from %s" % (len(data), len(ends), options.capture)
+
+  pacing = Pacing(options.pacing, options.rate, options.speed)
+  loop = ProxyLoop(0.01 if pacing.mode != 'asap' else 1.0)
+  server = ReplayServer(data, times, ends, options.port, loop, pacing, options.repeat)
+  loop.every(options.interval, server.stats.report)
+  print "Serving on port [%d]." % server.server_address[1]
+  try:
+    loop.run()
+  except KeyboardInterrupt:
+    server.stats.report()
+
+def drain(options):
+  host, port = options.address.rsplit(':', 1)
+  loop, stats = ProxyLoop(), Throughput('drain')
+  for _ in xrange(options.clients):
+    DrainClient((host, int(port)), loop, stats)
+  loop.every(options.interval, stats.report)
+  try:
+    loop.run()
+  except KeyboardInterrupt:
+    pass
+  stats.report()
+
+class replay(unittest.TestCase):
+  def test_pacing(self):
+    times, ends = [0.0, 1.0, 2.0], [10, 20, 30]
+    self.assertEqual(Pacing().allowed(0.0, 30, times, ends), 30)
+    self.assertEqual(Pacing('rate', 10).allowed(1.5, 30, times, ends), 15)
+    self.assertEqual(Pacing('rate', 10).allowed(5.0, 30, times, ends), 30)
+    self.assertEqual(Pacing('timestamps').allowed(1.5, 30, times, ends), 20)
+    self.assertEqual(Pacing('timestamps', speed = 2.0).allowed(1.0, 30, times, ends), 30)
+    self.assertRaises(ValueError, Pacing, 'rate')
+
+  def test_load_packs(self):
+    data, times, ends = load_replay('testpacks.packs')
+    from packs import read_payload
+    self.assertEqual(data, read_payload('testpacks.packs'))
+    self.assertEqual(ends[-1], len(data))
+
+  def test_fan_out(self):
+    loop = ProxyLoop(0.05)
+    server = ReplayServer('x' * 100000, [0.0], [100000], 0, loop, repeat = 2, host = '127.0.0.1')
+    stats = Throughput('drain')
+    for _ in xrange(5):
+      DrainClient(server.server_address, loop, stats)
+
+    end = time.time() + 5
+    while stats.finished < 5 and time.time() < end:
+      asyncore.loop(0.05, True, loop.map, 1)
+    self.assertEqual(stats.bytes, 5 * 2 * 100000)
+    self.assertEqual(server.stats.finished, 5)
+    server.close()
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description = 'Replay captured game server traffic.')
+  commands = parser.add_subparsers(dest = 'command')
+
+  serve_parser = commands.add_parser('serve')
+  serve_parser.add_argument('capture')
+  serve_parser.add_argument('--port', type = int, default = 50001)
+  serve_parser.add_argument('--direction', default = 'server', choices = ('server', 'client'))
+  serve_parser.add_argument('--pacing', default = 'asap', choices = ('asap', 'rate', 'timestamps'))
+  serve_parser.add_argument('--rate', type = float, help = 'bytes per second per client')
+  serve_parser.add_argument('--speed', type = float, default = 1.0)
+  serve_parser.add_argument('--repeat', type = int, default = 1)
+  serve_parser.add_argument('--interval', type = float, default = 5.0)
 
-class RequestHandler(SocketServer.BaseRequestHandler):
-  def handle(self):
-    print 'Connected by', self.request.getsockname()
-    for byte in bytes:
-      self.request.send(chr(int(byte, 16)))
-    self.request.close()
+  drain_parser = commands.add_parser('drain')
+  drain_parser.add_argument('address')
+  drain_parser.add_argument('--clients', type = int, default = 100)
+  drain_parser.add_argument('--interval', type = float, default = 5.0)
 
-server = SocketServer.TCPServer(('', 50001), RequestHandler)
-server.serve_forever()
+  commands.add_parser('test')
 
+  options = parser.parse_args()
+  if options.command == 'serve':
+    serve(options)
+  elif options.command == 'drain':
+    drain(options)
+  else:
+    unittest.main(argv = sys.argv[:1])
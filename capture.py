@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+capture.py
+
+Binary packet captures.
+
+A capture file is a magic string followed by one record per packet: a
+RECORD header (payload length, timestamp, session, direction, opcode)
+and the raw packet, header bytes included. The sidecar .idx file holds
+an INDEX entry (record offset, opcode) per packet, so the Nth packet is
+one lookup away. CaptureReader memory-maps both, so only the packets
+asked for are ever read, and rebuilds the index by scanning the capture
+when it is missing or behind.
+"""
+
+import mmap
+import os
+import struct
+import time
+import unittest
+from array import array
+from itertools import count
+from framer import PacketFramer
+from packet import as_string, make_record_type
+from processor import DataProcessor
+
+MAGIC = 'ROCAP1\n\x00'
+INDEX_MAGIC = 'ROIDX1\n\x00'
+RECORD = struct.Struct('<IdIBH')
+INDEX = struct.Struct('<QH')
+
+DIRECTIONS = {'client': 0, 'server': 1}
+SIDES = dict((direction, sid) for sid, direction in DIRECTIONS.items())
+
+CapturedPacket = make_record_type('CapturedPacket', ('index', 'timestamp', 'session', 'direction', 'opcode', 'payload'))
+
+class CaptureWriter(object):
+  """
+  Appends packets to a new capture file and its index.
+  """
+  def __init__(self, filename, buffering = 1 << 20):
+    self.filename = filename
+    self.file = open(filename, 'wb', buffering)
+    self.index = open(filename + '.idx', 'wb', buffering)
+    self.file.write(MAGIC)
+    self.index.write(INDEX_MAGIC)
+    self.offset = len(MAGIC)
+    self.count = 0
+
+  def write(self, session, direction, payload, timestamp = None, opcode = None):
+    """
+    Writes one packet. direction is 'client' or 'server', the side the
+    packet came from. The opcode is read from the payload if not given.
+    """
+    payload = as_string(payload)
+    if opcode is None:
+      opcode = ord(payload[0]) | ord(payload[1]) << 8
+    if timestamp is None:
+      timestamp = time.time()
+
+    self.file.write(RECORD.pack(len(payload), timestamp, session, DIRECTIONS[direction], opcode))
+    self.file.write(payload)
+    self.index.write(INDEX.pack(self.offset, opcode))
+    self.offset += RECORD.size + len(payload)
+    self.count += 1
+
+  def flush(self):
+    #the index is flushed last so it never points past the capture
+    self.file.flush()
+    self.index.flush()
+
+  def close(self):
+    self.flush()
+    self.file.close()
+    self.index.close()
+
+def scan_records(data, offset = len(MAGIC)):
+  """
+  Generator of the (offset, opcode) of every complete record in a mapped
+  capture, starting at offset.
+  """
+  end = len(data)
+  unpack_from = RECORD.unpack_from
+  while end - offset >= RECORD.size:
+    length, _, _, _, opcode = unpack_from(data, offset)
+    if end - offset - RECORD.size < length:
+      break
+    yield offset, opcode
+    offset += RECORD.size + length
+
+def build_index(data):
+  """
+  Returns the index of a mapped capture as a string.
+  """
+  pack = INDEX.pack
+  return INDEX_MAGIC + ''.join(pack(offset, opcode) for offset, opcode in scan_records(data))
+
+class CaptureReader(object):
+  """
+  Random access to a capture file.
+
+  reader[n] returns the Nth packet as a CapturedPacket, by_opcode(opcode)
+  the packets of one opcode in order. The first by_opcode call reads the
+  whole index once to group it by opcode.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.file = open(filename, 'rb')
+    self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+    if self.data[:len(MAGIC)] != MAGIC:
+      self.close()
+      raise ValueError('Not a capture file: %s' % filename)
+
+    self.index_file = None
+    self.index = self.load_index()
+    self.count = (len(self.index) - len(INDEX_MAGIC)) // INDEX.size
+    self.opcodes = None
+
+  def load_index(self):
+    """
+    Maps the sidecar index if it covers the whole capture. Otherwise the
+    index is rebuilt in memory, and saved if there was none, as a stale
+    one may still be being written to.
+    """
+    filename = self.filename + '.idx'
+    index_file = index = None
+    try:
+      index_file = open(filename, 'rb')
+      index = mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, mmap.error):
+      pass
+
+    if index is not None and self.index_covers(index):
+      self.index_file = index_file
+      return index
+    missing = index_file is None
+    if not missing:
+      if index is not None:
+        index.close()
+      index_file.close()
+
+    index = build_index(self.data)
+    if missing:
+      try:
+        with open(filename, 'wb') as f:
+          f.write(index)
+      except IOError:
+        pass
+    return index
+
+  def index_covers(self, index):
+    if index[:len(INDEX_MAGIC)] != INDEX_MAGIC or (len(index) - len(INDEX_MAGIC)) % INDEX.size:
+      return False
+
+    if len(index) == len(INDEX_MAGIC):
+      end = len(MAGIC)
+    else:
+      last = INDEX.unpack_from(index, len(index) - INDEX.size)[0]
+      if last + RECORD.size > len(self.data):
+        return False
+      end = last + RECORD.size + RECORD.unpack_from(self.data, last)[0]
+
+    #the last indexed record is whole and no whole record follows it
+    return end <= len(self.data) and next(scan_records(self.data, end), None) is None
+
+  def __len__(self):
+    return self.count
+
+  def offset(self, n):
+    return INDEX.unpack_from(self.index, len(INDEX_MAGIC) + n * INDEX.size)[0]
+
+  def read(self, n, offset):
+    length, timestamp, session, direction, opcode = RECORD.unpack_from(self.data, offset)
+    start = offset + RECORD.size
+    return tuple.__new__(CapturedPacket, (n, timestamp, session, SIDES[direction], opcode, self.data[start:start+length]))
+
+  def __getitem__(self, n):
+    if n < 0:
+      n += self.count
+    if not 0 <= n < self.count:
+      raise IndexError('Packet %d out of range' % n)
+    return self.read(n, self.offset(n))
+
+  def __iter__(self):
+    for n, (offset, _) in enumerate(scan_records(self.data)):
+      if n >= self.count:
+        break
+      yield self.read(n, offset)
+
+  def by_opcode(self, opcode):
+    if self.opcodes is None:
+      self.opcodes = {}
+      unpack_from, start = INDEX.unpack_from, len(INDEX_MAGIC)
+      for n in xrange(self.count):
+        packet_opcode = unpack_from(self.index, start + n * INDEX.size)[1]
+        if packet_opcode not in self.opcodes:
+          self.opcodes[packet_opcode] = array('l')
+        self.opcodes[packet_opcode].append(n)
+
+    for n in self.opcodes.get(opcode, ()):
+      yield self[n]
+
+  def opcode_counts(self):
+    if self.opcodes is None:
+      for _ in self.by_opcode(None):
+        pass
+    return dict((opcode, len(packets)) for opcode, packets in self.opcodes.items())
+
+  def close(self):
+    self.data.close()
+    self.file.close()
+    if self.index_file is not None:
+      self.index.close()
+      self.index_file.close()
+
+def CaptureProcessorFactory(writer, processor = DataProcessor):
+  """
+  Makes a processor class that frames both directions of every session
+  into writer and otherwise behaves as processor. Each session gets its
+  own number in the capture. The writer has to be flushed periodically,
+  e.g. with ProxyLoop.every.
+  """
+  sessions = count(1)
+
+  class CaptureProcessor(processor):
+    def __init__(self):
+      processor.__init__(self)
+      self.session = sessions.next()
+      self.capture_framers = {'client': PacketFramer(), 'server': PacketFramer()}
+
+    def read_event(self, sid, data):
+      framed, offsets = self.capture_framers[sid].split(data)
+      now = time.time()
+      for opcode, start, end in offsets:
+        writer.write(self.session, sid, framed[start:end], now, opcode)
+      processor.read_event(self, sid, data)
+
+  return CaptureProcessor
+
+class capture_file(unittest.TestCase):
+  packets = [
+    ('client', '\x66\x00\x01'),
+    ('server', '\x8e\x00\x0c\x00Warped.\x00'),
+    ('client', '\x66\x00\x02'),
+  ]
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'test.cap')
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  def write(self):
+    writer = CaptureWriter(self.filename)
+    for n, (sid, payload) in enumerate(self.packets):
+      writer.write(7, sid, payload, 1000.0 + n)
+    writer.close()
+
+  def test_round_trip(self):
+    self.write()
+    reader = CaptureReader(self.filename)
+    self.assertEqual(len(reader), 3)
+    self.assertEqual(reader[1], (1, 1001.0, 7, 'server', 0x008E, '\x8e\x00\x0c\x00Warped.\x00'))
+    self.assertEqual(reader[-1].payload, '\x66\x00\x02')
+    self.assertEqual([(packet.direction, packet.payload) for packet in reader], self.packets)
+    self.assertRaises(IndexError, lambda: reader[3])
+    reader.close()
+
+  def test_by_opcode(self):
+    self.write()
+    reader = CaptureReader(self.filename)
+    self.assertEqual([packet.index for packet in reader.by_opcode(0x0066)], [0, 2])
+    self.assertEqual(list(reader.by_opcode(0x0069)), [])
+    self.assertEqual(reader.opcode_counts(), {0x0066: 2, 0x008E: 1})
+    reader.close()
+
+  def test_rebuilds_index(self):
+    self.write()
+    os.remove(self.filename + '.idx')
+    reader = CaptureReader(self.filename)
+    self.assertEqual(reader[2].payload, '\x66\x00\x02')
+    reader.close()
+    self.assertTrue(os.path.exists(self.filename + '.idx'))
+
+  def test_truncated(self):
+    self.write()
+    with open(self.filename, 'ab') as f:
+      f.write(RECORD.pack(100, 0, 0, 0, 0x0066) + 'x')
+    reader = CaptureReader(self.filename)
+    self.assertEqual(len(reader), 3)
+    reader.close()
+
+  def test_stale_index(self):
+    self.write()
+    with open(self.filename, 'ab') as f:
+      f.write(RECORD.pack(3, 0, 0, 0, 0x0066) + '\x66\x00\x03')
+    reader = CaptureReader(self.filename)
+    self.assertEqual(len(reader), 4)
+    self.assertEqual(reader[3].payload, '\x66\x00\x03')
+    reader.close()
+
+  def test_processor(self):
+    writer = CaptureWriter(self.filename)
+    processor = CaptureProcessorFactory(writer)()
+    processor.read_event('client', '\x66\x00\x01\x8e\x00')
+    processor.read_event('server', '\x66\x00\x02')
+    processor.read_event('client', '\x0c\x00Warped.\x00')
+    writer.close()
+    self.assertEqual(len(processor.buffers['server']), 15)
+
+    reader = CaptureReader(self.filename)
+    self.assertEqual([(packet.session, packet.direction, packet.opcode) for packet in reader], [
+      (processor.session, 'client', 0x0066),
+      (processor.session, 'server', 0x0066),
+      (processor.session, 'client', 0x008E),
+    ])
+    reader.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,120 @@
+import binascii
+import sys
+import time
+import unittest
+from itertools import izip
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def bit_layout(lengths, memo = {}):
+  """
+  Returns (total bits, ((shift, mask), ...)) for a tuple of bitfield
+  lengths, read most significant bit first.
+  """
+  lengths = tuple(lengths)
+  if lengths not in memo:
+    total, fields = sum(lengths), []
+    shift = total
+    for l in lengths:
+      shift -= l
+      fields.append((shift, (1 << l) - 1))
+    memo[lengths] = (total, tuple(fields))
+  return memo[lengths]
+
+def make_unpacker(lengths):
+  """
+  Returns a function unpacking a byte string into the bitfields in
+  lengths, with the shifts and masks precomputed.
+  """
+  total, fields = bit_layout(lengths)
+  hexlify = binascii.hexlify
+
+  def unpacker(data):
+    if len(data) * 8 != total:
+      raise ValueError('Lengths dont sum to binary data (%d != %d)' % (total, len(data) * 8))
+    value = int(hexlify(data), 16) if data else 0
+    return [(value >> shift) & mask for shift, mask in fields]
+
+  return unpacker
+
+def make_packer(lengths):
+  """
+  Returns a function packing values into a byte string of the bitfields
+  in lengths. The lengths must sum to a whole number of bytes.
+  """
+  total, fields = bit_layout(lengths)
+  if total % 8:
+    raise ValueError('Lengths dont sum to whole bytes (%d)' % total)
+  digits = total // 4
+  unhexlify = binascii.unhexlify
+
+  def packer(values):
+    value = 0
+    for v, (shift, mask) in izip(values, fields):
+      if v & ~mask:
+        raise ValueError('Value %d does not fit in %d bits' % (v, mask.bit_length()))
+      value |= v << shift
+    return unhexlify('%0*x' % (digits, value))
+
+  return packer
+
+def unpack_bytes(data, lengths, memo = {}):
+  lengths = tuple(lengths)
+  if lengths not in memo:
+    memo[lengths] = make_unpacker(lengths)
+  return memo[lengths](data)
+
+def pack_bytes(values, lengths, memo = {}):
+  lengths = tuple(lengths)
+  if lengths not in memo:
+    memo[lengths] = make_packer(lengths)
+  return memo[lengths](values)
+
 def unpack(hex_data, lengths):
-  import binascii
+  return unpack_bytes(binascii.unhexlify(hex_data), tuple(lengths))
+
+def pack(values, lengths):
+  total, fields = bit_layout(lengths)
+  value = 0
+  for v, (shift, mask) in izip(values, fields):
+    if v & ~mask:
+      raise ValueError('Value %d does not fit in %d bits' % (v, mask.bit_length()))
+    value |= v << shift
+  return '%0*x' % (total // 4, value)
+
+def unpack_array(data, lengths):
+  """
+  Unpacks a buffer of back to back packed values (e.g. the 5 byte
+  positions of many unit move packets) into an (n, len(lengths)) uint64
+  array in one vectorized pass. Needs numpy and at most 64 bits per value.
+  """
+  if numpy is None:
+    raise ImportError('unpack_array needs numpy')
+
+  total, fields = bit_layout(lengths)
+  if total % 8 or total > 64:
+    raise ValueError('Lengths must sum to a whole number of bytes up to 64 bits (%d)' % total)
+
+  width = total // 8
+  raw = numpy.frombuffer(data, dtype = numpy.uint8)
+  if len(raw) % width:
+    raise ValueError('Data is not a whole number of %d byte values (%d bytes)' % (width, len(raw)))
+  raw = raw.reshape(-1, width).astype(numpy.uint64)
+
+  value = numpy.zeros(len(raw), dtype = numpy.uint64)
+  eight = numpy.uint64(8)
+  for column in xrange(width):
+    value = (value << eight) | raw[:, column]
+
+  unpacked = numpy.empty((len(raw), len(fields)), dtype = numpy.uint64)
+  for column, (shift, mask) in enumerate(fields):
+    unpacked[:, column] = (value >> numpy.uint64(shift)) & numpy.uint64(mask)
+  return unpacked
+
+def reference_unpack(hex_data, lengths):
   data = binascii.unhexlify(hex_data)
   binary = ''.join(bin(ord(c))[2:].zfill(8) for c in data)
   if sum(lengths) != len(binary):
@@ -11,22 +126,74 @@ def unpack(hex_data, lengths):
     counter += l
   return unpacked
 
-def pack(values, lengths):
+def reference_pack(values, lengths):
   bins = []
   for i, v in enumerate(values):
     bins.append(bin(v)[2:].zfill(lengths[i]))
   return ("%x" % int(''.join(bins), 2)).zfill(sum(lengths) / 4)
 
-def test():
-  import binascii, random
-  for _ in xrange(100000):
-    h = ''.join(random.choice("0123456789abcdef") for _ in xrange(10))
-    vals = unpack(h, (10,10,10,10))
-    ret = pack(vals, (10,10,10,10))
-    if h != ret:
+def test(samples = 100000):
+  import random
+  lengths = (10, 10, 10, 10)
+  hexes = [''.join(random.choice("0123456789abcdef") for _ in xrange(10)) for _ in xrange(samples)]
+
+  def round_trip(unpack, pack):
+    start = time.time()
+    for h in hexes:
+      if pack(unpack(h, lengths), lengths) != h:
+        return None
+    return time.time() - start
+
+  reference = round_trip(reference_unpack, reference_pack)
+  current = round_trip(unpack, pack)
+  if reference is None or current is None:
+    return False
+
+  print "string round trip: %.3fs, shift/mask round trip: %.3fs (%.1fx)" % (reference, current, reference / current)
+
+  raw = binascii.unhexlify(''.join(hexes))
+  unpacker = make_unpacker(lengths)
+  start = time.time()
+  unpacked = [unpacker(raw[i:i+5]) for i in xrange(0, len(raw), 5)]
+  print "bytes unpack: %.3fs" % (time.time() - start)
+
+  if numpy is not None:
+    start = time.time()
+    batch = unpack_array(raw, lengths)
+    print "numpy batch unpack: %.3fs" % (time.time() - start)
+    if batch.tolist() != unpacked:
       return False
+
   return True
 
+class bitfields(unittest.TestCase):
+  lengths = (10, 10, 10, 10)
+
+  def test_round_trip(self):
+    values = [1023, 0, 512, 7]
+    self.assertEqual(unpack(pack(values, self.lengths), self.lengths), values)
+    self.assertEqual(unpack_bytes(pack_bytes(values, self.lengths), self.lengths), values)
+    self.assertEqual(pack(values, self.lengths), reference_pack(values, self.lengths))
+
+  def test_overflow(self):
+    for packer in (pack, pack_bytes, lambda values, lengths: make_packer(lengths)(values)):
+      self.assertRaises(ValueError, packer, [1024, 0, 0, 0], self.lengths)
+      self.assertRaises(ValueError, packer, [0, 0, 0, -1], self.lengths)
+
+  def test_list_lengths(self):
+    lengths = list(self.lengths)
+    self.assertEqual(unpack_bytes(pack_bytes([1, 2, 3, 4], lengths), lengths), [1, 2, 3, 4])
+
+  @unittest.skipIf(numpy is None, 'needs numpy')
+  def test_unpack_array(self):
+    rows = [[1023, 0, 512, 7], [1, 2, 3, 4], [0, 0, 0, 0]]
+    data = ''.join(pack_bytes(row, self.lengths) for row in rows)
+    self.assertEqual(unpack_array(data, self.lengths).tolist(), rows)
+    self.assertRaises(ValueError, unpack_array, data[:-1], self.lengths)
+    self.assertRaises(ValueError, unpack_array, data, (10, 10, 10, 9))
+
 if __name__ == "__main__":
+  if sys.argv[1:] == ['test']:
+    unittest.main(argv = sys.argv[:1])
   if test():
-    print "Yay it works"
\ No newline at end of file
+    print "Yay it works"
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fake_login_servers.py
+
+Login and char servers on an asyncore map, for the tests of bot_connector
+and manager.
+"""
+
+import asyncore
+import socket
+from bot_connector import ACCOUNT_ID
+from framer import PacketFramer
+from packet import make_packet_builder
+from parsers import char_response_parser, login_response_parser, map_login_parser
+
+class FakeServer(asyncore.dispatcher):
+  """
+  Listening socket on a map, answering each framed request of a client
+  with respond(handler, opcode, packet).
+  """
+  def __init__(self, map, respond, greeting = ''):
+    asyncore.dispatcher.__init__(self, map = map)
+    self.map, self.respond, self.greeting = map, respond, greeting
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.bind(('127.0.0.1', 0))
+    self.listen(128)
+    self.address = self.socket.getsockname()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+    handler = asyncore.dispatcher_with_send(pair[0], map = self.map)
+    handler.framer = PacketFramer()
+    if self.greeting:
+      handler.send(self.greeting)
+
+    def handle_read():
+      data, offsets = handler.framer.split(handler.recv(4096))
+      for opcode, start, end in offsets:
+        self.respond(handler, opcode, data[start:end])
+    handler.handle_read = handle_read
+
+class FakeLoginServers(object):
+  """
+  Login and char servers on a map for tests. Every account logs in
+  unless its password is 'bad' and has the one character Poopstick in
+  slot 2. Stages in silent are never answered.
+  """
+  def __init__(self, map, silent = ()):
+    self.map, self.silent = map, silent
+    self.requests = []
+    self.login_response = make_packet_builder('\x69\x00', login_response_parser.layout.data_spec)
+    self.char_response = make_packet_builder('\x6b\x00', char_response_parser.layout.data_spec)
+    self.map_response = make_packet_builder('\x71\x00', map_login_parser.layout.data_spec)
+    self.char_server = FakeServer(map, self.char_respond, ACCOUNT_ID.pack(42))
+    self.login_server = FakeServer(map, self.login_respond)
+
+  def login_respond(self, handler, opcode, packet):
+    self.requests.append(opcode)
+    if 'login' in self.silent:
+      return
+    if packet[30:34] == 'bad\x00':
+      handler.send('\x6a\x00\x01' + '\x00' * 20)
+      return
+    ip, port = self.char_server.address
+    handler.send(str(self.login_response({
+      'l_id1': 1, 'a_id': 42, 'l_id2': 2, 'sex': 1,
+      'servers': [{'ip': socket.inet_aton(ip), 'port': port, 'name': 'test', 'users': 0}],
+    })))
+
+  def char_respond(self, handler, opcode, packet):
+    self.requests.append(opcode)
+    if opcode == 0x0065 and 'char' not in self.silent:
+      character = dict((name, 0) for name in char_response_parser.layout.repeat_names)
+      character.update({'name': 'Poopstick', 'slot': 2, 'char_id': 77})
+      handler.send(str(self.char_response({'slots_1': 0, 'slots_2': 0, 'slots_3': 0, 'characters': [character]})))
+    elif opcode == 0x0066 and 'select' not in self.silent:
+      handler.send(str(self.map_response({'char_id': 77, 'map_name': 'prontera.gat', 'ip': '\x7f\x00\x00\x01', 'port': 5121})))
+
+  def close(self):
+    for channel in self.map.values():
+      channel.close()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+framer.py
+
+Table driven packet framing.
+
+packets.txt is loaded once into a 65536 entry array of packet lengths
+indexed by the little endian opcode, so finding the length of a packet
+is a single array lookup. PacketFramer frames as many packets as it can
+out of each recv in one pass and hands them out as (opcode, memoryview)
+tuples that share the recv's memory instead of copying it.
+"""
+
+import struct
+import sys
+import time
+import unittest
+from array import array
+
+UNKNOWN = 0
+VARIABLE = -1
+
+def load_packet_table(packet_file = 'packets.txt', memo_dict = {}):
+  """
+  Returns an array of packet lengths indexed by opcode. Fixed size packets
+  have their length, variable packets have VARIABLE and anything not in
+  the file has UNKNOWN. Later lines override earlier ones, as in
+  PacketChunker.
+  """
+  if packet_file in memo_dict:
+    return memo_dict[packet_file]
+
+  table = array('i', [UNKNOWN]) * 65536
+  with open(packet_file) as f:
+    for line in f:
+      if line[:2] != '0x':
+        continue
+      opcode, length = line.strip().split(',')[:2]
+      table[int(opcode, 16)] = int(length)
+
+  memo_dict[packet_file] = table
+  return table
+
+def opcode_header(opcode):
+  return chr(opcode & 0xFF) + chr(opcode >> 8)
+
+def find_boundary(data, limit = 1024, table = None):
+  """
+  Returns the first offset in data, among the first limit, from which
+  everything up to the end of data frames as known packets, or None.
+  Used to pick a framing back up in the middle of a stream; a wrong
+  guess usually falls in step with the real packets within a frame or
+  two.
+  """
+  if table is None:
+    table = load_packet_table()
+  end = len(data)
+  for start in xrange(min(limit, end - 1)):
+    pos = start
+    while end - pos >= 2:
+      length = table[ord(data[pos]) | ord(data[pos+1]) << 8]
+      if length == VARIABLE:
+        #a length cut off by the end of data is taken on trust
+        length = ord(data[pos+2]) | ord(data[pos+3]) << 8 if end - pos >= 4 else 4
+        if length < 4:
+          break
+      elif length <= 0:
+        break
+      pos += length
+    else:
+      return start
+  return None
+
+class PacketFramer(object):
+  """
+  Frames a stream of recvs into packets.
+
+  Unknown opcodes are framed as their two header bytes, the same as
+  PacketChunker, so no byte of the stream is ever dropped. A partial
+  packet at the end of a recv is kept, with the recvs after it, until
+  it is complete and only then joined, so a large packet arriving in
+  many small recvs is copied once.
+  """
+  def __init__(self, packet_file = 'packets.txt'):
+    self.table = load_packet_table(packet_file)
+    #the partial packet as the recvs it arrived in, joined once it is complete
+    self.leftover = []
+    self.leftover_size = 0
+    self.needed = 0
+
+  def add_data(self, data):
+    """
+    Frames everything complete in the leftover bytes plus data and returns
+    the list of (opcode, memoryview) tuples framed.
+    """
+    data, offsets = self.split(data)
+    view = memoryview(data)
+    return [(opcode, view[start:end]) for opcode, start, end in offsets]
+
+  def split(self, data):
+    """
+    Frames everything complete in the leftover bytes plus data and returns
+    the joined data with the list of (opcode, start, end) offsets framed
+    in it, for callers that want to slice runs of packets themselves.
+    """
+    if self.leftover:
+      self.leftover.append(data)
+      self.leftover_size += len(data)
+      if self.leftover_size < self.needed:
+        return '', []
+      data = ''.join(self.leftover)
+
+    table, offsets = self.table, []
+    pos, end = 0, len(data)
+    needed = 2
+
+    while end - pos >= 2:
+      opcode = ord(data[pos]) | ord(data[pos+1]) << 8
+      length = table[opcode]
+
+      if length == VARIABLE:
+        if end - pos < 4:
+          needed = 4
+          break
+        length = ord(data[pos+2]) | ord(data[pos+3]) << 8
+        if length < 4:
+          #Broken length field. Frame the header and resync from there
+          length = 2
+      elif length <= 0:
+        #Unknown packet header. Frame it on its own
+        length = 2
+
+      if end - pos < length:
+        needed = length
+        break
+
+      offsets.append((opcode, pos, pos + length))
+      pos += length
+
+    if pos < end:
+      self.leftover, self.leftover_size, self.needed = [data[pos:]], end - pos, needed
+    else:
+      self.leftover, self.leftover_size = [], 0
+    return data, offsets
+
+  def frames(self, chunks):
+    """
+    Generator of (opcode, memoryview) tuples framed from an iterable of
+    recvs.
+    """
+    for chunk in chunks:
+      for frame in self.add_data(chunk):
+        yield frame
+
+  def pending(self):
+    return self.leftover_size
+
+def read_packs(filename):
+  """
+  Reads the TCP payload bytes of a .packs dump, see packs.py.
+  """
+  from packs import read_payload
+  return read_payload(filename)
+
+def benchmark(files = ('testpacks.packs', 'testpacks2.packs'), recv_sizes = (1024, 8192), rounds = 20):
+  from stream_chunker import PacketChunker
+
+  def run_chunker(data, recv_size):
+    chunker, count = PacketChunker(), 0
+    for i in xrange(0, len(data), recv_size):
+      chunker.add_data(data[i:i+recv_size])
+      while chunker.has_chunk():
+        chunker.pop()
+        count += 1
+    return count
+
+  def run_framer(data, recv_size):
+    framer, count = PacketFramer(), 0
+    for i in xrange(0, len(data), recv_size):
+      count += len(framer.add_data(data[i:i+recv_size]))
+    return count
+
+  for filename in files:
+    data = read_packs(filename)
+    for recv_size in recv_sizes:
+      for name, run in (('PacketChunkerClass', run_chunker), ('PacketFramer', run_framer)):
+        start = time.time()
+        for _ in xrange(rounds):
+          count = run(data, recv_size)
+        elapsed = (time.time() - start) / rounds
+        print "%-18s %-17s recv=%-5d %6d packets %10.0f packets/s %7.2f MB/s" % (
+          filename, name, recv_size, count, count / elapsed, len(data) / elapsed / 1e6
+        )
+
+class packet_framer(unittest.TestCase):
+  def test_table(self):
+    table = load_packet_table()
+    self.assertEqual(table[0x0066], 3)
+    self.assertEqual(table[0x006b], VARIABLE)
+    self.assertEqual(table[0x0000], UNKNOWN)
+
+  def test_correct_frame(self):
+    framer = PacketFramer()
+    frames = framer.add_data('\x66\x00\x00')
+    self.assertEqual([(opcode, view.tobytes()) for opcode, view in frames], [(0x0066, '\x66\x00\x00')])
+
+  def test_multiple_frames(self):
+    framer = PacketFramer()
+    frames = framer.add_data('\x66\x00\x00\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66\x66\x00\x00')
+    self.assertEqual([(opcode, view.tobytes()) for opcode, view in frames], [
+      (0x0066, '\x66\x00\x00'),
+      (0x006b, '\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66'),
+      (0x0066, '\x66\x00\x00'),
+    ])
+
+  def test_split_packet(self):
+    framer = PacketFramer()
+    data = '\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66'
+    frames = list(framer.frames(data))
+    self.assertEqual([(opcode, view.tobytes()) for opcode, view in frames], [(0x006b, data)])
+    self.assertEqual(framer.pending(), 0)
+
+  def test_partial_kept(self):
+    framer = PacketFramer()
+    self.assertEqual(len(framer.add_data('\x66\x00\x00\x6b\x00\x0a')), 1)
+    self.assertEqual(framer.pending(), 3)
+
+    frames = framer.add_data('\x00\x11\x22\x33\x44\x55\x66')
+    self.assertEqual([(opcode, view.tobytes()) for opcode, view in frames], [
+      (0x006b, '\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66'),
+    ])
+    self.assertEqual(framer.pending(), 0)
+
+  def test_split(self):
+    framer = PacketFramer()
+    data, offsets = framer.split('\x66\x00\x00\x6b\x00\x0a\x00\x11')
+    self.assertEqual(offsets, [(0x0066, 0, 3)])
+    data, offsets = framer.split('\x22\x33\x44\x55\x66\x66\x00')
+    self.assertEqual(data, '\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66\x66\x00')
+    self.assertEqual(offsets, [(0x006b, 0, 10)])
+    self.assertEqual(framer.pending(), 2)
+
+  def test_large_partial(self):
+    framer = PacketFramer()
+    packet = '\x6b\x00' + struct.pack('<H', 4000) + 'x' * 3996
+    for i in xrange(0, 3990, 10):
+      self.assertEqual(framer.split(packet[i:i+10]), ('', []) if i else (packet[:10], []))
+    self.assertEqual(framer.pending(), 3990)
+    data, offsets = framer.split(packet[3990:] + '\x66\x00')
+    self.assertEqual((data, offsets), (packet + '\x66\x00', [(0x006b, 0, 4000)]))
+    self.assertEqual(framer.leftover, ['\x66\x00'])
+
+  def test_find_boundary(self):
+    data = '\x66\x00\x00\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66\x66\x00\x00\x6b\x00'
+    self.assertEqual(find_boundary(data), 0)
+    self.assertEqual(find_boundary(data[1:]), 2)
+    self.assertEqual(find_boundary(data[5:]), 8)
+    self.assertEqual(find_boundary(data[5:], limit = 8), None)
+    self.assertEqual(find_boundary('\x00\x00\x00'), None)
+
+  def test_unknown_header(self):
+    framer = PacketFramer()
+    frames = framer.add_data('\x00\x00\x66\x00\x00')
+    self.assertEqual([(opcode, view.tobytes()) for opcode, view in frames], [
+      (0x0000, '\x00\x00'),
+      (0x0066, '\x66\x00\x00'),
+    ])
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['bench']:
+    benchmark()
+  else:
+    unittest.main()
@@ -1,4 +1,309 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+manager.py
 
+Runs many bots from one process on one asyncore loop.
+
+Every BotSession logs in with a bot_connector.AsyncLogin, the handshake
+of bot_connector.connect as a state machine driven by the packets of its
+non-blocking connections, so all of them share one map. The parsers,
+builders and packet table are module level and shared by every session.
+
+The Manager caps the handshakes in flight, so a few hundred bots don't
+all hit the login server at once, enforces the stage timeouts, keeps a
+latency Histogram per stage, and calls the tick() of every ready bot
+every tick_interval seconds of its own from a heap of due times, starting
+each at a random offset so the ticks are spread out.
+"""
+
+import asyncore
+import heapq
+import random
+import time
+import unittest
+from collections import deque
+from itertools import count
+from bot_connector import AsyncLogin, LoginCache
+from stats import Histogram
+
+class BotSession(object):
+  """
+  One bot account, logged in by an AsyncLogin. Subclasses override tick()
+  (and ready() or failed()) to do something once logged in, and call
+  stop() when done.
+  """
+  tick_interval = 1.0
+  ids = count(1)
+
+  def __init__(self, manager, server, auth, character_name, char_srv = 0, slot = None):
+    self.id = self.ids.next()
+    self.manager = manager
+    self.auth = auth
+    self.login_args = (server, auth, character_name, manager.map, self.login_done, char_srv, slot, manager.timeouts, manager.cache)
+    self.login = AsyncLogin(*self.login_args)
+    self.retried = False
+    self.stopped = False
+
+  def __repr__(self):
+    return '<BotSession %d %s %s>' % (self.id, self.auth[0], self.state)
+
+  @property
+  def state(self):
+    return 'stopped' if self.stopped else self.login.state
+
+  @property
+  def result(self):
+    return self.login.result
+
+  @property
+  def error(self):
+    return self.login.error
+
+  def start(self):
+    self.login.start()
+
+  def login_done(self, login):
+    if login.stale and not self.retried:
+      #the cache was out of date, and has been dropped
+      self.retried = True
+      self.login = AsyncLogin(*self.login_args)
+      self.login.start()
+      return
+    if login.state == 'ready':
+      self.manager.session_ready(self)
+      self.ready()
+    else:
+      self.manager.session_failed(self)
+      self.failed()
+
+  def ready(self):
+    pass
+
+  def failed(self):
+    pass
+
+  def tick(self, now):
+    pass
+
+  def stop(self):
+    """
+    Stops ticking. The Manager drops the session from its schedule.
+    """
+    self.stopped = True
+    self.login.close()
 
 class Manager(object):
-  pass
+  """
+  Runs BotSessions on one asyncore map, at most max_connecting of them
+  handshaking at a time. timeouts overrides AsyncLogin's stage timeouts.
+  A bot_connector.LoginCache given as cache is shared by every session
+  and written out at most every cache_interval seconds.
+  """
+  def __init__(self, map = None, max_connecting = 50, timeout = 1.0, timeouts = None, cache = None, cache_interval = 5.0):
+    self.map = map if map is not None else {}
+    self.max_connecting = max_connecting
+    self.timeout = timeout
+    self.timeouts = timeouts
+    self.cache, self.cache_interval = cache, cache_interval
+    self.sessions = []
+    self.pending = deque()
+    self.handshaking = set()
+    self.schedule = []
+    self.sequence = count()
+    self.latency = {}
+
+  @property
+  def connecting(self):
+    return len(self.handshaking)
+
+  def add(self, server, auth, character_name, char_srv = 0, session_class = BotSession, slot = None):
+    session = session_class(self, server, auth, character_name, char_srv, slot)
+    self.sessions.append(session)
+    self.pending.append(session)
+    self.start_pending()
+    return session
+
+  def start_pending(self):
+    while self.pending and len(self.handshaking) < self.max_connecting:
+      session = self.pending.popleft()
+      self.handshaking.add(session)
+      session.start()
+
+  def session_ready(self, session):
+    self.handshaking.discard(session)
+    for stage, seconds in session.login.latency.items():
+      if stage not in self.latency:
+        self.latency[stage] = Histogram()
+      self.latency[stage].add(seconds)
+    first = time.time() + random.random() * session.tick_interval
+    heapq.heappush(self.schedule, (first, self.sequence.next(), session))
+    self.start_pending()
+
+  def session_failed(self, session):
+    self.handshaking.discard(session)
+    self.start_pending()
+
+  def check_timeouts(self, now = None):
+    now = now or time.time()
+    for session in list(self.handshaking):
+      session.login.check_timeout(now)
+
+  def latency_report(self):
+    """
+    Percentiles of the handshake stages of the sessions logged in so far.
+    """
+    return dict((stage, histogram.as_dict()) for stage, histogram in self.latency.items())
+
+  def states(self):
+    states = {}
+    for session in self.sessions:
+      states[session.state] = states.get(session.state, 0) + 1
+    return states
+
+  def run_ticks(self, now = None):
+    """
+    Ticks every ready session that is due and returns how many were.
+    Sessions no longer ready, e.g. stopped, leave the schedule.
+    """
+    now = now or time.time()
+    schedule, ticked = self.schedule, 0
+    while schedule and schedule[0][0] <= now:
+      due, _, session = heapq.heappop(schedule)
+      if session.state != 'ready':
+        continue
+      session.tick(now)
+      ticked += 1
+      if session.state != 'ready':
+        continue
+      #keep to the session's own rhythm, unless it fell behind
+      heapq.heappush(schedule, (max(due + session.tick_interval, now), self.sequence.next(), session))
+    return ticked
+
+  def poll(self, timeout = None):
+    timeout = self.timeout if timeout is None else timeout
+    if self.schedule:
+      timeout = max(0.0, min(timeout, self.schedule[0][0] - time.time()))
+    if self.map:
+      asyncore.loop(timeout, True, self.map, 1)
+    else:
+      time.sleep(timeout)
+    self.check_timeouts()
+    self.run_ticks()
+    if self.cache is not None:
+      self.cache.flush(self.cache_interval)
+
+  def run(self, duration = None):
+    """
+    Runs until every session has failed or stopped, or for duration
+    seconds.
+    """
+    end = time.time() + duration if duration is not None else None
+    while self.pending or self.handshaking or self.schedule:
+      if end is not None and time.time() >= end:
+        break
+      self.poll()
+    if self.cache is not None:
+      self.cache.flush()
+
+class bot_manager(unittest.TestCase):
+  def setUp(self):
+    from fake_login_servers import FakeLoginServers
+    self.map = {}
+    self.servers = FakeLoginServers(self.map)
+    self.address = self.servers.login_server.address
+
+  def tearDown(self):
+    self.servers.close()
+
+  def run_manager(self, manager, sessions):
+    end = time.time() + 5
+    while any(session.state not in ('ready', 'failed') for session in sessions) and time.time() < end:
+      manager.poll(0.05)
+
+  def test_many_sessions(self):
+    manager = Manager(self.map, max_connecting = 5)
+    sessions = [manager.add(self.address, ('bot%d' % n, 'pass'), 'Poopstick') for n in xrange(20)]
+    self.assertEqual(manager.states(), {'login': 5, 'new': 15})
+    self.run_manager(manager, sessions)
+    self.assertEqual(manager.states(), {'ready': 20})
+    self.assertEqual(sessions[0].result, {'char_id': 'M\x00\x00\x00', 'server': ('127.0.0.1', 5121), 'map_name': 'prontera.gat'})
+    self.assertEqual(sessions[0].login.account_id, 42)
+
+  def test_failures(self):
+    manager = Manager(self.map)
+    refused = manager.add(self.address, ('bot', 'bad'), 'Poopstick')
+    unknown = manager.add(self.address, ('bot', 'pass'), 'Nobody')
+    self.run_manager(manager, [refused, unknown])
+    self.assertEqual(refused.error, 'Login refused (1)')
+    self.assertTrue(unknown.error.startswith('Nobody not in character list'))
+    self.assertEqual(manager.connecting, 0)
+
+  def test_timeouts(self):
+    self.servers.silent = ('select',)
+    manager = Manager(self.map, timeouts = {'select': 0.1})
+    session = manager.add(self.address, ('bot', 'pass'), 'Poopstick')
+    self.run_manager(manager, [session])
+    self.assertEqual(session.error, 'Timed out in select after 0.1s')
+
+  def test_stale_cache_retry(self):
+    import os, shutil, tempfile
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'logins.json')
+      cache = LoginCache(filename, trust_slots = True)
+      cache.update(self.address, 'bot', [list(self.servers.char_server.address) + ['test']], {'Poopstick': 1})
+      manager = Manager(self.map, cache = cache)
+      session = manager.add(self.address, ('bot', 'pass'), 'Poopstick')
+      self.run_manager(manager, [session])
+      self.assertEqual((session.state, session.retried), ('ready', True))
+      manager.run(0)
+      self.assertEqual(LoginCache(filename).get(self.address, 'bot')['characters'], {'Poopstick': 2})
+    finally:
+      shutil.rmtree(directory)
+
+  def test_latency_report(self):
+    manager = Manager(self.map)
+    sessions = [manager.add(self.address, ('bot', 'pass'), 'Poopstick', slot = 2) for _ in xrange(3)]
+    self.run_manager(manager, sessions)
+    report = manager.latency_report()
+    self.assertEqual(report['total']['count'], 3)
+    self.assertTrue(report['total']['p99'] < 1.0)
+
+  def test_ticks(self):
+    ticks = []
+    class TickingSession(BotSession):
+      tick_interval = 0.05
+      def tick(self, now):
+        ticks.append(self.id)
+
+    manager = Manager(self.map)
+    sessions = [manager.add(self.address, ('bot', 'pass'), 'Poopstick', session_class = TickingSession) for _ in xrange(3)]
+    self.run_manager(manager, sessions)
+    end = time.time() + 0.3
+    while time.time() < end:
+      manager.poll(0.05)
+    for session in sessions:
+      self.assertTrue(3 <= ticks.count(session.id) <= 8, ticks.count(session.id))
+
+  def test_run_until_stopped(self):
+    class StoppingSession(BotSession):
+      tick_interval = 0.01
+      ticks = 0
+      def tick(self, now):
+        self.ticks += 1
+        if self.ticks == 3:
+          self.stop()
+
+    manager = Manager(self.map, timeout = 0.05)
+    sessions = [manager.add(self.address, ('bot', 'pass'), 'Poopstick', session_class = StoppingSession) for _ in xrange(3)]
+    manager.add(self.address, ('bot', 'bad'), 'Poopstick', session_class = StoppingSession)
+    start = time.time()
+    manager.run()
+    self.assertTrue(time.time() - start < 5)
+    self.assertEqual([session.ticks for session in sessions], [3, 3, 3])
+    self.assertEqual(manager.states(), {'stopped': 3, 'failed': 1})
+    self.assertEqual(manager.schedule, [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,4 +1,7 @@
 from itertools import izip, izip_longest
+from binascii import hexlify
+from operator import itemgetter
+import struct
 import unittest
 
 class ParseError(Exception): pass
@@ -6,7 +9,475 @@ class ParseError(Exception): pass
 def hex_repr(data):
   return ''.join('%.2X' % ord(str(c)) for c in data)
 
-def make_packet_parser(header, data_spec):
+def as_string(data):
+  if isinstance(data, str):
+    return data
+  if isinstance(data, memoryview):
+    return data.tobytes()
+  if isinstance(data, bytearray):
+    return str(data)
+  return ''.join(data)
+
+INT_CODES = {1: 'B', 2: 'H', 4: 'I'}
+INT_STRUCTS = dict((bytes, struct.Struct('<' + code)) for bytes, code in INT_CODES.items())
+BUFFER_TYPES = frozenset((str, memoryview, bytearray))
+
+def field_code(name, bytes, ints = False):
+  if name == '_':
+    return '%dx' % bytes
+  if ints and bytes in INT_CODES:
+    return INT_CODES[bytes]
+  return '%ds' % bytes
+
+def field_struct(fields, ints = False):
+  """
+  Builds a struct for a run of fixed width fields. Named fields are read
+  as raw strings and '_' fields are skipped. With ints, 1, 2 and 4 byte
+  fields are read as little endian unsigned ints instead.
+  """
+  return struct.Struct('<' + ''.join(field_code(name, bytes, ints) for name, bytes in fields))
+
+def field_offsets(fields, offset = 0):
+  """
+  Returns a dict of name: (offset, bytes) for the named fields laid out
+  from offset.
+  """
+  offsets = {}
+  for name, bytes in fields:
+    if name != '_':
+      offsets[name] = (offset, bytes)
+    offset += bytes
+  return offsets
+
+def encode_field(name, bytes, value):
+  """
+  Encodes a field value for packing. Ints are packed little endian into
+  1, 2 and 4 byte fields and strings may be shorter than the field, in
+  which case they are padded with nulls.
+  """
+  if isinstance(value, (int, long)):
+    if bytes not in INT_STRUCTS:
+      raise ParseError('Field %s is %d bytes and cannot hold an int' % (name, bytes))
+    try:
+      return INT_STRUCTS[bytes].pack(value)
+    except struct.error:
+      raise ParseError('Field %s out of range: %d' % (name, value))
+  
+  value = as_string(value)
+  if len(value) > bytes:
+    raise ParseError('Field %s is longer than %d bytes' % (name, bytes))
+  return value
+
+def encode_fields(fields, values):
+  if hasattr(values, '_asdict'):
+    values = values._asdict()
+  
+  encoded = []
+  for name, bytes in fields:
+    if name not in values:
+      raise ParseError('Missing field: %s' % name)
+    encoded.append(encode_field(name, bytes, values[name]))
+  return encoded
+
+class Record(tuple):
+  """
+  Base of the generated packet record types. Records are tuples with a
+  named property per field, so they carry no per instance dict.
+  """
+  __slots__ = ()
+  _fields = ()
+  
+  def _asdict(self):
+    return dict(izip(self._fields, self))
+  
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % pair for pair in izip(self._fields, self)))
+
+def make_record_type(type_name, fields):
+  namespace = {'__slots__': (), '_fields': tuple(fields)}
+  for index, name in enumerate(fields):
+    namespace[name] = property(itemgetter(index))
+  return type(type_name, (Record,), namespace)
+
+class FieldView(object):
+  """
+  Descriptor decoding one fixed width field of a view on access. The
+  offset is taken from the start of the view, or from the end of the
+  middle section for fields after it.
+  """
+  __slots__ = ('unpack_from', 'offset', 'from_tail')
+  
+  def __init__(self, name, bytes, offset, from_tail = False):
+    self.unpack_from = struct.Struct('<' + field_code(name, bytes, ints = True)).unpack_from
+    self.offset = offset
+    self.from_tail = from_tail
+  
+  def __get__(self, view, owner):
+    if view is None:
+      return self
+    return self.unpack_from(view[0], view[2 if self.from_tail else 1] + self.offset)[0]
+
+class LengthView(object):
+  __slots__ = ()
+  
+  def __get__(self, view, owner):
+    if view is None:
+      return self
+    return len(view[0])
+
+class MiddleView(object):
+  """
+  Descriptor for the indeterminate middle section of a view, either the
+  raw variable width field or a RepeatView over the repeated records.
+  """
+  __slots__ = ('start', 'repeat_size', 'repeat_type')
+  
+  def __init__(self, start, repeat_size = 0, repeat_type = None):
+    self.start = start
+    self.repeat_size = repeat_size
+    self.repeat_type = repeat_type
+  
+  def __get__(self, view, owner):
+    if view is None:
+      return self
+    data, _, tail = view
+    if self.repeat_type is None:
+      return as_string(data[self.start:tail])
+    return RepeatView(data, self.start, (tail - self.start) // self.repeat_size, self.repeat_size, self.repeat_type)
+
+class PacketView(tuple):
+  """
+  Base of the generated packet view types. A view is a (buffer, base,
+  tail) tuple: the packet buffer, the offset of the view in it and the
+  end of the middle section. Fields are only decoded when accessed.
+  """
+  __slots__ = ()
+  _fields = ()
+  
+  def __new__(cls, data, base = 0, tail = 0):
+    return tuple.__new__(cls, (data, base, tail))
+  
+  def _asdict(self):
+    return dict((name, getattr(self, name)) for name in self._fields)
+  
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self._fields))
+
+class RepeatView(object):
+  """
+  Lazily indexed sequence of record views over a repeat block.
+  """
+  __slots__ = ('_data', '_start', '_count', '_size', '_type')
+  
+  def __init__(self, data, start, count, size, view_type):
+    self._data = data
+    self._start = start
+    self._count = count
+    self._size = size
+    self._type = view_type
+  
+  def __len__(self):
+    return self._count
+  
+  def __getitem__(self, index):
+    if index < 0:
+      index += self._count
+    if not 0 <= index < self._count:
+      raise IndexError('record index out of range')
+    return tuple.__new__(self._type, (self._data, self._start + index * self._size, 0))
+  
+  def __iter__(self):
+    new, view_type, data = tuple.__new__, self._type, self._data
+    for offset in xrange(self._start, self._start + self._count * self._size, self._size):
+      yield new(view_type, (data, offset, 0))
+
+def make_view_type(type_name, fields, start = 0, tail = (), middle = None):
+  """
+  Generates a PacketView subclass with a FieldView per named field. Head
+  fields start at start, tail fields are placed after the middle section.
+  """
+  namespace = {'__slots__': ()}
+  names = []
+  
+  def add_fields(fields, offset, from_tail = False):
+    for name, bytes in fields:
+      if name != '_':
+        namespace[name] = FieldView(name, bytes, offset, from_tail)
+        names.append(name)
+      offset += bytes
+  
+  add_fields(fields, start)
+  if middle is not None:
+    name, descriptor = middle
+    namespace[name] = descriptor
+    names.append(name)
+  add_fields(tail, 0, from_tail = True)
+  
+  namespace['_fields'] = tuple(names)
+  return type(type_name, (PacketView,), namespace)
+
+class PacketLayout(object):
+  """
+  Precomputed layout of a data_spec.
+  
+  The spec is split into a fixed head, at most one indeterminate middle
+  field (a repeat block or a zero width field) and a fixed tail. The head
+  is read at a constant offset after the header/length bytes, the tail at
+  a constant offset back from the end of the packet and the middle takes
+  whatever is left over.
+  """
+  def __init__(self, header, data_spec):
+    self.header = header
+    self.data_spec = data_spec
+    self.has_length = 'length' in (field_name for field_name, _ in data_spec)
+    self.start = 4 if self.has_length else 2
+    self.prefix_struct = struct.Struct('<2sH' if self.has_length else '<2s')
+    
+    fields = [(name, bytes) for name, bytes in data_spec if name != 'length']
+    middle = [i for i, (_, bytes) in enumerate(fields) if bytes == 0 or isinstance(bytes, tuple)]
+    if middle:
+      middle = middle[0]
+      self.head, self.tail = tuple(fields[:middle]), tuple(fields[middle+1:])
+      self.middle_name, bytes = fields[middle]
+    else:
+      self.head, self.tail = tuple(fields), ()
+      self.middle_name, bytes = None, 0
+    
+    self.head_struct, self.tail_struct = field_struct(self.head), field_struct(self.tail)
+    self.head_names = tuple(name for name, _ in self.head if name != '_')
+    self.tail_names = tuple(name for name, _ in self.tail if name != '_')
+    self.head_named = tuple((name, bytes) for name, bytes in self.head if name != '_')
+    self.tail_named = tuple((name, bytes) for name, bytes in self.tail if name != '_')
+    self.head_size, self.tail_size = self.head_struct.size, self.tail_struct.size
+    self.head_offsets = field_offsets(self.head, self.start)
+    
+    if isinstance(bytes, tuple):
+      self.repeat = tuple(bytes)
+      self.repeat_struct = field_struct(self.repeat)
+      self.repeat_names = tuple(name for name, _ in self.repeat if name != '_')
+      self.repeat_named = tuple((name, bytes) for name, bytes in self.repeat if name != '_')
+      self.repeat_size = self.repeat_struct.size
+      self.repeat_offsets = field_offsets(self.repeat)
+    else:
+      self.repeat = self.repeat_struct = self.repeat_names = None
+      self.repeat_size = 0
+      self.repeat_offsets = {}
+    
+    if self.has_length:
+      self.size = -1
+    else:
+      self.size = 2 + self.head_size + self.tail_size
+    
+    self.head_record_struct = field_struct(self.head, ints = True)
+    self.tail_record_struct = field_struct(self.tail, ints = True)
+    type_name = 'Packet%.2X%.2X' % (ord(header[1]), ord(header[0]))
+    record_fields = (('length',) if self.has_length else ()) + self.head_names
+    if self.middle_name not in (None, '_'):
+      record_fields += (self.middle_name,)
+    self.record_type = make_record_type(type_name, record_fields + self.tail_names)
+    
+    if self.repeat is not None:
+      self.repeat_record_struct = field_struct(self.repeat, ints = True)
+      self.repeat_record_type = make_record_type('%s_%s' % (type_name, self.middle_name), self.repeat_names)
+    else:
+      self.repeat_record_struct = self.repeat_record_type = None
+    
+    middle = None
+    if self.repeat is not None:
+      self.repeat_view_type = make_view_type('%sView_%s' % (type_name, self.middle_name), self.repeat)
+      middle = (self.middle_name, MiddleView(self.start + self.head_size, self.repeat_size, self.repeat_view_type))
+    elif self.middle_name not in (None, '_'):
+      middle = (self.middle_name, MiddleView(self.start + self.head_size))
+    self.view_type = make_view_type(type_name + 'View', self.head, self.start, self.tail, middle)
+    if self.has_length:
+      self.view_type.length = LengthView()
+      self.view_type._fields = ('length',) + self.view_type._fields
+  
+  def check(self, data):
+    """
+    Checks the header and length of a packet and returns the offset
+    and size of the indeterminate middle section.
+    """
+    raw_data_len = len(data)
+    
+    if raw_data_len < 2:
+      raise ParseError('No header to parse')
+    
+    if raw_data_len < self.start:
+      prefix = (as_string(data[:2]),)
+    else:
+      prefix = self.prefix_struct.unpack_from(data)
+    
+    if prefix[0] != self.header:
+      raise ParseError('Header mismatch. Got %s, expected %s' % (hex_repr(prefix[0]), hex_repr(self.header)))
+    
+    if self.has_length:
+      if raw_data_len < 4:
+        raise ParseError('Not enough data in packet.')
+      p_data_len = prefix[1]
+    else:
+      p_data_len = self.size
+    
+    if p_data_len != raw_data_len:
+      raise ParseError('Length mismatch. Expected %d and got %d' % (p_data_len, raw_data_len))
+    
+    middle_start = self.start + self.head_size
+    middle_size = raw_data_len - middle_start - self.tail_size
+    if middle_size < 0:
+      raise ParseError('Not enough data in packet.')
+    if self.repeat_size and middle_size % self.repeat_size:
+      raise ParseError('Not enough data in packet.')
+    
+    return middle_start, middle_size
+  
+  def unpack(self, data):
+    """
+    Unpacks a packet string into a dict of raw field strings.
+    """
+    middle_start, middle_size = self.check(data)
+    middle_end = middle_start + middle_size
+    
+    data_dict = dict(izip(self.head_names, self.head_struct.unpack_from(data, self.start)))
+    if self.tail_size:
+      data_dict.update(izip(self.tail_names, self.tail_struct.unpack_from(data, middle_end)))
+    
+    if self.has_length:
+      data_dict['length'] = len(data)
+    
+    if self.repeat is not None:
+      names, unpack_from = self.repeat_names, self.repeat_struct.unpack_from
+      data_dict[self.middle_name] = [
+        dict(izip(names, unpack_from(data, offset)))
+        for offset in xrange(middle_start, middle_end, self.repeat_size)
+      ]
+    elif self.middle_name not in (None, '_'):
+      data_dict[self.middle_name] = data[middle_start:middle_end]
+    
+    return data_dict
+  
+  def record(self, data):
+    """
+    Unpacks a packet string into an instance of record_type, with 1, 2
+    and 4 byte fields decoded to ints and repeat blocks as lists of
+    repeat_record_type.
+    """
+    middle_start, middle_size = self.check(data)
+    middle_end = middle_start + middle_size
+    
+    values = self.head_record_struct.unpack_from(data, self.start)
+    if self.has_length:
+      values = (len(data),) + values
+    
+    if self.repeat is not None:
+      new, record_type, unpack_from = tuple.__new__, self.repeat_record_type, self.repeat_record_struct.unpack_from
+      values += ([
+        new(record_type, unpack_from(data, offset))
+        for offset in xrange(middle_start, middle_end, self.repeat_size)
+      ],)
+    elif self.middle_name not in (None, '_'):
+      values += (data[middle_start:middle_end],)
+    
+    if self.tail_size:
+      values += self.tail_record_struct.unpack_from(data, middle_end)
+    
+    return tuple.__new__(self.record_type, values)
+  
+  def view(self, data):
+    """
+    Checks the header and length of a packet and returns a view_type over
+    it. Fields are decoded the same way as record() but only on access.
+    """
+    middle_start, middle_size = self.check(data)
+    return tuple.__new__(self.view_type, (data, 0, middle_start + middle_size))
+  
+  def middle_value(self, fields):
+    if self.middle_name in (None, '_'):
+      return None
+    if hasattr(fields, '_asdict'):
+      fields = fields._asdict()
+    if self.middle_name not in fields:
+      raise ParseError('Missing field: %s' % self.middle_name)
+    return fields[self.middle_name]
+  
+  def packed_size(self, fields):
+    """
+    Returns the size of the packet that pack_into would write for fields.
+    """
+    middle = self.middle_value(fields)
+    if middle is None:
+      middle_size = 0
+    elif self.repeat is not None:
+      middle_size = len(middle) * self.repeat_size
+    else:
+      middle_size = len(middle)
+    return self.start + self.head_size + middle_size + self.tail_size
+  
+  def pack_into(self, buf, offset, fields):
+    """
+    Packs fields (a dict, record or view) into buf at offset and returns
+    the number of bytes written. The length field of variable packets is
+    filled in and '_' fields are zeroed.
+    """
+    size = self.packed_size(fields)
+    if self.has_length and size > 0xFFFF:
+      raise ParseError('Packet too long: %d' % size)
+    if len(buf) - offset < size:
+      raise ParseError('Buffer too small. Need %d bytes and got %d' % (size, len(buf) - offset))
+    
+    if self.has_length:
+      self.prefix_struct.pack_into(buf, offset, self.header, size)
+    else:
+      self.prefix_struct.pack_into(buf, offset, self.header)
+    
+    self.head_struct.pack_into(buf, offset + self.start, *encode_fields(self.head_named, fields))
+    
+    middle_start = offset + self.start + self.head_size
+    middle_end = offset + size - self.tail_size
+    middle = self.middle_value(fields)
+    if self.repeat is not None:
+      pack_into, named = self.repeat_struct.pack_into, self.repeat_named
+      for record_offset, record in izip(xrange(middle_start, middle_end, self.repeat_size), middle):
+        pack_into(buf, record_offset, *encode_fields(named, record))
+    elif middle is not None:
+      buf[middle_start:middle_end] = as_string(middle)
+    
+    if self.tail_size:
+      self.tail_struct.pack_into(buf, middle_end, *encode_fields(self.tail_named, fields))
+    
+    return size
+  
+  def trace(self, data):
+    """
+    Builds the hex trace of a packet, one chunk per field with repeated
+    records wrapped in braces.
+    """
+    middle_start, middle_size = self.check(data)
+    chunks = [hexlify(data[:2]).upper()]
+    if self.has_length:
+      chunks.append(hexlify(data[2:4]).upper())
+    
+    def add_fields(fields, offset):
+      for _, bytes in fields:
+        chunks.append(hexlify(data[offset:offset+bytes]).upper())
+        offset += bytes
+      return offset
+    
+    add_fields(self.head, self.start)
+    if self.repeat is not None:
+      for offset in xrange(middle_start, middle_start + middle_size, self.repeat_size):
+        chunks.append('{')
+        add_fields(self.repeat, offset)
+        chunks.append('}')
+    elif self.middle_name is not None:
+      chunks.append(hexlify(data[middle_start:middle_start+middle_size]).upper())
+    add_fields(self.tail, middle_start + middle_size)
+    
+    return ' '.join(chunks)
+
+def compile_spec(header, data_spec):
+  """
+  Validates a header and data_spec and compiles them into a PacketLayout.
+  """
   if len(header) != 2:
     raise ParseError('Header must be two bytes')
   
@@ -15,11 +486,6 @@ def make_packet_parser(header, data_spec):
   
   has_length = 'length' in (field_name for field_name, _ in data_spec)
   has_repeat = any(isinstance(bytes, tuple) for _, bytes in data_spec)
-  if not has_repeat:
-    repeat_len = 0
-  else:
-    repeat_tuple = (bytes for _, bytes in data_spec if isinstance(bytes, tuple)).next() 
-    repeat_len = sum(bytes for _, bytes in repeat_tuple)
   
   if len(set(field_name for field_name, _ in data_spec if field_name != '_')) != len([field_name for field_name, _ in data_spec if field_name != '_']):
     raise ParseError('Duplicate field names')
@@ -34,99 +500,112 @@ def make_packet_parser(header, data_spec):
   if sum(1 for _, bytes in data_spec if (bytes == 0 or isinstance(bytes, tuple))) > 1:
     raise ParseError('Too many indeterminate fields')
   
-  if has_length:
-    data_len = -1
-  else:
-    data_len = sum(bytes for _, bytes in data_spec)
+  if has_repeat:
+    repeat_tuple = (bytes for _, bytes in data_spec if isinstance(bytes, tuple)).next()
+    if not all(isinstance(bytes, int) and bytes > 0 for _, bytes in repeat_tuple):
+      raise ParseError('Repeat fields must have a fixed size')
   
   #Make a copy of data_spec and header
-  data_spec, header = data_spec[:], header[:]
+  return PacketLayout(str(header), tuple(data_spec))
+
+def make_packet_parser(header, data_spec):
+  layout = compile_spec(header, data_spec)
   
   def parser(d_data, format = 'dict'):
     """
     parses data into specified data_spec.
     d_data: '\x00\xAB....\x13\x45' string of bytes
     """
+    if format == 'view':
+      if d_data.__class__ not in BUFFER_TYPES:
+        d_data = as_string(d_data)
+      return layout.view(d_data)
     
-    chunks = []
-    data_dict = {}
-    
-    d_data_split = iter(d_data)
-    raw_data_len = len(d_data)
-    
-    def set_field(name, data):
-      if name != '_':
-        data_dict[name] = data
+    d_data = as_string(d_data)
     
-    def get_data(data_gen, count):
-      returned_data = ''.join(data_gen.next() for _ in xrange(count))
-      
-      if len(returned_data) != count:
-        raise ParseError('Not enough data in packet.')
-      
-      chunks.append(hex_repr(returned_data))
-      return returned_data
-    
-    if raw_data_len < 2:
-      raise ParseError('No header to parse')
-    
-    d_header = get_data(d_data_split, 2)
-    
-    if d_header != header:
-      raise ParseError('Header mismatch. Got %s, expected %s' % (hex_repr(d_header), hex_repr(header)))
-    
-    if data_len == -1:
-      len_bytes = get_data(d_data_split, 2)
-      p_data_len = ord(len_bytes[0]) + 256*ord(len_bytes[1]) - 4 #Subtract header/len bytes
-    else:
-      p_data_len = data_len - 2 #Subtract just the header bytes
-    
-    if (p_data_len + 4) != raw_data_len:
-      raise ParseError('Length mismatch. Expected %d and got %d' % ((p_data_len + 4), raw_data_len))
-    
-    offset = 0
-    for count, (field_name, bytes) in enumerate(data_spec):
-      if field_name == "length":
-        set_field(field_name, p_data_len + 4)
-      elif isinstance(bytes, tuple):
-        #Figure out how many bytes are going to be left on the end
-        other_data = sum(bytes for _, bytes in data_spec[count+1:])
-        field_list = []
-        
-        while p_data_len - offset > other_data:
-          sub_field_dict = {}
-          chunks.append('{')
-          for sub_field_name, sub_bytes in bytes:
-            data = get_data(d_data_split, sub_bytes)
-            offset += sub_bytes
-            if sub_field_name != '_':
-              sub_field_dict[sub_field_name] = data
-          field_list.append(sub_field_dict)
-          chunks.append('}')
-          
-        set_field(field_name, field_list)
-      else:
-        if bytes == 0:
-          #Figure out how many bytes we need to read
-          other_data = sum(bytes for _, bytes in data_spec[count+1:])
-          bytes = p_data_len - offset - other_data
-        
-        data = get_data(d_data_split, bytes)
-        offset += bytes
-        
-        set_field(field_name, data)
-      
     if format == 'dict':
-      return data_dict
+      return layout.unpack(d_data)
+    elif format == 'record':
+      return layout.record(d_data)
     elif format == 'chunks':
-      return ' '.join(chunks)
+      return layout.trace(d_data)
     elif format == 'all':
-      return data_dict, ' '.join(chunks)
+      return layout.unpack(d_data), layout.trace(d_data)
     else:
       raise ParseError('Unknown format: %s' % format)
-      
+  
+  parser.layout = layout
+  parser.record_type = layout.record_type
+  parser.view_type = layout.view_type
   return parser
 
+def make_packet_builder(header, data_spec):
+  """
+  Makes the encoder counterpart of make_packet_parser for the same spec.
+  The builder takes a dict (or record or view) of field values and
+  returns a new bytearray holding the packet, and builder.pack_into(buf,
+  offset, fields) writes it into a caller supplied bytearray instead.
+  """
+  layout = compile_spec(header, data_spec)
+  
+  def builder(fields):
+    buf = bytearray(layout.packed_size(fields))
+    layout.pack_into(buf, 0, fields)
+    return buf
+  
+  builder.layout = layout
+  builder.size = layout.packed_size
+  builder.pack_into = layout.pack_into
+  return builder
+
+class TestPacketBuilder(unittest.TestCase):
+  def test_round_trip(self):
+    specs = (
+      (('field_1', 2), ('field_2', 2), ('field_3', 4)),
+      (('length', 2), ('field_1', 1), ('field_2', 0), ('field_3', 1)),
+      (('length', 2), ('field_1', 1), ('field_2', (('field_3', 1), ('field_4', 3))), ('field_5', 2)),
+    )
+    cases = (
+      ['\x00\x12\x00\x01\x00\x02\x00\x00\x00\x03'],
+      ['\x00\x12\x06\x00\x01\x02', '\x00\x12\x09\x00\x01abc\x02'],
+      ['\x00\x12\x07\x00\x01\x05\x00', '\x00\x12\x0F\x00\x01\x03abc\x04def\x05\x00'],
+    )
+    for data_spec, packets in izip(specs, cases):
+      parser, builder = make_packet_parser('\x00\x12', data_spec), make_packet_builder('\x00\x12', data_spec)
+      for packet in packets:
+        self.assertEqual(str(builder(parser(packet))), packet)
+        self.assertEqual(str(builder(parser(packet, format = 'record'))), packet)
+        self.assertEqual(str(builder(parser(packet, format = 'view'))), packet)
+  
+  def test_padding_and_ints(self):
+    builder = make_packet_builder('\x64\x00', (
+      ('version', 4),
+      ('name', 8),
+      ('_', 2),
+      ('type', 1),
+    ))
+    self.assertEqual(str(builder({'version': 0x18, 'name': 'test', 'type': '\x12'})),
+      '\x64\x00\x18\x00\x00\x00test\x00\x00\x00\x00\x00\x00\x12')
+  
+  def test_pack_into(self):
+    builder = make_packet_builder('\x00\x12', (
+      ('length', 2),
+      ('field_1', 0),
+    ))
+    buf = bytearray(16)
+    self.assertEqual(builder.pack_into(buf, 2, {'field_1': 'ab'}), 6)
+    self.assertEqual(str(buf[:8]), '\x00\x00\x00\x12\x06\x00ab')
+    self.assertRaises(ParseError, builder.pack_into, bytearray(5), 0, {'field_1': 'ab'})
+  
+  def test_invalid_values(self):
+    builder = make_packet_builder('\x00\x12', (
+      ('field_1', 2),
+      ('field_2', 3),
+    ))
+    self.assertRaises(ParseError, builder, {'field_1': 1})
+    self.assertRaises(ParseError, builder, {'field_1': 1, 'field_2': 'abcd'})
+    self.assertRaises(ParseError, builder, {'field_1': 1, 'field_2': 5})
+    self.assertRaises(ParseError, builder, {'field_1': 0x10000, 'field_2': 'abc'})
 
 class TestInvalidParsers(unittest.TestCase):
   def test_bad_header(self):
@@ -185,6 +664,80 @@ class TestInvalidParsers(unittest.TestCase):
       ('field_1', 1),
     ))
 
+class TestCompiledLayout(unittest.TestCase):
+  def test_fixed(self):
+    layout = compile_spec('\x00\x12', (
+      ('field_1', 2),
+      ('_', 1),
+      ('field_2', 4),
+    ))
+    self.assertEqual((layout.has_length, layout.start, layout.size), (False, 2, 9))
+    self.assertEqual(layout.head_struct.format, '<2s1x4s')
+    self.assertEqual((layout.head_names, layout.tail, layout.middle_name), (('field_1', 'field_2'), (), None))
+    self.assertEqual(layout.head_offsets, {'field_1': (2, 2), 'field_2': (5, 4)})
+    self.assertEqual(layout.check('\x00\x12' + '\x00' * 7), (9, 0))
+
+  def test_head_middle_tail(self):
+    layout = compile_spec('\x00\x12', (
+      ('length', 2),
+      ('field_1', 1),
+      ('field_2', (
+        ('field_3', 2),
+        ('_', 1),
+        ('field_4', 3),
+      )),
+      ('field_5', 2),
+    ))
+    self.assertEqual((layout.has_length, layout.start, layout.size), (True, 4, -1))
+    self.assertEqual((layout.head, layout.middle_name, layout.tail), ((('field_1', 1),), 'field_2', (('field_5', 2),)))
+    self.assertEqual((layout.head_size, layout.repeat_size, layout.tail_size), (1, 6, 2))
+    self.assertEqual(layout.repeat_struct.format, '<2s1x3s')
+    self.assertEqual(layout.repeat_record_struct.format, '<H1x3s')
+    self.assertEqual(layout.repeat_offsets, {'field_3': (0, 2), 'field_4': (3, 3)})
+    self.assertEqual(layout.record_type._fields, ('length', 'field_1', 'field_2', 'field_5'))
+    self.assertEqual(layout.check('\x00\x12\x13\x00\x07' + '\x00' * 14), (5, 12))
+    self.assertEqual(layout.check('\x00\x12\x07\x00\x07\x05\x00'), (5, 0))
+
+  def test_variable_middle(self):
+    layout = compile_spec('\x00\x12', (
+      ('length', 2),
+      ('field_1', 0),
+      ('_', 1),
+    ))
+    self.assertEqual((layout.head, layout.middle_name, layout.tail), ((), 'field_1', (('_', 1),)))
+    self.assertEqual((layout.repeat, layout.repeat_size, layout.tail_names), (None, 0, ()))
+    self.assertEqual(layout.check('\x00\x12\x08\x00abc\x00'), (4, 3))
+
+  def test_check_failures(self):
+    fixed = compile_spec('\x00\x12', (('field_1', 2),))
+    repeat = compile_spec('\x00\x12', (
+      ('length', 2),
+      ('field_1', 1),
+      ('field_2', (('field_3', 2),)),
+      ('field_4', 1),
+    ))
+    for layout, data, message in (
+      (fixed, '\x00', 'No header to parse'),
+      (fixed, '\x00\x13\x00\x00', 'Header mismatch. Got 0013, expected 0012'),
+      (fixed, '\x00\x12\x00', 'Length mismatch. Expected 4 and got 3'),
+      (repeat, '\x00\x12\x06', 'Not enough data in packet.'),
+      (repeat, '\x00\x12\x07\x00\x00\x00\x00', 'Not enough data in packet.'),
+      (repeat, '\x00\x12\x05\x00\x00', 'Not enough data in packet.'),
+      (repeat, '\x00\x12\x08\x00\x00\x00\x00', 'Length mismatch. Expected 8 and got 7'),
+    ):
+      try:
+        layout.check(data)
+      except ParseError, e:
+        self.assertEqual(str(e), message)
+      else:
+        self.fail('%r passed check' % data)
+
+  def test_copies_spec(self):
+    spec = [('field_1', 2)]
+    layout = compile_spec(bytearray('\x00\x12'), spec)
+    spec.append(('field_2', 2))
+    self.assertEqual((layout.header, layout.data_spec, layout.size), ('\x00\x12', (('field_1', 2),), 4))
+
 class TestInvalidParsing(unittest.TestCase):
   def setUp(self):
     self.basic_parser = make_packet_parser('\x00\x12', (
@@ -225,6 +778,100 @@ class TestInvalidParsing(unittest.TestCase):
   def test_repeat_right_length_wrong_repeat(self):
     self.assertRaises(ParseError, self.repeat_parser, '\x00\x12\x08\x00\x01\x03\x04\x03')
   
+class TestRecordParsing(unittest.TestCase):
+  def test_basic(self):
+    test_parser = make_packet_parser('\x00\x12', (
+      ('field_1', 2),
+      ('_', 2),
+      ('field_2', 4),
+      ('field_3', 3),
+    ))
+    record = test_parser('\x00\x12\x01\x00\x99\x99\x02\x00\x00\x00abc', format = 'record')
+    self.assertTrue(isinstance(record, test_parser.record_type))
+    self.assertEqual(record, (1, 2, 'abc'))
+    self.assertEqual((record.field_1, record.field_2, record.field_3), (1, 2, 'abc'))
+    self.assertEqual(record._asdict(), {'field_1': 1, 'field_2': 2, 'field_3': 'abc'})
+    self.assertRaises(AttributeError, setattr, record, 'field_4', 4)
+  
+  def test_repeat(self):
+    test_parser = make_packet_parser('\x00\x12', (
+      ('length', 2),
+      ('field_1', 1),
+      ('field_2', (
+        ('field_3', 2),
+        ('_', 1),
+        ('field_4', 3),
+      )),
+      ('field_5', 2),
+    ))
+    record = test_parser('\x00\x12\x13\x00\x07\x01\x00\x99abc\x02\x00\x99def\x05\x00', format = 'record')
+    self.assertEqual(record.length, 19)
+    self.assertEqual(record.field_1, 7)
+    self.assertEqual(record.field_5, 5)
+    self.assertEqual([(r.field_3, r.field_4) for r in record.field_2], [(1, 'abc'), (2, 'def')])
+  
+  def test_variable(self):
+    test_parser = make_packet_parser('\x00\x12', (
+      ('length', 2),
+      ('field_1', 0),
+      ('_', 1),
+    ))
+    record = test_parser('\x00\x12\x08\x00abc\x00', format = 'record')
+    self.assertEqual(record, (8, 'abc'))
+  
+  def test_invalid(self):
+    test_parser = make_packet_parser('\x00\x12', (
+      ('field_1', 2),
+    ))
+    self.assertRaises(ParseError, test_parser, '\x00\x12\x00', format = 'record')
+
+class TestViewParsing(unittest.TestCase):
+  def setUp(self):
+    self.test_parser = make_packet_parser('\x00\x12', (
+      ('length', 2),
+      ('field_1', 1),
+      ('field_2', (
+        ('field_3', 2),
+        ('_', 1),
+        ('field_4', 3),
+      )),
+      ('field_5', 2),
+    ))
+    self.data = '\x00\x12\x13\x00\x07\x01\x00\x99abc\x02\x00\x99def\x05\x00'
+  
+  def test_matches_record(self):
+    for data in (self.data, memoryview(self.data), bytearray(self.data), list(self.data)):
+      view = self.test_parser(data, format = 'view')
+      record = self.test_parser(self.data, format = 'record')
+      self.assertEqual((view.length, view.field_1, view.field_5), (record.length, record.field_1, record.field_5))
+      self.assertEqual([(r.field_3, r.field_4) for r in view.field_2], [(r.field_3, r.field_4) for r in record.field_2])
+  
+  def test_repeat_index(self):
+    view = self.test_parser(memoryview(self.data), format = 'view')
+    self.assertEqual(len(view.field_2), 2)
+    self.assertEqual(view.field_2[1].field_4, 'def')
+    self.assertEqual(view.field_2[-2].field_3, 1)
+    self.assertRaises(IndexError, view.field_2.__getitem__, 2)
+  
+  def test_shares_buffer(self):
+    data = memoryview(self.data)
+    view = self.test_parser(data, format = 'view')
+    self.assertTrue(view[0] is data)
+    self.assertEqual(view._asdict()['field_1'], 7)
+  
+  def test_variable(self):
+    test_parser = make_packet_parser('\x00\x12', (
+      ('length', 2),
+      ('field_1', 0),
+      ('field_2', 1),
+    ))
+    view = test_parser(memoryview('\x00\x12\x08\x00abc\x04'), format = 'view')
+    self.assertEqual((view.length, view.field_1, view.field_2), (8, 'abc', 4))
+  
+  def test_invalid(self):
+    self.assertRaises(ParseError, self.test_parser, bytearray('\x00\x13\x04\x00\x07'), format = 'view')
+    self.assertRaises(ParseError, self.test_parser, memoryview('\x00\x12\x09\x00\x07\x01'), format = 'view')
+
 class TestValidParsing(unittest.TestCase):
   def do_parse_test(self, parser, cases, responses, chunks):
     for data, response, chunk in izip_longest(cases, responses, chunks):
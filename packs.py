@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+packs.py
+
+Streaming reader for the .packs hex dumps.
+
+A .packs file is a hex dump of captured Ethernet frames separated by
+blank lines, either as plain rows of hex bytes or as C arrays
+("char pkt20[] = {0x00, ...};"). Frames are read one at a time and
+unhexlified whole, and the TCP payload is found from the IP header length
+and TCP data offset of each frame instead of assuming 54 bytes of
+headers, so options and Ethernet padding are handled and a dump of any
+size is read in constant memory.
+
+  python packs.py convert testpacks.packs testpacks.cap
+"""
+
+import binascii
+import socket
+import struct
+import sys
+import unittest
+from framer import PacketFramer
+from packet import make_record_type
+
+ETHERNET = struct.Struct('!12xH')
+IPV4 = struct.Struct('!BxH5xB2x4s4s')
+PORTS = struct.Struct('!HH')
+
+ETH_IPV4 = 0x0800
+ETH_VLAN = 0x8100
+IP_TCP = 6
+
+#separators of both dump styles
+NOT_HEX = ' \t\r\n,{};'
+
+Segment = make_record_type('Segment', ('src', 'sport', 'dst', 'dport', 'payload'))
+
+def iter_frames(filename):
+  """
+  Generator of the raw bytes of every frame in a .packs file.
+  """
+  with open(filename) as f:
+    rows = []
+    for line in f:
+      if not line.strip():
+        if rows:
+          yield binascii.unhexlify(''.join(rows))
+          rows = []
+      elif '[' not in line:
+        rows.append(line.replace('0x', '').translate(None, NOT_HEX))
+    if rows:
+      yield binascii.unhexlify(''.join(rows))
+
+def parse_frame(frame):
+  """
+  Returns the Segment of a TCP over IPv4 Ethernet frame, or None for any
+  other frame.
+  """
+  if len(frame) < 14:
+    return None
+  offset, ethertype = 14, ETHERNET.unpack_from(frame)[0]
+  if ethertype == ETH_VLAN and len(frame) >= 18:
+    offset, ethertype = 18, ETHERNET.unpack_from(frame, 4)[0]
+  if ethertype != ETH_IPV4 or len(frame) < offset + IPV4.size:
+    return None
+
+  version_ihl, total_length, protocol, src, dst = IPV4.unpack_from(frame, offset)
+  if version_ihl >> 4 != 4 or protocol != IP_TCP:
+    return None
+
+  tcp = offset + (version_ihl & 0x0F) * 4
+  if len(frame) < tcp + 13:
+    return None
+  sport, dport = PORTS.unpack_from(frame, tcp)
+  payload = tcp + (ord(frame[tcp+12]) >> 4) * 4
+  #the IP total length leaves out any Ethernet padding
+  end = min(len(frame), offset + total_length)
+
+  return tuple.__new__(Segment, (socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport, frame[payload:end]))
+
+def iter_segments(filename):
+  """
+  Generator of the Segments with a payload in a .packs file.
+  """
+  for frame in iter_frames(filename):
+    segment = parse_frame(frame)
+    if segment is not None and segment.payload:
+      yield segment
+
+def iter_payloads(filename):
+  """
+  Generator of the TCP payloads of a .packs file, in capture order.
+  """
+  for segment in iter_segments(filename):
+    yield segment.payload
+
+def read_payload(filename):
+  return ''.join(iter_payloads(filename))
+
+def convert(filename, capture_filename, server_ports = None):
+  """
+  Converts a .packs dump into a capture file and returns the number of
+  packets written. Every TCP connection becomes a session, framed in each
+  direction. Segments from one of server_ports (by default, from the
+  lower port of the connection) are from the server. The dumps carry no
+  times, so every packet is stamped 0.0.
+  """
+  from capture import CaptureWriter
+  writer = CaptureWriter(capture_filename)
+  sessions, framers = {}, {}
+
+  for segment in iter_segments(filename):
+    if server_ports is not None:
+      from_server = segment.sport in server_ports
+    else:
+      from_server = segment.sport < segment.dport
+    sid = 'server' if from_server else 'client'
+    server_end = (segment.src, segment.sport) if from_server else (segment.dst, segment.dport)
+    client_end = (segment.dst, segment.dport) if from_server else (segment.src, segment.sport)
+
+    connection = (client_end, server_end)
+    if connection not in sessions:
+      sessions[connection] = len(sessions) + 1
+    if (connection, sid) not in framers:
+      framers[(connection, sid)] = PacketFramer()
+
+    data, offsets = framers[(connection, sid)].split(segment.payload)
+    for opcode, start, end in offsets:
+      writer.write(sessions[connection], sid, data[start:end], 0.0, opcode)
+
+  count = writer.count
+  writer.close()
+  return count
+
+class packs_reader(unittest.TestCase):
+  def test_frames(self):
+    frames = list(iter_frames('testpacks.packs'))
+    self.assertEqual(binascii.hexlify(frames[0][:14]), '0017f205c7ce001f90797be90800')
+    self.assertEqual(list(iter_frames('testpacks2.packs'))[:3], frames[:3])
+
+  def test_parse_frame(self):
+    segment = parse_frame(next(iter_frames('testpacks.packs')))
+    self.assertEqual(segment[:4], ('216.83.36.53', 5121, '192.168.1.5', 56448))
+    self.assertEqual(segment.payload, '\x7f\x00\xb0\xc5\xe5\x0c')
+
+  def test_padding_and_options(self):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + 24 + 2, 0, 0, 64, IP_TCP, 0, '\x0a\x00\x00\x01', '\x0a\x00\x00\x02')
+    tcp = struct.pack('!HHIIBBHHH', 5121, 40000, 0, 0, 6 << 4, 0x18, 0, 0, 0) + '\x01\x01\x01\x00'
+    frame = '\x00' * 12 + '\x08\x00' + ip + tcp + '\x66\x00' + '\x00' * 6
+    self.assertEqual(parse_frame(frame).payload, '\x66\x00')
+    self.assertEqual(parse_frame('\x00' * 12 + '\x08\x06' + '\x00' * 28), None)
+
+  def test_convert(self):
+    import os, shutil, tempfile
+    from capture import CaptureReader
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'testpacks.cap')
+      count = convert('testpacks.packs', filename)
+      reader = CaptureReader(filename)
+      self.assertEqual(len(reader), count)
+      self.assertEqual((reader[0].direction, reader[0].opcode), ('server', 0x007F))
+      self.assertEqual(set(packet.direction for packet in reader), set(['server']))
+      framed = ''.join(packet.payload for packet in reader)
+      self.assertTrue(len(framed) > 20000)
+      self.assertTrue(read_payload('testpacks.packs').startswith(framed))
+      reader.close()
+    finally:
+      shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  if sys.argv[1:2] == ['convert'] and len(sys.argv) == 4:
+    print "Wrote %d packets" % convert(sys.argv[2], sys.argv[3])
+  else:
+    unittest.main()
@@ -1,4 +1,4 @@
-from packet import make_packet_parser
+from packet import make_packet_parser, make_packet_builder
 login_response_parser = make_packet_parser('\x69\x00', (
   ('length', 2),
   ('l_id1', 4),
@@ -67,4 +67,20 @@ map_login_parser = make_packet_parser('\x71\x00', (
   ('map_name', 16),
   ('ip', 4),
   ('port', 2),
-))
\ No newline at end of file
+))
+login_request_builder = make_packet_builder('\x64\x00', (
+  ('version', 4),
+  ('username', 24),
+  ('password', 24),
+  ('client_type', 1),
+))
+char_connect_builder = make_packet_builder('\x65\x00', (
+  ('a_id', 4),
+  ('l_id1', 4),
+  ('l_id2', 4),
+  ('_', 2),
+  ('sex', 1),
+))
+char_select_builder = make_packet_builder('\x66\x00', (
+  ('slot', 1),
+))
@@ -1,23 +1,123 @@
+import socket
+import struct
+import time
+import unittest
+from collections import deque
+from framer import PacketFramer
+
 class FIFOBuffer(object):
-  def __init__(self):
-    self.buffer = ''
+  """
+  Queue of bytes kept as the appended segments plus an offset into the
+  first one, so consuming sent bytes never copies what is left.
+  
+  With a high watermark the buffer reports itself full once it holds more
+  than high_water bytes and stays full until it drains to low_water.
+  
+  peak is the most bytes ever queued. Setting latency to a Histogram
+  times every appended segment until its last byte is popped.
+  """
+  def __init__(self, high_water = None, low_water = None, coalesce = 65536):
+    self.segments = deque()
+    self.offset = 0
+    self.size = 0
+    self.peak = 0
+    self.latency = None
+    self.appended = self.popped = 0
+    self.marks = deque()
+    self.high_water = high_water
+    self.low_water = high_water // 2 if low_water is None and high_water is not None else low_water
+    self.coalesce = coalesce
+    self.full = False
     
   def append(self, data):
-    self.buffer += data
+    if not data:
+      return
+    self.segments.append(memoryview(data))
+    self.size += len(data)
+    if self.size > self.peak:
+      self.peak = self.size
+    if self.high_water is not None and self.size > self.high_water:
+      self.full = True
+    
+    if self.latency is not None:
+      self.appended += len(data)
+      self.marks.append((self.appended, time.time()))
   
   def pop(self, bytes):
-    self.buffer = self.buffer[bytes:]
+    bytes = popped = min(bytes, self.size)
+    self.size -= bytes
+    while bytes:
+      left = len(self.segments[0]) - self.offset
+      if bytes >= left:
+        self.segments.popleft()
+        self.offset = 0
+        bytes -= left
+      else:
+        self.offset += bytes
+        bytes = 0
+    
+    if self.full and self.size <= self.low_water:
+      self.full = False
+    
+    if self.marks:
+      self.popped += popped
+      now, marks = time.time(), self.marks
+      while marks and marks[0][0] <= self.popped:
+        self.latency.add(now - marks.popleft()[1])
   
   def get(self):
-    return self.buffer
+    """
+    Returns the data at the front of the buffer: the rest of the first
+    segment, joined with the following ones up to coalesce bytes when it
+    is small.
+    """
+    if not self.segments:
+      return ''
+    
+    head = self.segments[0][self.offset:]
+    if len(self.segments) == 1 or len(head) >= self.coalesce:
+      return head
+    
+    data = bytearray(head)
+    for segment in self.segments:
+      if segment is self.segments[0]:
+        continue
+      if len(data) >= self.coalesce:
+        break
+      data += segment[:self.coalesce - len(data)]
+    return data
+  
+  def get_segments(self, limit = 64):
+    """
+    Returns up to limit of the pending segments, the first one starting at
+    the current offset, for a gathering write.
+    """
+    segments = []
+    for segment in self.segments:
+      if len(segments) >= limit:
+        break
+      segments.append(segment)
+    if segments and self.offset:
+      segments[0] = segments[0][self.offset:]
+    return segments
+  
+  def is_full(self):
+    return self.full
   
   def __len__(self):
-    return len(self.buffer)
+    return self.size
 
 class DataProcessor(object):
+  #bytes queued towards one side before reading from the other side stops
+  high_water = 256 * 1024
+  low_water = 64 * 1024
+  
   def __init__(self):
     #We have a client and a server
-    self.buffers = {'client': FIFOBuffer(), 'server': FIFOBuffer()}
+    self.buffers = {
+      'client': FIFOBuffer(self.high_water, self.low_water),
+      'server': FIFOBuffer(self.high_water, self.low_water),
+    }
   
   def other(self, sid):
     return {'server':'client', 'client':'server'}[sid]
@@ -29,11 +129,26 @@ class DataProcessor(object):
   def get_data(self, sid):
     return self.buffers[sid].get()
   
+  def get_segments(self, sid):
+    return self.buffers[sid].get_segments()
+  
   def sent_bytes_event(self, sid, bytes):
     self.buffers[sid].pop(bytes)
   
   def is_writable(self, sid):
     return (len(self.buffers[sid]) > 0)
+  
+  def is_readable(self, sid):
+    #stop reading from sid while the other side is backed up
+    return not self.buffers[self.other(sid)].is_full()
+  
+  def instrument(self, session):
+    """
+    Records queue depths and read to write latency into a SessionStats.
+    """
+    session.buffers = self.buffers
+    for buf in self.buffers.values():
+      buf.latency = session.latency
 
 class EchoProcessor(DataProcessor):
   def read_event(self, sid, data):
@@ -51,3 +166,268 @@ def SimpleReplacerFactory(mappings):
       self.buffers[self.other(sid)].append(data)
       
   return SimpleReplacerProcessor
+
+class PacketProcessor(DataProcessor):
+  """
+  Frames both directions with the packet table and only hands packets
+  whose opcode has a handler to it. Runs of other packets are queued as
+  slices of the recv they arrived in, without being looked at.
+  
+  handlers maps an opcode to handler(sid, packet), called with the side
+  the packet came from and a memoryview of the whole packet. It returns
+  the data to forward instead, e.g. the packet itself or a rewritten copy.
+  
+  The first server_prefix bytes from the server are forwarded raw before
+  anything is framed. The char server sends the 4 byte account id that
+  way ahead of 0x006B, so char server sessions need server_prefix = 4.
+  """
+  handlers = {}
+  server_prefix = 0
+  
+  def __init__(self):
+    DataProcessor.__init__(self)
+    self.framers = {'client': PacketFramer(), 'server': PacketFramer()}
+    self.raw = {'client': 0, 'server': self.server_prefix}
+    self.opcodes = None
+  
+  def instrument(self, session):
+    DataProcessor.instrument(self, session)
+    self.opcodes = session.opcodes
+  
+  def read_event(self, sid, data):
+    raw = self.raw[sid]
+    if raw:
+      self.raw[sid] = max(0, raw - len(data))
+      self.buffers[self.other(sid)].append(data[:raw])
+      data = data[raw:]
+    
+    data, offsets = self.framers[sid].split(data)
+    if not offsets:
+      return
+    
+    if self.opcodes is not None:
+      opcodes = self.opcodes
+      for opcode, _, _ in offsets:
+        opcodes[opcode] = opcodes.get(opcode, 0) + 1
+    
+    buf, handlers = self.buffers[self.other(sid)], self.handlers
+    view, run = memoryview(data), 0
+    for opcode, start, end in offsets:
+      handler = handlers.get(opcode)
+      if handler is not None:
+        if start > run:
+          buf.append(view[run:start])
+        buf.append(handler(sid, view[start:end]))
+        run = end
+    
+    end = offsets[-1][2]
+    if end > run:
+      buf.append(view[run:end])
+
+def PacketProcessorFactory(handlers, server_prefix = 0):
+  class HandlingPacketProcessor(PacketProcessor):
+    pass
+  HandlingPacketProcessor.handlers = dict(handlers)
+  HandlingPacketProcessor.server_prefix = server_prefix
+  return HandlingPacketProcessor
+
+def rewrite_address(buf, offset, mappings):
+  """
+  Replaces the 4 byte ip and little endian port at offset in buf if they
+  are in mappings. Returns True if they were.
+  """
+  address = (socket.inet_ntoa(str(buf[offset:offset+4])), struct.unpack_from('<H', buf, offset + 4)[0])
+  if address not in mappings:
+    return False
+  ip, port = mappings[address]
+  buf[offset:offset+4] = socket.inet_aton(ip)
+  struct.pack_into('<H', buf, offset + 4, port)
+  return True
+
+def address_handlers(mappings):
+  """
+  PacketProcessor handlers pointing the char servers listed in 0x0069 and
+  the map server in 0x0071 somewhere else. mappings is a dict of
+  (ip, port): (ip, port) with dotted quad ips, e.g. to our own listeners.
+  Packets without a mapped address are forwarded untouched. Sessions with
+  the char server, where 0x0071 comes from, need a server_prefix of 4.
+  """
+  import parsers
+  login_layout, map_layout = parsers.login_response_parser.layout, parsers.map_login_parser.layout
+  
+  def offset(offsets, ip, port):
+    #the rewrite writes the ip and port as one 6 byte block
+    if offsets[port][0] != offsets[ip][0] + 4:
+      raise ValueError('Port does not follow ip')
+    return offsets[ip][0]
+  
+  servers_start = login_layout.start + login_layout.head_size
+  server_offset = offset(login_layout.repeat_offsets, 'ip', 'port')
+  map_offset = offset(map_layout.head_offsets, 'ip', 'port')
+  
+  def login_response(sid, packet):
+    buf, rewritten = bytearray(packet), False
+    for start in xrange(servers_start, len(buf) - login_layout.repeat_size + 1, login_layout.repeat_size):
+      rewritten |= rewrite_address(buf, start + server_offset, mappings)
+    return buf if rewritten else packet
+  
+  def map_login(sid, packet):
+    buf = bytearray(packet)
+    return buf if rewrite_address(buf, map_offset, mappings) else packet
+  
+  return {0x0069: login_response, 0x0071: map_login}
+
+class fifo_buffer(unittest.TestCase):
+  def test_append_pop(self):
+    buf = FIFOBuffer()
+    buf.append('test')
+    buf.append('data')
+    self.assertEqual(len(buf), 8)
+    self.assertEqual(memoryview(buf.get()).tobytes(), 'testdata')
+    buf.pop(3)
+    self.assertEqual(memoryview(buf.get()).tobytes(), 'tdata')
+    buf.pop(3)
+    self.assertEqual(memoryview(buf.get()).tobytes(), 'ta')
+    buf.pop(2)
+    self.assertEqual(len(buf), 0)
+    self.assertEqual(buf.get(), '')
+  
+  def test_coalesce(self):
+    buf = FIFOBuffer(coalesce = 6)
+    for data in ('ab', 'cd', 'ef', 'gh'):
+      buf.append(data)
+    self.assertEqual(memoryview(buf.get()).tobytes(), 'abcdef')
+    buf.pop(5)
+    self.assertEqual(memoryview(buf.get()).tobytes(), 'fgh')
+  
+  def test_no_copy(self):
+    buf = FIFOBuffer()
+    buf.append('x' * 100)
+    buf.pop(10)
+    self.assertTrue(isinstance(buf.get(), memoryview))
+    self.assertEqual(len(buf.get()), 90)
+  
+  def test_segments(self):
+    buf = FIFOBuffer()
+    self.assertEqual(buf.get_segments(), [])
+    for data in ('ab', 'cd', 'ef', 'gh'):
+      buf.append(data)
+    buf.pop(3)
+    self.assertEqual([segment.tobytes() for segment in buf.get_segments()], ['d', 'ef', 'gh'])
+    self.assertEqual([segment.tobytes() for segment in buf.get_segments(2)], ['d', 'ef'])
+    buf.pop(5)
+    self.assertEqual(buf.get_segments(), [])
+  
+  def test_watermarks(self):
+    buf = FIFOBuffer(high_water = 10, low_water = 4)
+    buf.append('x' * 10)
+    self.assertFalse(buf.is_full())
+    buf.append('x')
+    self.assertTrue(buf.is_full())
+    buf.pop(6)
+    self.assertTrue(buf.is_full())
+    buf.pop(1)
+    self.assertFalse(buf.is_full())
+  
+  def test_peak_and_latency(self):
+    from stats import Histogram
+    buf = FIFOBuffer()
+    buf.latency = Histogram()
+    buf.append('abc')
+    buf.append('de')
+    buf.pop(2)
+    self.assertEqual(buf.latency.total, 0)
+    buf.pop(2)
+    self.assertEqual(buf.latency.total, 1)
+    buf.append('f')
+    buf.pop(2)
+    self.assertEqual(buf.latency.total, 3)
+    self.assertEqual(buf.peak, 5)
+  
+  def test_processor_backpressure(self):
+    processor = DataProcessor()
+    processor.read_event('server', 'x' * (processor.high_water + 1))
+    self.assertFalse(processor.is_readable('server'))
+    self.assertTrue(processor.is_readable('client'))
+    processor.sent_bytes_event('client', processor.high_water)
+    self.assertTrue(processor.is_readable('server'))
+
+class packet_processor(unittest.TestCase):
+  def pending(self, processor, sid):
+    return ''.join(segment.tobytes() for segment in processor.get_segments(sid))
+  
+  def test_passthrough(self):
+    processor = PacketProcessor()
+    data = '\x66\x00\x00\x6b\x00\x0a\x00\x11\x22\x33\x44\x55\x66\x66\x00'
+    processor.read_event('client', data[:5])
+    processor.read_event('client', data[5:])
+    self.assertEqual(self.pending(processor, 'server'), data[:13])
+    self.assertEqual(len(processor.buffers['server'].segments), 2)
+    processor.read_event('client', '\x00')
+    self.assertEqual(self.pending(processor, 'server'), data + '\x00')
+  
+  def test_handler(self):
+    seen = []
+    def handler(sid, packet):
+      seen.append((sid, packet.tobytes()))
+      return 'XYZ'
+    
+    processor = PacketProcessorFactory({0x0066: handler})()
+    processor.read_event('server', '\x00\x00\x66\x00\x01\x00\x00')
+    self.assertEqual(seen, [('server', '\x66\x00\x01')])
+    self.assertEqual(self.pending(processor, 'client'), '\x00\x00XYZ\x00\x00')
+  
+  def test_opcode_counts(self):
+    from stats import SessionStats
+    processor, session = PacketProcessor(), SessionStats()
+    processor.instrument(session)
+    processor.read_event('client', '\x66\x00\x00\x66\x00\x00\x00\x00')
+    self.assertEqual(session.opcodes, {0x0066: 2, 0x0000: 1})
+  
+  def test_map_login(self):
+    processor = PacketProcessorFactory(address_handlers({('10.0.0.1', 5121): ('127.0.0.1', 7000)}))()
+    packet = '\x71\x00' + 'A' * 4 + 'prontera.gat'.ljust(16, '\x00') + socket.inet_aton('10.0.0.1') + struct.pack('<H', 5121)
+    processor.read_event('server', packet)
+    rewritten = self.pending(processor, 'client')
+    self.assertEqual(rewritten[:22], packet[:22])
+    self.assertEqual(rewritten[22:], socket.inet_aton('127.0.0.1') + struct.pack('<H', 7000))
+  
+  def test_login_response(self):
+    processor = PacketProcessorFactory(address_handlers({('10.0.0.2', 6121): ('127.0.0.1', 6121)}))()
+    
+    def server(ip, port):
+      return socket.inet_aton(ip) + struct.pack('<H', port) + 'Server'.ljust(20, '\x00') + '\x00' * 6
+    
+    servers = server('10.0.0.9', 6121) + server('10.0.0.2', 6121)
+    packet = '\x69\x00' + struct.pack('<H', 47 + len(servers)) + '\x01' * 43 + servers
+    processor.read_event('server', packet)
+    rewritten = self.pending(processor, 'client')
+    self.assertEqual(rewritten[:79], packet[:79])
+    self.assertEqual(rewritten[79:85], socket.inet_aton('127.0.0.1') + struct.pack('<H', 6121))
+    self.assertEqual(rewritten[85:], packet[85:])
+    
+    processor.read_event('server', '\x69\x00' + struct.pack('<H', 79) + '\x01' * 43 + server('10.0.0.9', 6121))
+    self.assertTrue(isinstance(processor.buffers['client'].segments[-1], memoryview))
+  
+  def test_char_server_prefix(self):
+    mappings = {('10.0.0.1', 5121): ('127.0.0.1', 7000)}
+    processor = PacketProcessorFactory(address_handlers(mappings), server_prefix = 4)()
+    #account id 2031716 starts with the bytes of 0x0064, a 55 byte packet
+    account_id = struct.pack('<I', 2031716)
+    characters = '\x6b\x00' + struct.pack('<H', 27) + '\x00' * 23
+    map_login = '\x71\x00' + 'A' * 4 + 'prontera.gat'.ljust(16, '\x00') + socket.inet_aton('10.0.0.1') + struct.pack('<H', 5121)
+    processor.read_event('server', account_id[:3])
+    processor.read_event('server', account_id[3:] + characters)
+    processor.read_event('server', map_login)
+    rewritten = self.pending(processor, 'client')
+    self.assertEqual(rewritten[:-6], account_id + characters + map_login[:22])
+    self.assertEqual(rewritten[-6:], socket.inet_aton('127.0.0.1') + struct.pack('<H', 7000))
+    
+    
+    #framed from the first byte, 0x0064 swallows 0x006B and the head of 0x0071
+    processor = PacketProcessorFactory(address_handlers(mappings))()
+    processor.read_event('server', account_id + characters + map_login)
+    self.assertFalse(socket.inet_aton('127.0.0.1') in self.pending(processor, 'client'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+profiler.py
+
+Per opcode profile of proxied traffic.
+
+ProfilingProcessorFactory(profile, processor) makes a processor class that
+behaves as processor and frames both directions of every session into an
+OpcodeProfile. A PacketProcessor's own framers are reused, so its packets
+are framed once. Other processors are only framed during a profiled
+burst, picking the stream up at the first packet boundary find_boundary()
+finds in the burst. For every direction and opcode the profile counts
+packets and bytes, the gaps between them and the time spent in their
+handlers, and the time of each read in the processor. All of it is
+sampled, in bursts of reads; only the bytes read from each side are
+counted on every read.
+
+Measured on the bundled captures, profiling adds a little over 1us to
+every read of a DataProcessor, 60-70% of what the read costs it as it
+does nothing else with the data, and about 2.5us (15%) to the 1024 byte
+reads of a PacketProcessor and 2-6% to its 8192 byte ones. Most of it
+is the Python calls wrapping every read, not the sampled framing.
+
+report() is the top opcodes as a table, dump() writes the whole profile
+as sorted JSON so two runs can be diffed, or compared with:
+
+  python profiler.py compare before.json after.json
+"""
+
+import json
+import os
+import sys
+import time
+import unittest
+from framer import PacketFramer, find_boundary
+from processor import DataProcessor
+from stats import Histogram
+
+SIDES = ('client', 'server')
+
+class OpcodeProfile(object):
+  """
+  Counters keyed by (side the packets came from, opcode), shared by every
+  session of a processor class.
+
+  Reads are profiled in bursts of burst consecutive reads, one burst in
+  sample_every, counted over the reads of every session. Gaps between
+  packets of an opcode are measured within a burst and within one
+  session, from the last times record() is passed for it. Per opcode
+  counts and bytes are of the profiled reads only and scaled up by reads
+  per profiled read; the bytes read from each side are counted exactly.
+  """
+  def __init__(self, sample_every = 256, burst = 16):
+    self.sample_every, self.burst = sample_every, burst
+    self.started = time.time()
+    self.reads = self.sampled_reads = 0
+    self.window = None
+    self.sampled = False
+    self.read_bytes = dict((sid, 0) for sid in SIDES)
+    self.counts = {}
+    self.bytes = {}
+    self.last = {}
+    self.intervals = {}
+    self.handler_time = {}
+    self.read_time = dict((sid, Histogram()) for sid in SIDES)
+
+  def start_read(self, sid, size):
+    """
+    Counts a read and returns whether it is profiled.
+    """
+    window = self.reads // self.burst
+    self.reads += 1
+    self.read_bytes[sid] += size
+    self.sampled = window % self.sample_every == 0
+    if self.sampled:
+      self.window = window
+      self.sampled_reads += 1
+    return self.sampled
+
+  def scale(self):
+    """
+    Estimated reads per profiled read.
+    """
+    return float(self.reads) / self.sampled_reads if self.sampled_reads else 1.0
+
+  def record(self, sid, offsets, last = None):
+    """
+    Counts the packets framed from a profiled read. last is the session's
+    own dict of when each of its opcodes was last seen, shared by every
+    caller if not given.
+    """
+    counts, sizes, window = self.counts, self.bytes, self.window
+    if last is None:
+      last = self.last
+    now = time.time()
+    for opcode, start, end in offsets:
+      key = (sid, opcode)
+      if key in counts:
+        counts[key] += 1
+        sizes[key] += end - start
+        seen = last.get(key)
+        if seen is not None and seen[1] == window:
+          self.intervals[key].add(now - seen[0])
+      else:
+        counts[key], sizes[key] = 1, end - start
+        self.intervals[key], self.handler_time[key] = Histogram(), Histogram()
+      last[key] = (now, window)
+
+  def timed_handler(self, opcode, handler):
+    """
+    Wraps a PacketProcessor handler to time its sampled calls.
+    """
+    def timed(sid, packet):
+      if not self.sampled:
+        return handler(sid, packet)
+      start = time.time()
+      try:
+        return handler(sid, packet)
+      finally:
+        self.handler_time[(sid, opcode)].add(time.time() - start)
+    return timed
+
+  def rows(self):
+    total = max(sum(self.bytes.values()), 1)
+    scale = self.scale()
+    rows = []
+    for key in self.counts:
+      sid, opcode = key
+      rows.append({
+        'side': sid,
+        'opcode': '0x%04X' % opcode,
+        'count': int(round(self.counts[key] * scale)),
+        'bytes': int(round(self.bytes[key] * scale)),
+        'sampled': self.counts[key],
+        'share': float(self.bytes[key]) / total,
+        'interval': self.intervals[key].as_dict(),
+        'handler': self.handler_time[key].as_dict(),
+      })
+    return rows
+
+  def as_dict(self):
+    elapsed = max(time.time() - self.started, 1e-6)
+    return {
+      'elapsed': elapsed,
+      'reads': self.reads,
+      'sampled_reads': self.sampled_reads,
+      'sample_every': self.sample_every,
+      'burst': self.burst,
+      'read_bytes': dict(self.read_bytes),
+      'packets': int(round(sum(self.counts.values()) * self.scale())),
+      'read_time': dict((sid, histogram.as_dict()) for sid, histogram in self.read_time.items()),
+      'opcodes': dict(('%s %s' % (row['side'], row['opcode']), row) for row in self.rows()),
+    }
+
+  def report(self, top = 10, key = 'bytes'):
+    """
+    Returns the top opcodes by key ('bytes', 'count' or 'handler', the
+    sampled handler time) as lines of text.
+    """
+    rows = self.rows()
+    if key == 'handler':
+      rows.sort(key = lambda row: row['handler']['mean'] * row['count'], reverse = True)
+    else:
+      rows.sort(key = lambda row: row[key], reverse = True)
+
+    elapsed = max(time.time() - self.started, 1e-6)
+    lines = ['~%d packets, %d bytes in %.1fs, %d of %d reads profiled' % (
+      sum(self.counts.values()) * self.scale(), sum(self.read_bytes.values()), elapsed, self.sampled_reads, self.reads)]
+    lines.append('%-6s %-6s %9s %11s %6s %10s %10s' % ('side', 'opcode', 'count', 'bytes', 'share', 'gap p50', 'handler'))
+    for row in rows[:top]:
+      lines.append('%-6s %-6s %9d %11d %5.1f%% %9.0fus %9.1fus' % (
+        row['side'], row['opcode'], row['count'], row['bytes'], row['share'] * 100,
+        row['interval']['p50'] * 1e6, row['handler']['mean'] * 1e6))
+    return '\n'.join(lines)
+
+  def dump(self, filename):
+    """
+    Writes the profile to filename, replacing the previous one.
+    """
+    with open(filename + '.tmp', 'w') as f:
+      json.dump(self.as_dict(), f, indent = 2, sort_keys = True)
+    os.rename(filename + '.tmp', filename)
+
+def compare(before, after, top = 10, out = sys.stdout):
+  """
+  Prints the opcodes whose share of the bytes changed most between two
+  dumps.
+  """
+  keys = set(before['opcodes']) | set(after['opcodes'])
+  share = lambda dump, key: dump['opcodes'][key]['share'] if key in dump['opcodes'] else 0.0
+  changes = sorted(((share(after, key) - share(before, key), key) for key in keys), key = lambda change: abs(change[0]), reverse = True)
+  for change, key in changes[:top]:
+    out.write('%-14s %5.1f%% -> %5.1f%% (%+.1f)\n' % (key, share(before, key) * 100, share(after, key) * 100, change * 100))
+  return changes[:top]
+
+def ProfilingProcessorFactory(profile, processor = DataProcessor):
+  """
+  Makes a processor class that profiles into profile and otherwise
+  behaves as processor.
+  """
+  class ProfilingProcessor(processor):
+    def __init__(self):
+      processor.__init__(self)
+      self.profile_last = {}
+      framers = getattr(self, 'framers', None)
+      if framers is not None:
+        #split() is wrapped so the processor's own framing is counted
+        self.profile_framers = None
+        for sid, framer in framers.items():
+          framer.split = self.recording_split(sid, framer.split)
+      else:
+        #None while out of step with the stream
+        self.profile_framers = dict((sid, None) for sid in SIDES)
+
+    def recording_split(self, sid, split):
+      def recorded(data):
+        framed = split(data)
+        if profile.sampled:
+          profile.record(sid, framed[1], self.profile_last)
+        return framed
+      return recorded
+
+    def profile_read(self, sid, data):
+      framer = self.profile_framers[sid]
+      if framer is None:
+        #reads since the last burst were not framed, start over at a packet boundary
+        start = find_boundary(data)
+        if start is None:
+          return
+        framer = self.profile_framers[sid] = PacketFramer()
+        data = data[start:]
+      profile.record(sid, framer.split(data)[1], self.profile_last)
+
+    def read_event(self, sid, data):
+      sampled = profile.start_read(sid, len(data))
+      if self.profile_framers is not None:
+        if sampled:
+          self.profile_read(sid, data)
+        else:
+          self.profile_framers[sid] = None
+      if not sampled:
+        return processor.read_event(self, sid, data)
+
+      start = time.time()
+      processor.read_event(self, sid, data)
+      profile.read_time[sid].add(time.time() - start)
+
+  handlers = getattr(processor, 'handlers', None)
+  if handlers is not None:
+    ProfilingProcessor.handlers = dict((opcode, profile.timed_handler(opcode, handler)) for opcode, handler in handlers.items())
+  return ProfilingProcessor
+
+class opcode_profile(unittest.TestCase):
+  def test_data_processor(self):
+    profile = OpcodeProfile(sample_every = 1, burst = 2)
+    processor = ProfilingProcessorFactory(profile)()
+    processor.read_event('client', '\x66\x00\x01\x8e\x00')
+    processor.read_event('client', '\x0c\x00Warped.\x00\x66\x00\x02')
+    processor.read_event('server', '\x7f\x00\x00\x00\x00\x00')
+    self.assertEqual(len(processor.buffers['server']), 18)
+    self.assertEqual(profile.counts, {('client', 0x0066): 2, ('client', 0x008E): 1, ('server', 0x007F): 1})
+    self.assertEqual(profile.bytes[('client', 0x008E)], 12)
+    self.assertEqual(profile.intervals[('client', 0x0066)].total, 1)
+    self.assertEqual(profile.read_time['client'].total, 2)
+
+  def test_data_processor_resync(self):
+    profile = OpcodeProfile(sample_every = 2, burst = 1)
+    processor = ProfilingProcessorFactory(profile)()
+    processor.read_event('client', '\x66\x00\x01')
+    processor.read_event('client', '\x7f\x00\x00')
+    self.assertEqual(processor.profile_framers['client'], None)
+    processor.read_event('client', '\x00\x00\x00\x66\x00\x02\x8e')
+    self.assertEqual(profile.counts, {('client', 0x0066): 2})
+    self.assertEqual(processor.profile_framers['client'].pending(), 1)
+    self.assertEqual(len(processor.buffers['server']), 13)
+
+  def test_gaps_per_session(self):
+    profile = OpcodeProfile(sample_every = 1, burst = 8)
+    factory = ProfilingProcessorFactory(profile)
+    first, second = factory(), factory()
+    first.read_event('server', '\x7f\x00\x00\x00\x00\x00')
+    second.read_event('server', '\x7f\x00\x00\x00\x00\x00')
+    self.assertEqual(profile.intervals[('server', 0x007F)].total, 0)
+    first.read_event('server', '\x7f\x00\x00\x00\x00\x00')
+    self.assertEqual(profile.intervals[('server', 0x007F)].total, 1)
+    self.assertEqual(profile.counts[('server', 0x007F)], 3)
+
+  def test_packet_processor(self):
+    from processor import PacketProcessorFactory
+    calls = []
+    def handler(sid, packet):
+      calls.append(packet.tobytes())
+      return packet
+    profile = OpcodeProfile(sample_every = 2, burst = 1)
+    processor = ProfilingProcessorFactory(profile, PacketProcessorFactory({0x0066: handler}))()
+    for _ in xrange(4):
+      processor.read_event('client', '\x66\x00\x01\x7f\x00\x00\x00\x00\x00')
+    self.assertEqual(len(calls), 4)
+    self.assertEqual(profile.counts[('client', 0x0066)], 2)
+    self.assertEqual(profile.read_bytes['client'], 36)
+    self.assertEqual(profile.handler_time[('client', 0x0066)].total, 2)
+    self.assertEqual(profile.handler_time[('client', 0x007F)].total, 0)
+    self.assertEqual(len(processor.buffers['server']), 36)
+
+  def test_report_and_dump(self):
+    import shutil, tempfile
+    profile = OpcodeProfile(sample_every = 1, burst = 1)
+    profile.start_read('server', 38)
+    profile.record('server', [(0x0086, 0, 16), (0x0086, 16, 32), (0x007F, 32, 38)])
+    lines = profile.report(top = 1).splitlines()
+    self.assertEqual(len(lines), 3)
+    self.assertTrue(lines[2].startswith('server 0x0086         2          32'))
+
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'profile.json')
+      profile.dump(filename)
+      with open(filename) as f:
+        before = json.load(f)
+    finally:
+      shutil.rmtree(directory)
+    self.assertEqual(before['opcodes']['server 0x007F']['count'], 1)
+
+    profile.record('server', [(0x007F, 0, 6)] * 10)
+    class Null(object):
+      def write(self, data):
+        pass
+    changes = dict((key, change) for change, key in compare(before, profile.as_dict(), 2, Null()))
+    self.assertTrue(changes['server 0x007F'] > 0 > changes['server 0x0086'])
+
+if __name__ == '__main__':
+  if sys.argv[1:2] == ['compare'] and len(sys.argv) == 4:
+    with open(sys.argv[2]) as f:
+      before = json.load(f)
+    with open(sys.argv[3]) as f:
+      after = json.load(f)
+    compare(before, after)
+  else:
+    unittest.main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+registry.py
+
+Opcode dispatched packet parsers.
+
+Specs are read from the hand_parsed.txt notation:
+
+  unit move   8600 4:id 5:p_delta 1:88 4:tick
+  pos list    6601 2:len {4:pos_num 28:pos_name}
+  norm msg    8e00 2:len .:message 1:00
+
+The opcode is written as it appears on the wire (little endian). A leading
+2:len is the length field, {...} is a repeated record, '.' is the variable
+width field, and fields named '_', '??' or by a hex constant of their own
+width ('1:88', '2:0000') are not captured. Parsers are only compiled the
+first time their opcode is parsed.
+
+parse_stream() decodes a whole stream of recvs at once: runs of the same
+fixed size opcode are decoded together into columns, with numpy when it
+is installed.
+"""
+
+import re
+import struct
+import unittest
+from packet import make_packet_parser, make_record_type, ParseError, INT_CODES
+from framer import load_packet_table, opcode_header, PacketFramer, VARIABLE
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+Batch = make_record_type('Batch', ('opcode', 'count', 'columns', 'raw'))
+
+def group_dtype(layout):
+  """
+  numpy dtype of one fixed size packet: 1, 2 and 4 byte fields as little
+  endian unsigned ints, other fields as arrays of bytes.
+  """
+  names, formats, offsets = [], [], []
+  for name, (offset, bytes) in sorted(layout.head_offsets.items(), key = lambda item: item[1]):
+    names.append(name)
+    formats.append('<u%d' % bytes if bytes in INT_CODES else ('u1', (bytes,)))
+    offsets.append(offset)
+  return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': layout.size})
+
+def decode_group(layout, data, start, count, dtype = None):
+  """
+  Decodes count back to back packets of a fixed size layout in data into
+  a dict of columns, numpy arrays with a dtype or tuples otherwise.
+  """
+  if dtype is not None:
+    packets = numpy.frombuffer(data, dtype, count, start)
+    return dict((name, packets[name]) for name in dtype.names)
+
+  unpack_from, size = layout.head_record_struct.unpack_from, layout.size
+  rows = [unpack_from(data, offset) for offset in xrange(start + 2, start + 2 + count * size, size)]
+  return dict(zip(layout.head_names, zip(*rows)))
+
+def parse_field(token):
+  size, name = token.split(':', 1)
+  size = 0 if size == '.' else int(size)
+  if name == '??' or (re.match('^[0-9a-fA-F]+$', name) and len(name) == 2 * size):
+    name = '_'
+  return name, size
+
+def parse_line(line):
+  """
+  Parses one hand_parsed.txt line into (name, opcode, data_spec).
+  """
+  tokens = line.split()
+  for index, token in enumerate(tokens):
+    if re.match('^[0-9a-fA-F]{4}$', token):
+      break
+  else:
+    raise ParseError('No opcode in line: %r' % line)
+
+  name, opcode = ' '.join(tokens[:index]), int(token[2:4] + token[0:2], 16)
+
+  data_spec, repeat = [], None
+  for token in tokens[index+1:]:
+    if token.startswith('{'):
+      repeat, token = [], token[1:]
+    closes = token.endswith('}')
+    field = parse_field(token.rstrip('}'))
+
+    if repeat is not None:
+      repeat.append(field)
+      if closes:
+        data_spec.append(('records', tuple(repeat)))
+        repeat = None
+    else:
+      data_spec.append(field)
+
+  if data_spec and data_spec[0] == ('len', 2):
+    data_spec[0] = ('length', 2)
+
+  return name, opcode, tuple(data_spec)
+
+def read_specs(filename = 'hand_parsed.txt'):
+  """
+  Generator of (name, opcode, data_spec) for every entry above the staging
+  section of a hand_parsed.txt file.
+  """
+  with open(filename) as f:
+    for line in f:
+      if line.startswith('---'):
+        break
+      if line.strip():
+        yield parse_line(line)
+
+class ParserRegistry(object):
+  def __init__(self):
+    self.specs = {}
+    self.names = {}
+    self.parsers = {}
+
+  def register_spec(self, opcode, data_spec, name = None):
+    self.specs[opcode] = data_spec
+    self.names[opcode] = name
+    self.parsers.pop(opcode, None)
+
+  def register_parser(self, opcode, parser, name = None):
+    self.names[opcode] = name
+    self.parsers[opcode] = parser
+
+  def load(self, filename = 'hand_parsed.txt'):
+    for name, opcode, data_spec in read_specs(filename):
+      self.register_spec(opcode, data_spec, name)
+
+  def __contains__(self, opcode):
+    return opcode in self.parsers or opcode in self.specs
+
+  def name(self, opcode):
+    return self.names.get(opcode)
+
+  def parser(self, opcode):
+    """
+    Returns the parser for an opcode, compiling it the first time it is
+    asked for. Returns None for opcodes without a spec.
+    """
+    parser = self.parsers.get(opcode)
+    if parser is None and opcode in self.specs:
+      parser = self.parsers[opcode] = make_packet_parser(opcode_header(opcode), self.specs[opcode])
+    return parser
+
+  def parse(self, opcode, payload, format = 'dict'):
+    """
+    Parses a framed packet (header included) with the parser for its
+    opcode. Returns None if there is no parser for the opcode.
+    """
+    parser = self.parser(opcode)
+    if parser is None:
+      return None
+    return parser(payload, format)
+  
+  def parse_stream(self, chunks, packet_file = 'packets.txt', use_numpy = True, framer = None):
+    """
+    Generator of Batches decoded from an iterable of recvs.
+    
+    Every run of consecutive packets of one fixed size opcode in a recv
+    is decoded in one step into columns, a dict of field name to one value
+    per packet, as long as the framed packets are the size of the parser's
+    spec. Other packets come one per Batch with their record fields as
+    columns of one value. Packets without a parser, or rejected by it,
+    have no columns and their bytes in raw. Pass a framer to carry partial
+    packets over from one call to the next.
+    """
+    framer = framer or PacketFramer(packet_file)
+    dtypes = {}
+    use_numpy = use_numpy and numpy is not None
+    
+    for chunk in chunks:
+      data, offsets = framer.split(chunk)
+      index, count = 0, len(offsets)
+      while index < count:
+        opcode, start, end = offsets[index]
+        parser = self.parser(opcode)
+        
+        size = parser.layout.size if parser is not None else -1
+        if size > 0 and end - start == size:
+          #a spec that disagrees with the framing goes through the per packet checks instead
+          run = index + 1
+          while run < count and offsets[run][0] == opcode and offsets[run][2] - offsets[run][1] == size:
+            run += 1
+          if use_numpy and opcode not in dtypes:
+            dtypes[opcode] = group_dtype(parser.layout)
+          columns = decode_group(parser.layout, data, start, run - index, dtypes.get(opcode))
+          yield tuple.__new__(Batch, (opcode, run - index, columns, None))
+          index = run
+          continue
+        
+        index += 1
+        packet = data[start:end]
+        try:
+          record = parser(packet, 'record') if parser is not None else None
+        except ParseError:
+          record = None
+        if record is None:
+          yield tuple.__new__(Batch, (opcode, 1, None, [packet]))
+        else:
+          yield tuple.__new__(Batch, (opcode, 1, dict((name, (value,)) for name, value in record._asdict().items()), None))
+
+def default_registry(memo = []):
+  """
+  Shared registry of hand_parsed.txt plus the parsers in parsers.py.
+  """
+  if not memo:
+    import parsers
+    registry = ParserRegistry()
+    registry.load()
+    registry.register_parser(0x0069, parsers.login_response_parser, 'login response')
+    registry.register_parser(0x006B, parsers.char_response_parser, 'char response')
+    registry.register_parser(0x0071, parsers.map_login_parser, 'map login')
+    memo.append(registry)
+  return memo[0]
+
+def parse(opcode, payload, format = 'dict'):
+  return default_registry().parse(opcode, payload, format)
+
+def parse_stream(chunks, use_numpy = True):
+  return default_registry().parse_stream(chunks, use_numpy = use_numpy)
+
+class parser_registry(unittest.TestCase):
+  def test_parse_line(self):
+    self.assertEqual(parse_line('unit move   8600 4:id 5:p_delta 1:88 4:tick'), ('unit move', 0x0086, (
+      ('id', 4), ('p_delta', 5), ('_', 1), ('tick', 4),
+    )))
+    self.assertEqual(parse_line('pos list    6601 2:len {4:pos_num 28:pos_name}'), ('pos list', 0x0166, (
+      ('length', 2), ('records', (('pos_num', 4), ('pos_name', 28))),
+    )))
+    self.assertEqual(parse_line('norm msg    8e00 2:len .:message 1:00'), ('norm msg', 0x008E, (
+      ('length', 2), ('message', 0), ('_', 1),
+    )))
+
+  def test_specs_compile(self):
+    for name, opcode, data_spec in read_specs():
+      make_packet_parser(opcode_header(opcode), data_spec)
+
+  def test_fixed_sizes_match_table(self):
+    table = load_packet_table()
+    for name, opcode, data_spec in read_specs():
+      if table[opcode] != VARIABLE:
+        self.assertEqual(2 + sum(bytes for _, bytes in data_spec), table[opcode], name)
+
+  def test_lazy_compile(self):
+    registry = ParserRegistry()
+    registry.load()
+    self.assertEqual(registry.parsers, {})
+
+    packet = '\x41\x01\x0d\x00\x00\x00\x01\x00\x00\x00\x04\x00\x00\x00'
+    self.assertEqual(registry.parse(0x0141, packet), {
+      'type': '\x0d\x00\x00\x00', 'curr': '\x01\x00\x00\x00', 'diff': '\x04\x00\x00\x00',
+    })
+    self.assertEqual(registry.parsers.keys(), [0x0141])
+
+  def test_variable(self):
+    packet = '\x8e\x00\x0c\x00Warped.\x00'
+    self.assertEqual(parse(0x008E, packet), {'length': 12, 'message': 'Warped.'})
+
+  def test_unknown(self):
+    self.assertEqual(ParserRegistry().parse(0x0000, '\x00\x00'), None)
+  
+  def test_parse_stream(self):
+    move = lambda id, tick: '\x86\x00' + struct.pack('<I', id) + '\x01\x02\x03\x04\x05\x88' + struct.pack('<I', tick)
+    stream = move(1, 10) + move(2, 20) + move(3, 30) + '\x7f\x00\x05\x00\x00\x00' + '\x8e\x00\x0c\x00Warped.\x00' + '\x00\x00' + move(4, 40)
+    
+    for use_numpy in (False, True) if numpy is not None else (False,):
+      batches = list(parse_stream([stream[:20], stream[20:]], use_numpy = use_numpy))
+      self.assertEqual([(batch.opcode, batch.count) for batch in batches], [
+        (0x0086, 1), (0x0086, 2), (0x007F, 1), (0x008E, 1), (0x0000, 1), (0x0086, 1),
+      ])
+      self.assertEqual(list(batches[1].columns['id']), [2, 3])
+      self.assertEqual(list(batches[1].columns['tick']), [20, 30])
+      self.assertEqual(list(batches[2].columns['tick']), [5])
+      self.assertEqual(batches[3].columns, {'length': (12,), 'message': ('Warped.',)})
+      self.assertEqual((batches[4].columns, batches[4].raw), (None, ['\x00\x00']))
+    
+    p_delta = list(parse_stream([move(1, 10)], use_numpy = False))[0].columns['p_delta']
+    self.assertEqual(p_delta, ('\x01\x02\x03\x04\x05',))
+  
+  def test_parse_stream_mismatched_spec(self):
+    registry = ParserRegistry()
+    #a byte short of the 16 bytes packets.txt frames 0x0086 with
+    registry.register_spec(0x0086, (('id', 4), ('p_delta', 5), ('tick', 4)))
+    move = '\x86\x00' + struct.pack('<I', 1) + '\x01\x02\x03\x04\x05\x88' + struct.pack('<I', 10)
+    for use_numpy in (False, True) if numpy is not None else (False,):
+      batches = list(registry.parse_stream([move * 3], use_numpy = use_numpy))
+      self.assertEqual([(batch.opcode, batch.count, batch.columns, batch.raw) for batch in batches], [(0x0086, 1, None, [move])] * 3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,10 +1,21 @@
+import asyncore
+import errno
+import json
+import logging
+import os
+import select
+import signal
 import socket
+import sys
 import threading
+import time
 import SocketServer
-from swapper import SwapHandler
+from swapper import AsyncHandler, SwapHandler
+from stats import ProxyStats, StatsServer, dump
+from upstream import ConnectStats, Upstream, UpstreamPool
 from processor import EchoProcessor, SimpleReplacerFactory
 
-def RequestHandlerFactory(server, port, processor):
+def RequestHandlerFactory(server, port, processor, connect_stats = None):
   class ThreadedRequestHandler(SocketServer.BaseRequestHandler):
     def handle(self):
       print "Got request (%s of %d): %s" % (threading.current_thread().getName(), threading.active_count(), self.request.getsockname())
@@ -17,8 +28,9 @@ def RequestHandlerFactory(server, port, processor):
       #Create a swapper object and pass in the client socket
       #and the address of the server to connect to
       try:
-        s = SwapHandler(self.request, server, port, processor)
-      except:
+        s = SwapHandler(self.request, server, port, processor, connect_stats = connect_stats)
+      except socket.error, e:
+        print "Could not connect %s to [%s:%d]: %s" % (self.client_address, server, port, e)
         return
       
       #Begin the asyncore runloop
@@ -29,7 +41,11 @@ def RequestHandlerFactory(server, port, processor):
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
   pass
 
-def start_servers(servers):
+def start_threaded_servers(servers):
+  """
+  Starts a thread per listening port and a thread per proxied client,
+  each client running its own asyncore loop.
+  """
   server_list = []
   for listen_port, server, port, processor in servers:
     temp_server = ThreadedTCPServer(('', listen_port), RequestHandlerFactory(server, port, processor))
@@ -41,6 +57,439 @@ def start_servers(servers):
   
   return server_list
 
+class ProxyLoop(object):
+  """
+  One asyncore loop (using poll, so it is not limited to FD_SETSIZE
+  sockets) serving every listening socket and proxied session in its map.
+  The loop runs until the map is empty.
+
+  Every session of the loop counts into its ProxyStats, which can be
+  served on a local port or dumped to a file periodically.
+  """
+  def __init__(self, timeout = 1.0):
+    self.map = {}
+    self.timeout = timeout
+    self.thread = None
+    self.timers = []
+    self.pools = {}
+    self.upstreams = {}
+    self.stats = ProxyStats()
+    self.stats_server = None
+
+  def every(self, interval, callback):
+    """
+    Calls callback from the loop thread every interval seconds.
+    """
+    self.timers.append([time.time() + interval, interval, callback])
+
+  def run(self):
+    while self.map:
+      timeout = self.timeout
+      if self.timers:
+        #wake up in time for the next timer
+        timeout = max(0.0, min(timeout, min(timer[0] for timer in self.timers) - time.time()))
+      asyncore.loop(timeout, True, self.map, 1)
+
+      if self.timers:
+        now = time.time()
+        for timer in self.timers:
+          if now >= timer[0]:
+            timer[0] = now + timer[1]
+            timer[2]()
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self.thread
+
+  def upstream(self, server, port):
+    """
+    Returns the Upstream of server:port, shared by every listener of the
+    loop forwarding there. The first call looks it up, blocking, so it is
+    made before the loop runs; the loop refreshes it from a thread.
+    """
+    if (server, port) not in self.upstreams:
+      upstream = self.upstreams[(server, port)] = Upstream(server, port)
+      self.every(1.0, upstream.refresh)
+    return self.upstreams[(server, port)]
+
+  def pool(self, server, port, size):
+    """
+    Returns the UpstreamPool to server:port, shared by every listener of
+    the loop forwarding there, opening it the first time.
+    """
+    if (server, port) not in self.pools:
+      pool = self.pools[(server, port)] = UpstreamPool(server, port, self.map, size, upstream = self.upstream(server, port))
+      self.every(1.0, pool.maintain)
+    return self.pools[(server, port)]
+
+  def serve_stats(self, port):
+    self.stats_server = StatsServer(port, self.stats, self.map)
+    return self.stats_server
+
+  def dump_stats(self, filename, interval = 10.0):
+    self.every(interval, lambda: dump(self.stats, filename))
+
+  def sessions(self):
+    return sum(1 for channel in self.map.values() if isinstance(channel, AsyncHandler)) // 2
+
+  def upstream_stats(self):
+    totals = {}
+    for pool in self.pools.values():
+      for key, value in pool.as_dict().items():
+        totals[key] = totals.get(key, 0) + value
+    return totals
+
+class ProxyServer(asyncore.dispatcher):
+  """
+  Listening socket that accepts clients into SwapHandlers sharing its
+  loop's map.
+
+  With a pool_size, clients are handed pre-opened upstream connections
+  from the loop's UpstreamPool to the server, falling back to connecting
+  on accept when the pool has none idle.
+  """
+  def __init__(self, listen_port, server, port, processor, loop, backlog = 128, sock = None, reuse_port = False, pool_size = 0):
+    asyncore.dispatcher.__init__(self, map=loop.map)
+    self.server, self.port, self.processor, self.loop = server, port, processor, loop
+    self.upstream = loop.upstream(server, port)
+    self.accepted = self.failed = 0
+    if pool_size:
+      self.pool = loop.pool(server, port, pool_size)
+      self.connect_stats = self.pool.stats
+    else:
+      self.pool = None
+      self.connect_stats = ConnectStats()
+
+    if sock is not None:
+      #an already listening socket, e.g. inherited from a supervisor
+      self.set_socket(sock)
+      self.accepting = True
+    else:
+      self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.set_reuse_addr()
+      if reuse_port:
+        if SO_REUSEPORT is None:
+          self.close()
+          raise ValueError('SO_REUSEPORT is not supported on %s' % sys.platform)
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+      self.bind(('', listen_port))
+      self.listen(backlog)
+    self.server_address = self.socket.getsockname()
+
+  def __repr__(self):
+    return '<ProxyServer %s:%d to %s:%d>' % (self.server_address + (self.server, self.port))
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+
+    client_socket, address = pair
+    self.accepted += 1
+    server_socket = self.pool.take() if self.pool is not None else None
+    try:
+      SwapHandler(client_socket, self.server, self.port, self.processor, self.loop.map, server_socket, self.connect_stats, self.loop.stats, self.upstream)
+    except socket.error, e:
+      self.failed += 1
+      print "Could not connect %s to [%s:%d]: %s" % (address, self.server, self.port, e)
+      client_socket.close()
+
+  def shutdown(self):
+    self.close()
+
+if hasattr(socket, 'SO_REUSEPORT'):
+  SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+  #the Python 2 socket module does not export it
+  SO_REUSEPORT = 15
+else:
+  SO_REUSEPORT = None
+
+def run_worker(servers, listeners, stats_fd, stats_interval, pool_size = 0):
+  """
+  Body of a forked worker: runs a ProxyLoop over the servers (binding
+  them with SO_REUSEPORT unless listening sockets are passed in) and
+  writes a line of JSON stats to stats_fd every stats_interval seconds.
+  """
+  loop = ProxyLoop()
+  proxy_servers = []
+  for index, (listen_port, server, port, processor) in enumerate(servers):
+    if listeners:
+      proxy_servers.append(ProxyServer(listen_port, server, port, processor, loop, sock = listeners[index], pool_size = pool_size))
+    else:
+      proxy_servers.append(ProxyServer(listen_port, server, port, processor, loop, reuse_port = True, pool_size = pool_size))
+  #servers sharing a pool share its stats
+  connect_stats = dict((id(proxy_server.connect_stats), proxy_server.connect_stats) for proxy_server in proxy_servers).values()
+
+  def report():
+    stats = {
+      'pid': os.getpid(),
+      'sessions': loop.sessions(),
+      'accepted': sum(proxy_server.accepted for proxy_server in proxy_servers),
+      'failed': sum(proxy_server.failed for proxy_server in proxy_servers),
+      'upstream_connects': sum(stats.connects for stats in connect_stats),
+      'upstream_failures': sum(stats.failures for stats in connect_stats),
+      'upstream_connect_time': sum(stats.connect_time for stats in connect_stats),
+      'pool_hits': sum(pool.hits for pool in loop.pools.values()),
+      'pool_misses': sum(pool.misses for pool in loop.pools.values()),
+    }
+    stats.update(loop.stats.totals())
+    try:
+      os.write(stats_fd, json.dumps(stats) + '\n')
+    except OSError:
+      #the supervisor is gone
+      os._exit(1)
+
+  loop.every(stats_interval, report)
+  report()
+  loop.run()
+
+class Supervisor(object):
+  """
+  Forks worker processes that each run their own ProxyLoop on the same
+  listening ports, restarts workers that die and aggregates the stats
+  they report.
+  
+  With reuse_port every worker binds the ports itself with SO_REUSEPORT
+  and the kernel spreads connections between them. Otherwise, or where
+  SO_REUSEPORT is not available, the supervisor binds the ports once and
+  the workers inherit the sockets.
+
+  A worker that dies within quick_failure seconds of starting is
+  restarted after restart_delay seconds, doubling with every quick
+  failure in a row up to max_restart_delay, and not at all after
+  max_quick_failures of them.
+  """
+  restart_delay = 0.5
+  max_restart_delay = 30.0
+  quick_failure = 10.0
+  max_quick_failures = 5
+
+  def __init__(self, servers, workers, reuse_port = True, stats_interval = 5.0, pool_size = 0):
+    self.servers = list(servers)
+    self.count = workers
+    self.pool_size = pool_size
+    self.reuse_port = reuse_port and SO_REUSEPORT is not None
+    self.stats_interval = stats_interval
+    self.listeners = []
+    self.workers = {}
+    self.stats = {}
+    self.started = {}
+    self.failures = {}
+    self.restart_due = {}
+    self.restarts = 0
+    self.running = False
+    self.lock = threading.Lock()
+
+  def __repr__(self):
+    return '<Supervisor of %d workers on ports %s>' % (self.count, ', '.join(str(server[0]) for server in self.servers))
+
+  def start(self):
+    if not self.reuse_port:
+      for listen_port, _, _, _ in self.servers:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', listen_port))
+        sock.listen(128)
+        sock.setblocking(0)
+        self.listeners.append(sock)
+
+    self.running = True
+    for index in xrange(self.count):
+      self.spawn(index)
+
+    self.thread = threading.Thread(target=self.monitor)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def spawn(self, index):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_fd)
+      try:
+        run_worker(self.servers, self.listeners, write_fd, self.stats_interval, self.pool_size)
+      except:
+        import traceback
+        traceback.print_exc()
+        os._exit(1)
+      os._exit(0)
+
+    os.close(write_fd)
+    with self.lock:
+      self.workers[index] = (pid, read_fd, [''])
+      self.stats[index] = {'pid': pid}
+    self.started[index] = time.time()
+    print "Started worker %d (pid %d)" % (index, pid)
+
+  def read_stats(self, index):
+    pid, read_fd, partial = self.workers[index]
+    try:
+      data = os.read(read_fd, 65536)
+    except OSError:
+      data = ''
+    if not data:
+      return False
+
+    lines = (partial[0] + data).split('\n')
+    partial[0] = lines.pop()
+    for line in lines:
+      self.stats[index] = json.loads(line)
+    return True
+
+  def reap(self):
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError, e:
+        if e.errno == errno.ECHILD:
+          return
+        raise
+      if pid == 0:
+        return
+
+      for index, (worker_pid, read_fd, _) in self.workers.items():
+        if worker_pid == pid:
+          os.close(read_fd)
+          with self.lock:
+            del self.workers[index]
+          if self.running:
+            self.schedule_restart(index, pid, status)
+
+  def schedule_restart(self, index, pid, status):
+    now = time.time()
+    if now - self.started[index] < self.quick_failure:
+      self.failures[index] = self.failures.get(index, 0) + 1
+    else:
+      self.failures[index] = 1
+    failures = self.failures[index]
+    if failures > self.max_quick_failures:
+      print "Worker %d (pid %d) died with status %d, %d times in a row within %.0fs of starting, giving up" % (index, pid, status, failures, self.quick_failure)
+      with self.lock:
+        self.stats.pop(index, None)
+      return
+    delay = min(self.restart_delay * 2 ** (failures - 1), self.max_restart_delay)
+    print "Worker %d (pid %d) died with status %d, restarting in %.1fs" % (index, pid, status, delay)
+    self.restart_due[index] = now + delay
+
+  def restart_due_workers(self):
+    now = time.time()
+    for index, due in self.restart_due.items():
+      if now >= due:
+        del self.restart_due[index]
+        self.restarts += 1
+        self.spawn(index)
+
+  def monitor(self):
+    while self.running:
+      fds = dict((read_fd, index) for index, (_, read_fd, _) in self.workers.items())
+      timeout = 1.0
+      if self.restart_due:
+        timeout = max(0.0, min(timeout, min(self.restart_due.values()) - time.time()))
+      try:
+        readable = select.select(fds.keys(), [], [], timeout)[0]
+      except (select.error, OSError):
+        readable = []
+      for read_fd in readable:
+        self.read_stats(fds[read_fd])
+      self.reap()
+      if self.running:
+        self.restart_due_workers()
+
+  def aggregate(self):
+    """
+    Sums the latest stats of every worker.
+    """
+    with self.lock:
+      stats = self.stats.values()
+    totals = {'workers': len(stats), 'restarts': self.restarts}
+    for worker_stats in stats:
+      for key, value in worker_stats.items():
+        if key.endswith('_peak'):
+          totals[key] = max(totals.get(key, 0), value)
+        elif key != 'pid':
+          totals[key] = totals.get(key, 0) + value
+    return totals
+
+  def shutdown(self):
+    self.running = False
+    self.thread.join()
+    for pid, read_fd, _ in self.workers.values():
+      try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+      os.close(read_fd)
+    self.workers = {}
+    for sock in self.listeners:
+      sock.close()
+
+def start_servers(servers, loop = None, workers = 0, reuse_port = True, pool_size = 0, stats_port = None, stats_file = None, stats_interval = 10.0,
+                  profile = None, profile_file = None, profile_interval = 10.0, profile_top = 10, profile_log = None):
+  """
+  Starts a listening socket per (listen_port, server, port, processor)
+  entry. Every listener and proxied session runs in one ProxyLoop thread.
+  With a pool_size, that many upstream connections to each (server, port)
+  are kept open ahead of clients.
+
+  With a stats_port, a JSON snapshot of the loop's stats is served to
+  every connection to that port on localhost. With a stats_file, one is
+  written there every stats_interval seconds. Workers report their
+  totals to the Supervisor instead.
+
+  With a profile (True or a profiler.OpcodeProfile), every processor is
+  wrapped to profile its traffic per opcode into it. Every
+  profile_interval seconds the top profile_top opcodes are passed as text
+  to profile_log (by default logged at INFO by the 'profiler' logger) and
+  the profile is written to profile_file, if given. Workers are not
+  profiled.
+  
+  With workers, a Supervisor forks that many processes instead, each
+  running its own loop on the same ports, and is returned as the only
+  server.
+  """
+  if workers:
+    supervisor = Supervisor(servers, workers, reuse_port, pool_size = pool_size)
+    supervisor.start()
+    return [supervisor]
+
+  if loop is None:
+    loop = ProxyLoop()
+
+  if profile:
+    from profiler import OpcodeProfile, ProfilingProcessorFactory
+    if not isinstance(profile, OpcodeProfile):
+      profile = OpcodeProfile()
+    servers = [(listen_port, server, port, ProfilingProcessorFactory(profile, processor)) for listen_port, server, port, processor in servers]
+
+    if profile_log is None:
+      profile_log = logging.getLogger('profiler').info
+
+    def report():
+      profile_log(profile.report(profile_top))
+      if profile_file is not None:
+        profile.dump(profile_file)
+    loop.every(profile_interval, report)
+
+  server_list = []
+  for listen_port, server, port, processor in servers:
+    server_list.append(ProxyServer(listen_port, server, port, processor, loop, pool_size = pool_size))
+    print "Starting server on port [%d] to [%s:%d]." % (listen_port, server, port)
+
+  if stats_port is not None:
+    server_list.append(loop.serve_stats(stats_port))
+    print "Serving stats on port [%d]." % stats_port
+  if stats_file is not None:
+    loop.dump_stats(stats_file, stats_interval)
+
+  if loop.thread is None:
+    loop.start()
+
+  return server_list
+
 if __name__ == '__main__':
   #ThreadedTCPServer(('localhost', 80), RequestHandlerFactory('google.com', 80)).serve_forever()
   
@@ -58,5 +507,5 @@ if __name__ == '__main__':
     pass
   finally:
     for server in servers:
-      print "Shutting down server on %s:%d" % server.server_address
+      print "Shutting down %r" % server
       server.shutdown()
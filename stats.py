@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+stats.py
+
+Proxy counters.
+
+Every SwapHandler given a ProxyStats keeps a SessionStats with the bytes
+read from and written to each side, the packets seen per opcode, the
+peak depth of each outbound FIFOBuffer and a histogram of how long bytes
+sat in the proxy between being read and being sent. Counting is plain
+integer adds on the hot path; everything else is done when a snapshot is
+taken. Snapshots are served as JSON by a StatsServer on a local port or
+written out periodically with dump().
+"""
+
+import asyncore
+import json
+import os
+import socket
+import time
+import unittest
+from itertools import count
+
+class Histogram(object):
+  """
+  Latency histogram with power of two microsecond buckets: bucket i
+  counts values under 2**i microseconds.
+  """
+  buckets = 32
+
+  def __init__(self):
+    self.counts = [0] * self.buckets
+    self.total = 0
+    self.sum = 0.0
+
+  def add(self, seconds):
+    self.counts[min(int(seconds * 1e6).bit_length(), self.buckets - 1)] += 1
+    self.total += 1
+    self.sum += seconds
+
+  def merge(self, other):
+    for index, value in enumerate(other.counts):
+      self.counts[index] += value
+    self.total += other.total
+    self.sum += other.sum
+
+  def percentile(self, fraction):
+    """
+    Returns the upper bound in seconds of the bucket holding the given
+    fraction of the values.
+    """
+    if not self.total:
+      return 0.0
+    seen, wanted = 0, fraction * self.total
+    for index, value in enumerate(self.counts):
+      seen += value
+      if seen >= wanted:
+        return (1 << index) / 1e6
+    return (1 << (self.buckets - 1)) / 1e6
+
+  def as_dict(self):
+    return {
+      'count': self.total,
+      'mean': self.sum / self.total if self.total else 0.0,
+      'p50': self.percentile(0.5),
+      'p99': self.percentile(0.99),
+      'buckets': dict(('<%dus' % (1 << index), value) for index, value in enumerate(self.counts) if value),
+    }
+
+def merge_counts(into, counts):
+  for key, value in counts.iteritems():
+    into[key] = into.get(key, 0) + value
+
+class SessionStats(object):
+  """
+  Counters of one proxied session. read and written are keyed by the side
+  the bytes came from or went to.
+  """
+  ids = count(1)
+
+  def __init__(self, address = None):
+    self.id = self.ids.next()
+    self.address = address
+    self.started = time.time()
+    self.read = {'client': 0, 'server': 0}
+    self.written = {'client': 0, 'server': 0}
+    self.opcodes = {}
+    self.latency = Histogram()
+    self.buffers = {}
+
+  def queue_peaks(self):
+    return dict((sid, buf.peak) for sid, buf in self.buffers.items())
+
+  def rate(self, now = None):
+    age = max((now or time.time()) - self.started, 1e-6)
+    return (sum(self.read.values()) + sum(self.written.values())) / age
+
+  def as_dict(self, now = None):
+    now = now or time.time()
+    return {
+      'id': self.id,
+      'address': '%s:%d' % self.address if self.address else None,
+      'age': now - self.started,
+      'read': dict(self.read),
+      'written': dict(self.written),
+      'bytes_per_second': self.rate(now),
+      'queue_peak': self.queue_peaks(),
+      'latency': self.latency.as_dict(),
+    }
+
+class ProxyStats(object):
+  """
+  Global counters of every session of a ProxyLoop. Live sessions are
+  summed when a snapshot is taken, finished ones are folded into the
+  totals when they close.
+  """
+  def __init__(self):
+    self.started = time.time()
+    self.sessions = set()
+    self.opened = self.closed = 0
+    self.read = {'client': 0, 'server': 0}
+    self.written = {'client': 0, 'server': 0}
+    self.opcodes = {}
+    self.latency = Histogram()
+    self.queue_peak = 0
+
+  def open_session(self, address = None):
+    session = SessionStats(address)
+    self.sessions.add(session)
+    self.opened += 1
+    return session
+
+  def close_session(self, session):
+    if session not in self.sessions:
+      return
+    self.sessions.discard(session)
+    self.closed += 1
+    merge_counts(self.read, session.read)
+    merge_counts(self.written, session.written)
+    merge_counts(self.opcodes, session.opcodes)
+    self.latency.merge(session.latency)
+    self.queue_peak = max([self.queue_peak] + session.queue_peaks().values())
+
+  def snapshot(self, top = 10):
+    """
+    Returns a JSON friendly dict of the totals so far plus the top
+    sessions by bytes per second.
+    """
+    now = time.time()
+    read, written, opcodes = dict(self.read), dict(self.written), dict(self.opcodes)
+    latency = Histogram()
+    latency.merge(self.latency)
+    queue_peak = self.queue_peak
+    for session in self.sessions:
+      merge_counts(read, session.read)
+      merge_counts(written, session.written)
+      merge_counts(opcodes, session.opcodes)
+      latency.merge(session.latency)
+      queue_peak = max([queue_peak] + session.queue_peaks().values())
+
+    uptime = max(now - self.started, 1e-6)
+    hot = sorted(self.sessions, key = lambda session: session.rate(now), reverse = True)[:top]
+    return {
+      'time': now,
+      'uptime': uptime,
+      'sessions': len(self.sessions),
+      'opened': self.opened,
+      'closed': self.closed,
+      'read': read,
+      'written': written,
+      'bytes_per_second': (sum(read.values()) + sum(written.values())) / uptime,
+      'opcodes': dict(('0x%04X' % opcode, value) for opcode, value in opcodes.items()),
+      'queue_peak': queue_peak,
+      'latency': latency.as_dict(),
+      'top': [session.as_dict(now) for session in hot],
+    }
+
+  def totals(self):
+    """
+    Flat numeric totals, for the Supervisor's stats lines.
+    """
+    snapshot = self.snapshot(top = 0)
+    return {
+      'bytes_read': sum(snapshot['read'].values()),
+      'bytes_written': sum(snapshot['written'].values()),
+      'packets': sum(snapshot['opcodes'].values()),
+      'queue_peak': snapshot['queue_peak'],
+    }
+
+def dump(stats, filename, top = 10):
+  """
+  Writes a snapshot to filename, replacing the previous one.
+  """
+  with open(filename + '.tmp', 'w') as f:
+    json.dump(stats.snapshot(top), f, indent = 2, sort_keys = True)
+  os.rename(filename + '.tmp', filename)
+
+class StatsClient(asyncore.dispatcher):
+  """
+  One connection to a StatsServer, sent its snapshot as the socket takes
+  it and closed once it is all sent, so a slow client never holds up the
+  loop.
+  """
+  def __init__(self, sock, data, map):
+    asyncore.dispatcher.__init__(self, sock, map = map)
+    self.data, self.offset = data, 0
+
+  def readable(self):
+    #only to notice the client going away
+    return True
+
+  def writable(self):
+    return self.offset < len(self.data)
+
+  def handle_read(self):
+    self.recv(4096)
+
+  def handle_write(self):
+    self.offset += self.send(buffer(self.data, self.offset))
+    if self.offset >= len(self.data):
+      self.close()
+
+  def handle_close(self):
+    self.close()
+
+class StatsServer(asyncore.dispatcher):
+  """
+  Local port answering every connection with a JSON snapshot of stats.
+  """
+  def __init__(self, port, stats, map, host = '127.0.0.1'):
+    asyncore.dispatcher.__init__(self, map = map)
+    self.map = map
+    self.stats = stats
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(5)
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+    StatsClient(pair[0], json.dumps(self.stats.snapshot(), sort_keys = True) + '\n', self.map)
+
+  def shutdown(self):
+    self.close()
+
+class proxy_stats(unittest.TestCase):
+  def test_histogram(self):
+    histogram = Histogram()
+    for seconds in (0.000001, 0.000003, 0.001, 0.002):
+      histogram.add(seconds)
+    self.assertEqual(histogram.total, 4)
+    self.assertEqual(histogram.percentile(0.5), 4e-6)
+    self.assertEqual(histogram.percentile(1.0), 2048e-6)
+
+  def test_sessions(self):
+    stats = ProxyStats()
+    first, second = stats.open_session(('127.0.0.1', 1000)), stats.open_session()
+    first.read['client'] += 10
+    first.opcodes[0x0069] = 1
+    second.written['server'] += 5
+    second.opcodes[0x0069] = 2
+
+    stats.close_session(first)
+    stats.close_session(first)
+    snapshot = stats.snapshot()
+    self.assertEqual((snapshot['opened'], snapshot['closed'], snapshot['sessions']), (2, 1, 1))
+    self.assertEqual(snapshot['read'], {'client': 10, 'server': 0})
+    self.assertEqual(snapshot['written'], {'client': 0, 'server': 5})
+    self.assertEqual(snapshot['opcodes'], {'0x0069': 3})
+    self.assertEqual([session['id'] for session in snapshot['top']], [second.id])
+    json.dumps(snapshot)
+
+  def test_server(self):
+    stats, map = ProxyStats(), {}
+    server = StatsServer(0, stats, map)
+    client = socket.create_connection(server.socket.getsockname())
+    end = time.time() + 2
+    while len(map) < 2 and time.time() < end:
+      asyncore.loop(0.05, True, map, 1)
+    while len(map) > 1 and time.time() < end:
+      asyncore.loop(0.05, True, map, 1)
+    self.assertEqual(json.loads(client.makefile().readline())['sessions'], 0)
+    client.close()
+    server.close()
+
+  def test_slow_client(self):
+    stats, map = ProxyStats(), {}
+    snapshot = stats.snapshot()
+    snapshot['padding'] = 'x' * (16 << 20)
+    stats.snapshot = lambda: snapshot
+    server = StatsServer(0, stats, map)
+    client = socket.create_connection(server.socket.getsockname())
+    try:
+      start = time.time()
+      for _ in xrange(5):
+        asyncore.loop(0.05, True, map, 1)
+      #the client reads nothing, so most of the snapshot is still queued
+      self.assertTrue(time.time() - start < 1.0)
+      clients = [channel for channel in map.values() if isinstance(channel, StatsClient)]
+      self.assertEqual(len(clients), 1)
+      self.assertTrue(clients[0].writable())
+    finally:
+      client.close()
+      for channel in map.values():
+        channel.close()
+
+if __name__ == '__main__':
+  unittest.main()
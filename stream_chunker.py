@@ -7,39 +7,60 @@ Created by zeebo on 2010-07-28.
 """
 
 import unittest
+from collections import deque
 
 class StreamChunker(object):
+  """
+  Splits a stream of data into chunks of requested sizes.
+  
+  Incoming data is appended to a single bytearray and consumed by moving
+  a read offset forward, so adding N bytes costs O(N) no matter how much
+  is still buffered. The consumed prefix is only dropped once it makes up
+  at least half of the buffer.
+  """
+  compact_size = 4096
+  
   def __init__(self, callback = None):
-    self.chunks = []
-    self.buffer = []
-    self.to_chunk = []
+    self.chunks = deque()
+    self.buffer = bytearray()
+    self.offset = 0
+    self.to_chunk = deque()
     self.callback = callback
   
   def add_data(self, data):
-    self.buffer.append(data)
-    while len(self.to_chunk) > 0 and len(self.data()) >= self.to_chunk[0]:
-      self.chunk(self.to_chunk.pop(0))
+    self.buffer.extend(data)
+    while len(self.to_chunk) > 0 and self.available() >= self.to_chunk[0]:
+      self.chunk(self.to_chunk.popleft())
+  
+  def available(self):
+    return len(self.buffer) - self.offset
   
   def data(self):
-    return ''.join(self.buffer)
+    return str(self.buffer[self.offset:])
+  
+  def peek(self, count):
+    return str(self.buffer[self.offset:self.offset+count])
+  
+  def consume(self, count):
+    chunk = str(self.buffer[self.offset:self.offset+count])
+    self.offset += count
+    
+    #drop the consumed prefix once it dominates the buffer
+    if self.offset >= self.compact_size and self.offset * 2 >= len(self.buffer):
+      del self.buffer[:self.offset]
+      self.offset = 0
+    elif self.offset == len(self.buffer):
+      del self.buffer[:]
+      self.offset = 0
+    
+    return chunk
   
   def chunk(self, count):
-    if len(self.data()) >= count:
-      temp_data = []
-      while count >= len(self.buffer[0]):
-        popped = self.buffer.pop(0)
-        temp_data.append(popped)
-        count -= len(popped)
-        if len(self.buffer) == 0:
-          break
-      if count > 0:
-        temp_data.append(self.buffer[0][:count])
-        self.buffer[0] = self.buffer[0][count:]
-      
-      self.chunks.append(''.join(temp_data))
+    if self.available() >= count:
+      self.chunks.append(self.consume(count))
       
       if callable(self.callback):
-        self.callback(self.chunks.pop(0))
+        self.callback(self.chunks.popleft())
     else:
       self.to_chunk.append(count)
   
@@ -47,7 +68,7 @@ class StreamChunker(object):
     return len(self.chunks) > 0
   
   def pop(self):
-    return self.chunks.pop(0)
+    return self.chunks.popleft()
 
 def PacketChunker(packet_file = 'packets.txt', memo_dict={}, *args, **kwargs):
   if packet_file in memo_dict:
@@ -69,31 +90,27 @@ def PacketChunker(packet_file = 'packets.txt', memo_dict={}, *args, **kwargs):
       
       #check if we're waiting to chunk already
       #if we aren't, then we're at a header
-      while len(self.to_chunk) == 0 and len(self.data()) >= 2:
-        current_data = self.data()
-      
-        #check if we have enough data for the header
-        if len(current_data) >= 2:
-          #see if the header is in our packet database
-          amount_to_chunk = self.packets.get(current_data[:2], None)
-          
-          #flat amount, chunk it
-          if amount_to_chunk > 0:
+      while len(self.to_chunk) == 0 and self.available() >= 2:
+        #see if the header is in our packet database
+        amount_to_chunk = self.packets.get(self.peek(2), None)
+        
+        #flat amount, chunk it
+        if amount_to_chunk > 0:
+          self.chunk(amount_to_chunk)
+        
+        #-1, check for length and chunk it
+        elif amount_to_chunk == -1:
+          if self.available() >= 4:
+            raw_length = self.peek(4)[2:4]
+            #little endian
+            amount_to_chunk = ord(raw_length[0]) + 256*ord(raw_length[1])
             self.chunk(amount_to_chunk)
-          
-          #-1, check for length and chunk it
-          elif amount_to_chunk == -1:
-            if len(current_data) >= 4:
-              raw_length = current_data[2:4]
-              #little endian
-              amount_to_chunk = ord(raw_length[0]) + 256*ord(raw_length[1])
-              self.chunk(amount_to_chunk)
-            else:
-              #must wait for more data
-              break
           else:
-            #Unknown packet header. Chunk it and discard
-            self.chunk(2)
+            #must wait for more data
+            break
+        else:
+          #Unknown packet header. Chunk it and discard
+          self.chunk(2)
       
   memo_dict[packet_file] = PacketChunkerClass
   return PacketChunkerClass(*args, **kwargs)
@@ -231,6 +248,22 @@ class stream_chunker(unittest.TestCase):
     self.assertEqual(chunker.pop(), 'tte')
     self.assertEqual(chunker.pop(), 'stt')
     self.assertEqual(chunker.pop(), 'est')
+  
+  def test_compaction(self):
+    chunker = StreamChunker()
+    data = ''.join(chr(i % 251) for i in xrange(3 * chunker.compact_size))
+    for i in xrange(0, len(data), 7):
+      chunker.add_data(data[i:i+7])
+      chunker.chunk(5)
+    
+    chunks = []
+    while chunker.has_chunk():
+      chunks.append(chunker.pop())
+    joined = ''.join(chunks)
+    
+    self.assertEqual(joined, data[:len(joined)])
+    self.assertEqual(chunker.data(), data[len(joined):])
+    self.assertTrue(len(chunker.buffer) < 2 * chunker.compact_size)
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -1,6 +1,36 @@
 import asyncore
+import errno
+import os
 import socket
 import threading
+import time
+import unittest
+from upstream import resolve
+
+def sendmsg(sock, segments):
+  """
+  Sends a list of buffers with one gathering write and returns the number
+  of bytes sent. Needs socket.sendmsg, see HAS_SENDMSG.
+  """
+  return sock.sendmsg(segments)
+
+#True when the socket module has sendmsg, which Python 2 does not
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+def defined_in(cls, name):
+  for klass in cls.__mro__:
+    if name in klass.__dict__:
+      return klass
+  return None
+
+def uses_segments(processor):
+  """
+  True when processor's get_segments can stand in for its get_data, i.e.
+  get_data is not overridden below the class defining get_segments.
+  """
+  segments_class = defined_in(type(processor), 'get_segments')
+  data_class = defined_in(type(processor), 'get_data')
+  return segments_class is not None and (data_class is None or issubclass(segments_class, data_class))
 
 def hex_print(data, bytes_per_line = 20, bytes_per_break = 5):
   if bytes_per_line > 100:
@@ -22,55 +52,188 @@ class AsyncHandler(asyncore.dispatcher):
     asyncore.dispatcher.__init__(self, sock=socket, map=swapper.map)
     self.swapper = swapper
     self.id = sid
+    self.finished = False
   
   def fileno(self):
     return self.socket.fileno()
   
+  def close(self):
+    asyncore.dispatcher.close(self)
+    if not self.finished:
+      self.finished = True
+      self.swapper.handle_closed(self.id)
+  
   def handle_connect(self):
-    pass
+    err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err != 0:
+      raise socket.error(err, os.strerror(err))
+    self.swapper.handle_connect(self.id)
   
   def handle_close(self):
     self.swapper.handle_close(self.id)
   
+  def handle_error(self):
+    self.swapper.handle_error(self.id)
+  
   def handle_read(self):
     self.swapper.handle_read(self.id, self.recv(8192))
   
   def handle_write(self):
     self.swapper.handle_write(self.id)
   
+  def send_segments(self, segments):
+    #asyncore.dispatcher.send for a list of buffers
+    try:
+      return sendmsg(self.socket, segments)
+    except socket.error, why:
+      if why.args[0] == errno.EWOULDBLOCK:
+        return 0
+      elif why.args[0] in asyncore._DISCONNECTED:
+        self.handle_close()
+        return 0
+      raise
+  
   def writable(self):
-    return self.swapper.writable(self.id)
+    #keep polling for writes until a pending connect finishes
+    return self.connecting or self.swapper.writable(self.id)
+  
+  def readable(self):
+    return self.swapper.readable(self.id)
   
 class SwapHandler(object):
-  def __init__(self, client_socket, server_address, server_port, processor):
-    server_socket = socket.create_connection((server_address, server_port))
-      
-    self.map = {}
+  """
+  Swaps data between a client socket and a server connection through a
+  DataProcessor.
+  
+  Without a map the server connection is made blocking and loop() runs a
+  private asyncore loop over the two sockets. With a map (shared by every
+  session of a ProxyLoop) the server connection is made non-blocking and
+  both sockets are served by whoever runs the loop over that map.
+  
+  An already connected server_socket (e.g. from an UpstreamPool) is used
+  as is. Otherwise the server is connected to at the address of upstream,
+  an upstream.Upstream, or looked up with resolve() when none is given.
+  Connects made here are reported to connect_stats if given.
+  
+  With a ProxyStats the session keeps a SessionStats there, which
+  processors with an instrument() method fill in too.
+
+  With gathering_writes, queued data is sent with one socket.sendmsg of
+  the processor's get_segments() instead of a send of its joined
+  get_data(), unless the processor overrides get_data without
+  get_segments or the socket module has no sendmsg. It is off by default.
+  """
+  gathering_writes = False
+
+  def __init__(self, client_socket, server_address, server_port, processor, map = None, server_socket = None, connect_stats = None, stats = None, upstream = None):
+    self.connect_stats = connect_stats
+    self.connect_started = None
+    if server_socket is None:
+      family, sockaddr = upstream.address if upstream is not None else resolve(server_address, server_port)
+    
+    if map is None:
+      self.map = {}
+      if server_socket is None:
+        self.connect_started = time.time()
+        try:
+          server_socket = socket.create_connection(sockaddr)
+        except socket.error, e:
+          self.connect_failed(e)
+          raise
+        self.connect_done()
+    else:
+      self.map = map
+    
+    self.processor = processor()
+    self.is_readable = getattr(self.processor, 'is_readable', lambda sid: True)
+    if self.gathering_writes and HAS_SENDMSG and uses_segments(self.processor):
+      self.get_segments = self.processor.get_segments
+    else:
+      self.get_segments = None
+    
+    self.stats, self.session, self.closed = stats, None, set()
+    if stats is not None:
+      try:
+        address = client_socket.getpeername()
+      except socket.error:
+        address = None
+      self.session = stats.open_session(address)
+      if hasattr(self.processor, 'instrument'):
+        self.processor.instrument(self.session)
     
     self.sockets = {
                       'client': AsyncHandler(client_socket, 'client', self),
                       'server': AsyncHandler(server_socket, 'server', self),
                    }
     
-    self.processor = processor()
+    if server_socket is None:
+      self.connect_started = time.time()
+      try:
+        self.sockets['server'].create_socket(family, socket.SOCK_STREAM)
+        self.sockets['server'].connect(sockaddr)
+      except socket.error, e:
+        self.connect_failed(e)
+        self.close()
+        raise
+  
+  def connect_done(self):
+    if self.connect_started is not None:
+      if self.connect_stats is not None:
+        self.connect_stats.connected(time.time() - self.connect_started)
+      self.connect_started = None
+  
+  def connect_failed(self, error):
+    if self.connect_started is not None:
+      if self.connect_stats is not None:
+        self.connect_stats.failed(error)
+      self.connect_started = None
   
   def other(self, sid):
     return {'client':'server', 'server':'client'}[sid]
   
+  def close(self):
+    for handler in self.sockets.values():
+      handler.close()
+  
   def handle_close(self, sid):
-    if not self.processor.is_writable(sid):
-      self.sockets[sid].close()
+    #the peer is gone, so nothing more can be read from or sent to it
+    if sid == 'server':
+      self.connect_failed('closed while connecting')
+    self.sockets[sid].close()
     
     if not self.processor.is_writable(self.other(sid)):
       self.sockets[self.other(sid)].close()
-    
+  
+  def handle_closed(self, sid):
+    self.closed.add(sid)
+    if len(self.closed) == 2 and self.session is not None:
+      self.stats.close_session(self.session)
+  
+  def handle_connect(self, sid):
+    self.connect_done()
+  
+  def handle_error(self, sid):
+    nil, t, v, tbinfo = asyncore.compact_traceback()
+    print "Closing session on %s error: %s %s" % (sid, t, v)
+    self.connect_failed(v)
+    self.close()
   
   def handle_read(self, sid, data):
+    if self.session is not None:
+      self.session.read[sid] += len(data)
     self.processor.read_event(sid, data)
   
   def handle_write(self, sid):
-    sent = self.sockets[sid].send(self.processor.get_data(sid))
-    self.processor.sent_bytes_event(sid, sent)
+    #a finished connect also lands here, with possibly nothing to send
+    if self.processor.is_writable(sid):
+      if self.get_segments is not None:
+        #hand the kernel every queued segment instead of joining them first
+        sent = self.sockets[sid].send_segments(self.get_segments(sid))
+      else:
+        sent = self.sockets[sid].send(self.processor.get_data(sid))
+      if self.session is not None:
+        self.session.written[sid] += sent
+      self.processor.sent_bytes_event(sid, sent)
     
     #check if theres no data and the other socket is closed
     if not self.processor.is_writable(sid) and not self.sockets[self.other(sid)].connected:
@@ -79,5 +242,66 @@ class SwapHandler(object):
   def writable(self, sid):
     return self.processor.is_writable(sid)
   
+  def readable(self, sid):
+    #backpressure: the processor stops us reading while the other side is backed up
+    return self.is_readable(sid)
+  
   def loop(self):
-    asyncore.loop(map = self.map)
\ No newline at end of file
+    asyncore.loop(map = self.map)
+
+class gathering_write(unittest.TestCase):
+  def test_uses_segments(self):
+    from processor import DataProcessor, PacketProcessor
+    class JoinedProcessor(DataProcessor):
+      def get_data(self, sid):
+        return str(bytearray(DataProcessor.get_data(self, sid))).upper()
+    class SegmentProcessor(JoinedProcessor):
+      def get_segments(self, sid):
+        return [self.get_data(sid)]
+    self.assertTrue(uses_segments(DataProcessor()))
+    self.assertTrue(uses_segments(PacketProcessor()))
+    self.assertFalse(uses_segments(JoinedProcessor()))
+    self.assertTrue(uses_segments(SegmentProcessor()))
+    self.assertFalse(uses_segments(object()))
+
+  def test_swap_handler(self):
+    from processor import DataProcessor
+    class JoinedProcessor(DataProcessor):
+      def get_data(self, sid):
+        return str(bytearray(DataProcessor.get_data(self, sid))).upper()
+    class GatheringHandler(SwapHandler):
+      gathering_writes = True
+
+    for handler_class, processor, gathered in (
+      (SwapHandler, DataProcessor, False),
+      (GatheringHandler, DataProcessor, HAS_SENDMSG),
+      (GatheringHandler, JoinedProcessor, False),
+    ):
+      client_app, client_proxy = socket.socketpair()
+      server_proxy, server_app = socket.socketpair()
+      try:
+        handler = handler_class(client_proxy, '127.0.0.1', 1, processor, {}, server_proxy)
+        self.assertEqual(handler.get_segments is not None, gathered)
+        client_app.sendall('hello')
+        asyncore.loop(0.1, True, handler.map, 2)
+        expected = 'HELLO' if processor is JoinedProcessor else 'hello'
+        self.assertEqual(server_app.recv(100), expected)
+        handler.close()
+      finally:
+        for sock in (client_app, server_app):
+          sock.close()
+
+  def test_sendmsg(self):
+    if not HAS_SENDMSG:
+      return
+    a, b = socket.socketpair()
+    try:
+      segments = ['hello ', memoryview('->world')[2:], bytearray(' !')]
+      self.assertEqual(sendmsg(a, segments), 13)
+      self.assertEqual(b.recv(100), 'hello world !')
+    finally:
+      a.close()
+      b.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+upstream.py
+
+Upstream connections for the proxy.
+
+Resolved addresses are cached so a login burst does not look the server up
+once per client. An Upstream is looked up once up front and refreshed from
+a thread, so connects made on the proxy loop never wait on DNS. An
+UpstreamPool keeps a few connections to a server
+already open on the proxy loop so a new client can be handed one without
+waiting for a TCP handshake. Every connect made through a pool, pre-opened
+or not, is timed and counted in its ConnectStats.
+"""
+
+import asyncore
+import os
+import socket
+import threading
+import time
+import unittest
+
+def resolve(host, port, ttl = 60.0, memo = {}):
+  """
+  Returns (family, sockaddr) for host and port, looking it up at most
+  once every ttl seconds.
+  """
+  now = time.time()
+  cached = memo.get((host, port))
+  if cached is None or cached[0] < now:
+    family, _, _, _, sockaddr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    cached = memo[(host, port)] = (now + ttl, family, sockaddr)
+  return cached[1], cached[2]
+
+class Upstream(object):
+  """
+  The (family, sockaddr) of host and port in address, looked up when it
+  is made. refresh() is called from the loop and looks it up again in a
+  thread once it is older than ttl; until that finishes, and if it
+  fails, the old address is kept.
+  """
+  def __init__(self, host, port, ttl = 60.0):
+    self.host, self.port, self.ttl = host, port, ttl
+    self.address = resolve(host, port, ttl)
+    self.resolved = time.time()
+    self.thread = None
+
+  def __repr__(self):
+    return '<Upstream %s:%d at %s>' % (self.host, self.port, self.address[1])
+
+  def refresh(self):
+    if self.thread is not None or time.time() - self.resolved < self.ttl:
+      return
+    self.thread = threading.Thread(target=self.lookup)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def lookup(self):
+    try:
+      family, _, _, _, sockaddr = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+      self.address = (family, sockaddr)
+    except socket.error:
+      pass
+    finally:
+      self.resolved = time.time()
+      self.thread = None
+
+class ConnectStats(object):
+  """
+  Connect latency and failure counts of one upstream.
+  """
+  def __init__(self):
+    self.connects = 0
+    self.failures = 0
+    self.connect_time = 0.0
+    self.max_connect_time = 0.0
+    self.last_error = None
+
+  def connected(self, latency):
+    self.connects += 1
+    self.connect_time += latency
+    self.max_connect_time = max(self.max_connect_time, latency)
+
+  def failed(self, error):
+    self.failures += 1
+    self.last_error = str(error)
+
+  def average(self):
+    return self.connect_time / self.connects if self.connects else 0.0
+
+  def as_dict(self):
+    return {
+      'connects': self.connects,
+      'failures': self.failures,
+      'connect_time': self.connect_time,
+      'max_connect_time': self.max_connect_time,
+    }
+
+class PooledConnection(asyncore.dispatcher):
+  """
+  One pre-opened connection, connecting or idle in its pool.
+  """
+  def __init__(self, pool):
+    asyncore.dispatcher.__init__(self, map = pool.map)
+    self.pool = pool
+    self.started = time.time()
+    self.ready_at = None
+
+    try:
+      family, sockaddr = pool.upstream.address
+      self.create_socket(family, socket.SOCK_STREAM)
+      self.connect(sockaddr)
+    except:
+      self.close()
+      raise
+
+  def handle_connect(self):
+    err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err != 0:
+      raise socket.error(err, os.strerror(err))
+    self.ready_at = time.time()
+    self.pool.handle_ready(self, self.ready_at - self.started)
+
+  def handle_read(self):
+    #nothing should arrive before the client speaks, so the connection is unusable
+    self.recv(1)
+    self.pool.discard(self)
+
+  def handle_close(self):
+    self.pool.discard(self)
+
+  def handle_error(self):
+    nil, t, v, tbinfo = asyncore.compact_traceback()
+    self.pool.discard(self, v)
+
+  def writable(self):
+    return self.connecting
+
+  def detach(self):
+    #hand the socket over without closing it
+    self.del_channel()
+    sock, self.socket = self.socket, None
+    return sock
+
+class UpstreamPool(object):
+  """
+  Keeps size connections to server:port open in an asyncore map.
+
+  take() hands out an idle connection, or None when there is none and the
+  caller has to connect on its own. Connections are replaced as they are
+  taken, closed by the server or older than max_idle. Failed connects back
+  off, doubling up to max_backoff seconds, so a dead server is not
+  hammered. maintain() has to be called periodically from the loop.
+
+  Connections are made to the address of upstream, an Upstream to
+  server:port made here if not given.
+  """
+  def __init__(self, server, port, map, size = 4, max_idle = 60.0, max_backoff = 30.0, upstream = None):
+    self.server, self.port, self.map = server, port, map
+    self.upstream = upstream if upstream is not None else Upstream(server, port)
+    self.size = size
+    self.max_idle = max_idle
+    self.max_backoff = max_backoff
+    self.connecting = set()
+    self.idle = []
+    self.stats = ConnectStats()
+    self.hits = self.misses = 0
+    self.backoff = 0.0
+    self.retry_at = 0.0
+    self.closed = False
+    self.fill()
+
+  def __repr__(self):
+    return '<UpstreamPool %s:%d %d idle>' % (self.server, self.port, len(self.idle))
+
+  def fill(self):
+    if self.closed or time.time() < self.retry_at:
+      return
+    while len(self.idle) + len(self.connecting) < self.size:
+      try:
+        self.connecting.add(PooledConnection(self))
+      except socket.error, e:
+        self.handle_failure(e)
+        return
+
+  def handle_ready(self, connection, latency):
+    self.connecting.discard(connection)
+    self.idle.append(connection)
+    self.stats.connected(latency)
+    self.backoff = 0.0
+
+  def handle_failure(self, error):
+    self.stats.failed(error)
+    self.backoff = min(self.max_backoff, self.backoff * 2 or 0.5)
+    self.retry_at = time.time() + self.backoff
+
+  def discard(self, connection, error = None):
+    if connection in self.connecting:
+      self.connecting.discard(connection)
+      self.handle_failure(error or 'closed while connecting')
+    elif connection in self.idle:
+      self.idle.remove(connection)
+    connection.close()
+
+  def take(self):
+    """
+    Returns a connected socket, or None if no connection is idle.
+    """
+    if not self.idle:
+      self.misses += 1
+      self.fill()
+      return None
+
+    self.hits += 1
+    sock = self.idle.pop().detach()
+    self.fill()
+    return sock
+
+  def maintain(self):
+    now = time.time()
+    for connection in self.idle[:]:
+      if now - connection.ready_at > self.max_idle:
+        self.discard(connection)
+    self.upstream.refresh()
+    self.fill()
+
+  def close(self):
+    self.closed = True
+    for connection in list(self.connecting) + self.idle:
+      connection.close()
+    self.connecting.clear()
+    self.idle = []
+
+  def as_dict(self):
+    stats = self.stats.as_dict()
+    stats.update({'pool_hits': self.hits, 'pool_misses': self.misses, 'pool_idle': len(self.idle)})
+    return stats
+
+class upstream_pool(unittest.TestCase):
+  def setUp(self):
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(16)
+    self.port = self.listener.getsockname()[1]
+    self.map = {}
+
+  def tearDown(self):
+    for channel in self.map.values():
+      channel.close()
+    self.listener.close()
+
+  def run_loop(self, pool, until, timeout = 2.0):
+    end = time.time() + timeout
+    while not until() and time.time() < end:
+      asyncore.loop(0.05, True, self.map, 1)
+
+  def test_resolve_cached(self):
+    memo = {}
+    self.assertEqual(resolve('127.0.0.1', 80, memo = memo), (socket.AF_INET, ('127.0.0.1', 80)))
+    memo[('127.0.0.1', 80)] = (time.time() + 60, socket.AF_INET, ('127.0.0.2', 80))
+    self.assertEqual(resolve('127.0.0.1', 80, memo = memo)[1], ('127.0.0.2', 80))
+
+  def test_upstream_refresh(self):
+    upstream = Upstream('localhost', self.port, ttl = 0.0)
+    self.assertEqual(upstream.address[1][1], self.port)
+    upstream.address = (socket.AF_INET, ('0.0.0.0', 0))
+    upstream.refresh()
+    #the lookup clears upstream.thread when it is done, possibly already
+    thread = upstream.thread
+    if thread is not None:
+      thread.join(2.0)
+    self.assertEqual(upstream.address[1][1], self.port)
+
+    upstream.ttl = 60.0
+    upstream.refresh()
+    self.assertEqual(upstream.thread, None)
+
+  def test_prewarm_and_take(self):
+    pool = UpstreamPool('127.0.0.1', self.port, self.map, size = 2)
+    self.run_loop(pool, lambda: len(pool.idle) == 2)
+    self.assertEqual(pool.stats.connects, 2)
+
+    sock = pool.take()
+    self.assertNotEqual(sock, None)
+    self.assertEqual(sock.getpeername()[1], self.port)
+    self.assertFalse(any(getattr(channel, 'socket', None) is sock for channel in self.map.values()))
+    self.assertEqual(len(pool.connecting) + len(pool.idle), 2)
+    sock.close()
+    pool.close()
+
+  def test_failure_backoff(self):
+    self.listener.close()
+    pool = UpstreamPool('127.0.0.1', self.port, self.map, size = 1)
+    self.run_loop(pool, lambda: pool.stats.failures)
+    self.assertEqual(pool.stats.failures, 1)
+    self.assertEqual(pool.take(), None)
+    self.assertTrue(pool.retry_at > time.time())
+    self.assertFalse(pool.connecting)
+    pool.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+world.py
+
+World state kept up to date from the map server's packets.
+
+Entities live in an EntityTable: one array per column (x, y, option, ...)
+indexed by slot, a dict from entity id to slot and a free list of the
+slots of entities gone, so in steady state an update is a few array
+stores and nothing is allocated. Every map has a SpatialGrid of cells of
+cell_size tiles holding the slots in them, so nearby() only looks at the
+cells in range.
+
+A World consumes the Batches of registry.parse_stream():
+
+  unit move   0x0086  moves an entity, seen for the first time or not
+  walk ok     0x0087  moves us
+  unit gone   0x0080  frees the entity's slot
+  port to     0x0091  changes map, dropping every entity but us
+  updatestat  0x0141  sets one of our stats
+  emote       0x00C0  sets an entity's last emote
+  changeopt   0x0229  sets an entity's options
+
+Move positions are decoded from p_delta as four 10 bit fields: source x
+and y, then destination x and y. Entities are placed at their destination.
+Batches are walked by index and every value is stored straight into the
+table's columns, so no lists are built per batch or packet; with numpy
+the positions of a run of moves are decoded in one vectorized pass.
+"""
+
+import struct
+import unittest
+from array import array
+from binascii import hexlify
+from data import bit_layout, pack_bytes, unpack_array
+from framer import PacketFramer
+from registry import default_registry
+
+MOVE_BITS = (10, 10, 10, 10)
+((SRC_X_SHIFT, MOVE_MASK), (SRC_Y_SHIFT, _), (X_SHIFT, _), (Y_SHIFT, _)) = bit_layout(MOVE_BITS)[1]
+NOWHERE = -1
+
+class SpatialGrid(object):
+  """
+  Slots bucketed by the cell of cell_size by cell_size tiles they are in.
+  """
+  def __init__(self, cell_size = 8):
+    self.cell_size = cell_size
+    self.cells = {}
+
+  def key(self, x, y):
+    return (x // self.cell_size) << 16 | (y // self.cell_size)
+
+  def insert(self, slot, x, y):
+    key = self.key(x, y)
+    cell = self.cells.get(key)
+    if cell is None:
+      cell = self.cells[key] = set()
+    cell.add(slot)
+
+  def remove(self, slot, x, y):
+    cell = self.cells.get(self.key(x, y))
+    if cell is not None:
+      cell.discard(slot)
+
+  def move(self, slot, old_x, old_y, x, y):
+    if self.key(old_x, old_y) != self.key(x, y):
+      self.remove(slot, old_x, old_y)
+      self.insert(slot, x, y)
+
+  def clear(self):
+    #emptied rather than dropped, so the sets are reused
+    for cell in self.cells.itervalues():
+      cell.clear()
+
+  def query(self, x, y, radius, xs, ys, out):
+    """
+    Appends to out the slots at most radius tiles from (x, y) on either
+    axis, looking up their exact positions in xs and ys.
+    """
+    size, cells = self.cell_size, self.cells
+    low_y, high_y = max(y - radius, 0) // size, (y + radius) // size
+    for cell_x in xrange(max(x - radius, 0) // size, (x + radius) // size + 1):
+      for cell_y in xrange(low_y, high_y + 1):
+        cell = cells.get(cell_x << 16 | cell_y)
+        if not cell:
+          continue
+        for slot in cell:
+          if abs(xs[slot] - x) <= radius and abs(ys[slot] - y) <= radius:
+            out.append(slot)
+    return out
+
+class EntityTable(object):
+  """
+  Column store of entities. Slots of entities gone are reused before the
+  columns grow. Every column is an array('l') indexed by slot; the id
+  column holds NOWHERE for free slots and the x column NOWHERE for
+  entities whose position is not known yet.
+  """
+  columns = ('id', 'x', 'y', 'src_x', 'src_y', 'tick', 'emote', 'opt_1', 'opt_2', 'option', 'karma')
+  defaults = {'id': NOWHERE, 'x': NOWHERE, 'y': NOWHERE, 'src_x': NOWHERE, 'src_y': NOWHERE, 'emote': NOWHERE}
+
+  def __init__(self, capacity = 64):
+    self.slots = {}
+    self.free = []
+    for name in self.columns:
+      setattr(self, name, array('l', [self.defaults.get(name, 0)]) * capacity)
+    self.free.extend(xrange(capacity - 1, -1, -1))
+
+  def __len__(self):
+    return len(self.slots)
+
+  def __contains__(self, id):
+    return id in self.slots
+
+  def capacity(self):
+    return len(self.id)
+
+  def grow(self):
+    capacity = self.capacity()
+    for name in self.columns:
+      getattr(self, name).extend(array('l', [self.defaults.get(name, 0)]) * capacity)
+    self.free.extend(xrange(2 * capacity - 1, capacity - 1, -1))
+
+  def add(self, id):
+    """
+    Returns the slot of id, taking a free one if it is new.
+    """
+    slot = self.slots.get(id)
+    if slot is not None:
+      return slot
+    if not self.free:
+      self.grow()
+    slot = self.free.pop()
+    self.slots[id] = slot
+    self.id[slot] = id
+    return slot
+
+  def remove(self, id):
+    """
+    Frees the slot of id and returns it, or None for an unknown id.
+    """
+    slot = self.slots.pop(id, None)
+    if slot is None:
+      return None
+    for name in self.columns:
+      getattr(self, name)[slot] = self.defaults.get(name, 0)
+    self.free.append(slot)
+    return slot
+
+  def get(self, id, column):
+    return getattr(self, column)[self.slots[id]]
+
+  def row(self, id):
+    slot = self.slots[id]
+    return dict((name, getattr(self, name)[slot]) for name in self.columns)
+
+class World(object):
+  """
+  State of the map one bot is on. self_id is the bot's own character id,
+  kept in the table like any other entity.
+  """
+  def __init__(self, self_id = 0, cell_size = 8, registry = None):
+    self.self_id = self_id
+    self.cell_size = cell_size
+    self.registry = registry or default_registry()
+    self.framer = PacketFramer()
+    self.entities = EntityTable()
+    self.grids = {}
+    self.map = None
+    self.grid = self.grid_for(None)
+    self.stats = {}
+    self.entities.add(self_id)
+
+    self.handlers = {
+      0x0086: self.unit_move,
+      0x0087: self.walk_ok,
+      0x0080: self.unit_gone,
+      0x0091: self.port_to,
+      0x0141: self.update_stat,
+      0x00C0: self.emote,
+      0x0229: self.change_option,
+    }
+
+  def grid_for(self, map):
+    if map not in self.grids:
+      self.grids[map] = SpatialGrid(self.cell_size)
+    return self.grids[map]
+
+  def feed(self, chunks):
+    """
+    Applies every packet in an iterable of recvs. A packet split across
+    calls is applied once it is whole.
+    """
+    for batch in self.registry.parse_stream(chunks, framer = self.framer):
+      self.apply(batch)
+
+  def apply(self, batch):
+    handler = self.handlers.get(batch.opcode)
+    if handler is not None and batch.columns is not None:
+      handler(batch.count, batch.columns)
+
+  def place(self, id, src_x, src_y, x, y, tick = None):
+    entities = self.entities
+    slot = entities.add(id)
+    old_x, old_y = entities.x[slot], entities.y[slot]
+    if old_x == NOWHERE:
+      self.grid.insert(slot, x, y)
+    else:
+      self.grid.move(slot, old_x, old_y, x, y)
+    entities.src_x[slot], entities.src_y[slot] = src_x, src_y
+    entities.x[slot], entities.y[slot] = x, y
+    if tick is not None:
+      entities.tick[slot] = tick
+
+  def remove(self, id):
+    entities = self.entities
+    slot = entities.slots.get(id)
+    if slot is not None and entities.x[slot] != NOWHERE:
+      self.grid.remove(slot, entities.x[slot], entities.y[slot])
+    entities.remove(id)
+
+  def place_moves(self, count, ids, ticks, p_deltas):
+    """
+    Places the entities of a run of moves, us when ids is None.
+    """
+    place, self_id = self.place, self.self_id
+    if hasattr(p_deltas, 'tobytes'):
+      moves = unpack_array(p_deltas.tobytes(), MOVE_BITS)
+      for index in xrange(count):
+        src_x, src_y, x, y = moves[index]
+        place(self_id if ids is None else int(ids[index]), int(src_x), int(src_y), int(x), int(y), int(ticks[index]))
+      return
+
+    mask = MOVE_MASK
+    for index in xrange(count):
+      value = int(hexlify(p_deltas[index]), 16)
+      place(self_id if ids is None else ids[index],
+        value >> SRC_X_SHIFT & mask, value >> SRC_Y_SHIFT & mask,
+        value >> X_SHIFT & mask, value >> Y_SHIFT & mask, ticks[index])
+
+  def unit_move(self, count, columns):
+    self.place_moves(count, columns['id'], columns['tick'], columns['p_delta'])
+
+  def walk_ok(self, count, columns):
+    self.place_moves(count, None, columns['tick'], columns['p_delta'])
+
+  def unit_gone(self, count, columns):
+    ids = columns['id']
+    for index in xrange(count):
+      id = int(ids[index])
+      if id != self.self_id:
+        self.remove(id)
+
+  def port_to(self, count, columns):
+    names, xs, ys = columns['name'], columns['x'], columns['y']
+    for index in xrange(count):
+      name = names[index]
+      name = (name if isinstance(name, str) else name.tobytes()).rstrip('\x00')
+      self.change_map(name, int(xs[index]), int(ys[index]))
+
+  def change_map(self, name, x, y):
+    """
+    Moves us to (x, y) on map name. Nothing else seen on the old map is
+    in sight any more.
+    """
+    for id in [id for id in self.entities.slots if id != self.self_id]:
+      self.entities.remove(id)
+    self.grid.clear()
+    self.map, self.grid = name, self.grid_for(name)
+
+    slot = self.entities.slots[self.self_id]
+    self.entities.x[slot] = NOWHERE
+    self.place(self.self_id, x, y, x, y)
+
+  def update_stat(self, count, columns):
+    types, currents = columns['type'], columns['curr']
+    for index in xrange(count):
+      self.stats[int(types[index])] = int(currents[index])
+
+  def emote(self, count, columns):
+    entities = self.entities
+    ids, types = columns['id'], columns['type']
+    for index in xrange(count):
+      entities.emote[entities.add(int(ids[index]))] = types[index]
+
+  def change_option(self, count, columns):
+    entities = self.entities
+    ids, opt_1, opt_2 = columns['id'], columns['opt_1'], columns['opt_2']
+    option, karma = columns['option'], columns['karma']
+    for index in xrange(count):
+      slot = entities.add(int(ids[index]))
+      entities.opt_1[slot], entities.opt_2[slot] = opt_1[index], opt_2[index]
+      entities.option[slot], entities.karma[slot] = option[index], karma[index]
+
+  def position(self, id = None):
+    slot = self.entities.slots[self.self_id if id is None else id]
+    return self.entities.x[slot], self.entities.y[slot]
+
+  def nearby(self, x, y, radius, out = None):
+    """
+    Returns the ids of the entities at most radius tiles from (x, y) on
+    either axis. Passing out (a list, emptied first) saves allocating one.
+    """
+    if out is None:
+      out = []
+    else:
+      del out[:]
+    entities = self.entities
+    self.grid.query(x, y, radius, entities.x, entities.y, out)
+    ids = entities.id
+    for index in xrange(len(out)):
+      out[index] = ids[out[index]]
+    return out
+
+  def around_me(self, radius, out = None):
+    """
+    nearby() of our own position, without us.
+    """
+    x, y = self.position()
+    out = self.nearby(x, y, radius, out)
+    if self.self_id in out:
+      out.remove(self.self_id)
+    return out
+
+class world_state(unittest.TestCase):
+  @staticmethod
+  def move(id, src, dst, tick = 0):
+    return '\x86\x00' + struct.pack('<I', id) + pack_bytes(src + dst, MOVE_BITS) + '\x88' + struct.pack('<I', tick)
+
+  @staticmethod
+  def walk(src, dst, tick = 0):
+    return '\x87\x00' + struct.pack('<I', tick) + pack_bytes(src + dst, MOVE_BITS) + '\x88'
+
+  def test_moves_and_queries(self):
+    world = World(self_id = 1)
+    world.feed([self.walk((0, 0), (50, 50)), self.move(2, (0, 0), (52, 47), 5) + self.move(3, (0, 0), (90, 90)) + self.move(4, (0, 0), (45, 55))])
+    self.assertEqual(world.position(), (50, 50))
+    self.assertEqual(world.position(2), (52, 47))
+    self.assertEqual(world.entities.get(2, 'tick'), 5)
+    self.assertEqual(sorted(world.around_me(5)), [2, 4])
+    self.assertEqual(sorted(world.nearby(90, 90, 0)), [3])
+
+    move = self.move(3, (90, 90), (51, 51))
+    world.feed([move[:7]])
+    self.assertEqual(world.position(3), (90, 90))
+    world.feed([move[7:]])
+    self.assertEqual(sorted(world.around_me(1)), [3])
+    self.assertEqual(world.nearby(90, 90, 3), [])
+
+  def test_gone_reuses_slots(self):
+    world = World(self_id = 1)
+    world.feed([self.move(id, (0, 0), (id, id)) for id in xrange(2, 12)])
+    capacity, slot = world.entities.capacity(), world.entities.slots[5]
+    world.feed(['\x80\x00\x05\x00\x00\x00\x01'])
+    self.assertFalse(5 in world.entities)
+    self.assertEqual(world.nearby(5, 5, 0), [])
+    world.feed([self.move(20, (0, 0), (7, 7))])
+    self.assertEqual(world.entities.slots[20], slot)
+    self.assertEqual(world.entities.capacity(), capacity)
+
+  def test_grows(self):
+    world = World()
+    world.feed([''.join(self.move(id, (0, 0), (id % 400, id % 300)) for id in xrange(1, 201))])
+    self.assertEqual(len(world.entities), 201)
+    self.assertEqual(world.nearby(10, 10, 0), [10])
+
+  def test_options_emotes_and_stats(self):
+    world = World(self_id = 1)
+    world.feed([
+      '\xc0\x00\x02\x00\x00\x00\x07',
+      '\x29\x02\x02\x00\x00\x00\x01\x00\x00\x00\x20\x00\x00\x00\x00',
+      '\x41\x01\x05\x00\x00\x00\x64\x00\x00\x00\x00\x00\x00\x00',
+    ])
+    self.assertEqual(world.entities.get(2, 'emote'), 7)
+    self.assertEqual((world.entities.get(2, 'opt_1'), world.entities.get(2, 'option')), (1, 32))
+    self.assertEqual(world.entities.get(2, 'x'), NOWHERE)
+    self.assertEqual(world.stats, {5: 100})
+
+  def test_map_change(self):
+    world = World(self_id = 1)
+    world.feed([self.move(2, (0, 0), (10, 10)), self.walk((0, 0), (10, 11))])
+    world.feed(['\x91\x00prontera.gat\x00\x00\x00\x00\x9c\x00\xbf\x00'])
+    self.assertEqual((world.map, world.position()), ('prontera.gat', (156, 191)))
+    self.assertFalse(2 in world.entities)
+    self.assertEqual(world.nearby(10, 10, 5), [])
+    self.assertEqual(world.around_me(5), [])
+
+if __name__ == '__main__':
+  unittest.main()